@@ -1,21 +1,41 @@
 import uvicorn
 from fastapi import FastAPI, Depends, HTTPException, Request, Form, File, UploadFile
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import sqlite3
 import os
+import sys
 import json
 import httpx
 import base64
-from io import BytesIO
+import hashlib
+import hmac
+import html
+import shutil
+import tempfile
+import uuid
+import asyncio
+import time
+import heapq
+import random
+import re
+import unicodedata
+from collections import OrderedDict, deque
+from difflib import SequenceMatcher
+from contextlib import asynccontextmanager
+from io import BytesIO, TextIOWrapper
 try:
     from PIL import Image
     PIL_AVAILABLE = True
 except ImportError:
     PIL_AVAILABLE = False
 
+# 后端和 Bot 共用的模块放在项目根目录的 common/ 下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cassette import Cassette, CassetteTransport
+
 # 路径配置（数据放到 meow_qa_bot 同级的 meow_data 文件夹，避免覆盖更新时丢失）
 # 可通过环境变量 DATA_DIR 自定义
 DATA_DIR = os.getenv("DATA_DIR", "./data")
@@ -24,6 +44,58 @@ CONFIG_PATH = os.path.join(DATA_DIR, "config.json")
 
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# 录制/回放模式（off / record / replay），用于离线复现上游 LLM 流量
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", os.path.join(DATA_DIR, "cassettes", "llm.jsonl"))
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "1.0"))  # 回放延迟倍数，0 表示不等待
+
+# 会话上下文缓存：最多缓存的频道数、每个频道保留的聊天记录条数
+CONTEXT_STORE_MAX_CHANNELS = int(os.getenv("CONTEXT_STORE_MAX_CHANNELS", "500"))
+CONTEXT_STORE_MAX_LINES = int(os.getenv("CONTEXT_STORE_MAX_LINES", "200"))
+
+# 频道滚动摘要：提示词只保留最近 CONTEXT_RAW_KEEP 条原文，更早的记录攒够 CONTEXT_SUMMARY_BATCH 条后
+# 由后台 LLM 调用折叠进摘要
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "true").lower() == "true"
+CONTEXT_RAW_KEEP = int(os.getenv("CONTEXT_RAW_KEEP", "20"))
+CONTEXT_SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "30"))
+CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("CONTEXT_SUMMARY_MAX_CHARS", "800"))
+
+# LLM 调用排队：全局和每个 BOT 的并发上限、排队上限（满了直接 503）、排队超时（秒，超时返回 429）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_CONCURRENCY_PER_BOT = int(os.getenv("LLM_MAX_CONCURRENCY_PER_BOT", "8"))
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "200"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))
+# 频道摘要等后台任务的排队权重（普通问答为 1，越小越靠后）
+LLM_SUMMARY_WEIGHT = float(os.getenv("LLM_SUMMARY_WEIGHT", "0.2"))
+
+# 多上游路由：单次请求超时（秒）、最多尝试轮数、重试退避基数（秒，带随机抖动）
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "90"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.3"))
+# 一次调用（含重试、对冲）的总时限（秒），要小于 Bot 等待 /api/ask 的 90 秒减去排队超时，过了就不再重试
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "70"))
+# 对冲请求：主上游超过其 p95 耗时（不低于 LLM_HEDGE_MIN_DELAY 秒）还没返回时，向次优上游再发一份
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "8"))  # 样本不足时使用
+# 熔断：连续失败 LLM_CIRCUIT_FAILURES 次后暂停使用该上游 LLM_CIRCUIT_COOLDOWN 秒
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))
+
+# 多 Bot 托管进程读取 Discord Token 用的共享密钥（请求头 X-Bot-Host-Secret），未设置时不提供 Token
+BOT_HOST_SECRET = os.getenv("BOT_HOST_SECRET", "")
+
+# FAQ 快速回答：知识库标题索引的最长缓存时间（秒），后台增删改知识时会立即失效
+FAQ_INDEX_TTL = float(os.getenv("FAQ_INDEX_TTL", "300"))
+
+# 知识库导入导出：导入每批插入的条数（每批一个事务，批与批之间释放写锁）、导出每次读取的条数
+KNOWLEDGE_IMPORT_BATCH = int(os.getenv("KNOWLEDGE_IMPORT_BATCH", "500"))
+KNOWLEDGE_EXPORT_BATCH = int(os.getenv("KNOWLEDGE_EXPORT_BATCH", "1000"))
+
+# 后台列表分页：默认每页条数和单页上限
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+ADMIN_PAGE_SIZE_MAX = int(os.getenv("ADMIN_PAGE_SIZE_MAX", "200"))
+
 # 默认配置
 DEFAULT_CONFIG = {
     "llm_base_url": "https://generativelanguage.googleapis.com/v1beta/openai",
@@ -138,7 +210,51 @@ def get_db():
     return conn
 
 
+# 用户记忆全文索引是否可用（SQLite 需要 3.34+ 且带 FTS5），不可用时搜索退回 LIKE
+memory_fts_enabled = False
+
+
+def init_memory_fts(cur) -> bool:
+    """建立 user_memories 的 FTS5 trigram 索引和同步触发器，第一次建立时导入已有记忆"""
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_memories_fts'")
+    exists = cur.fetchone() is not None
+    try:
+        cur.execute(
+            """CREATE VIRTUAL TABLE IF NOT EXISTS user_memories_fts USING fts5(
+                   memory, user_name, user_id,
+                   content='user_memories', content_rowid='id', tokenize='trigram'
+               )"""
+        )
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ [记忆搜索] 当前 SQLite 不支持 FTS5 trigram，搜索使用 LIKE: {e}")
+        return False
+    cur.executescript(
+        """
+        CREATE TRIGGER IF NOT EXISTS user_memories_fts_ai AFTER INSERT ON user_memories BEGIN
+            INSERT INTO user_memories_fts (rowid, memory, user_name, user_id)
+            VALUES (new.id, new.memory, new.user_name, new.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS user_memories_fts_ad AFTER DELETE ON user_memories BEGIN
+            INSERT INTO user_memories_fts (user_memories_fts, rowid, memory, user_name, user_id)
+            VALUES ('delete', old.id, old.memory, old.user_name, old.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS user_memories_fts_au AFTER UPDATE OF memory, user_name, user_id ON user_memories BEGIN
+            INSERT INTO user_memories_fts (user_memories_fts, rowid, memory, user_name, user_id)
+            VALUES ('delete', old.id, old.memory, old.user_name, old.user_id);
+            INSERT INTO user_memories_fts (rowid, memory, user_name, user_id)
+            VALUES (new.id, new.memory, new.user_name, new.user_id);
+        END;
+        """
+    )
+    if not exists:
+        started = time.perf_counter()
+        cur.execute("INSERT INTO user_memories_fts (user_memories_fts) VALUES ('rebuild')")
+        print(f"🔎 [记忆搜索] 已建立全文索引，耗时 {(time.perf_counter() - started) * 1000:.0f}ms")
+    return True
+
+
 def init_db():
+    global memory_fts_enabled
     conn = get_db()
     cur = conn.cursor()
     
@@ -182,6 +298,19 @@ def init_db():
         """
     )
     
+    # 知识标签表（knowledge.tags 拆分后的规范化标签，用于精确筛选和检索加权）
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS knowledge_tags (
+            knowledge_id INTEGER NOT NULL,
+            bot_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (knowledge_id, tag)
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_tags_bot_tag ON knowledge_tags(bot_id, tag, knowledge_id)")
+    
     # 统计表（加bot_id）
     cur.execute(
         """
@@ -194,6 +323,31 @@ def init_db():
         """
     )
     
+    # LLM 用量表（每次调用一行：token 数、耗时、模型/档位，以及提示词各部分的字数）
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_id TEXT NOT NULL,
+            user_id TEXT DEFAULT '',
+            model TEXT DEFAULT '',
+            tier TEXT DEFAULT '',
+            upstream TEXT DEFAULT '',
+            ok INTEGER DEFAULT 1,
+            prompt_tokens INTEGER DEFAULT 0,
+            completion_tokens INTEGER DEFAULT 0,
+            cached_tokens INTEGER DEFAULT 0,
+            latency_ms INTEGER DEFAULT 0,
+            prompt_chars INTEGER DEFAULT 0,
+            memory_chars INTEGER DEFAULT 0,
+            history_chars INTEGER DEFAULT 0,
+            knowledge_chars INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_bot_time ON llm_usage(bot_id, created_at)")
+    
     # 用户记忆表（加bot_id，改唯一约束）
     cur.execute(
         """
@@ -224,6 +378,8 @@ def init_db():
         """
     )
     
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bots_created ON bots(created_at, id)")
+    
     # 确保默认BOT存在并修正名称
     cur.execute("INSERT OR IGNORE INTO bots (id, name) VALUES ('default', 'Fishy')")
     cur.execute("INSERT OR IGNORE INTO bots (id, name) VALUES ('maodie', '小鱼娘')")
@@ -261,11 +417,102 @@ def init_db():
         cur.execute("ALTER TABLE user_memories ADD COLUMN bot_id TEXT DEFAULT 'default'")
     except:
         pass
+    try:
+        cur.execute("ALTER TABLE bot_configs ADD COLUMN discord_token TEXT DEFAULT ''")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE bot_configs ADD COLUMN llm_upstreams TEXT DEFAULT ''")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE bot_configs ADD COLUMN llm_tiers TEXT DEFAULT ''")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE bot_configs ADD COLUMN faq_enabled INTEGER DEFAULT 0")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE bot_configs ADD COLUMN faq_threshold REAL DEFAULT 0.9")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE bot_configs ADD COLUMN faq_templates TEXT DEFAULT ''")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE ask_logs ADD COLUMN fast_path INTEGER DEFAULT 0")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE bot_configs ADD COLUMN knowledge_tag_mode TEXT DEFAULT 'off'")
+    except:
+        pass
+    try:
+        cur.execute("ALTER TABLE knowledge ADD COLUMN content_hash TEXT DEFAULT ''")
+    except:
+        pass
+    
+    # 后台列表按 bot_id 分页用的索引（放在迁移之后，旧表补上 bot_id 列才能建）
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_bot ON knowledge(bot_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_memories_bot_updated ON user_memories(bot_id, updated_at, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_hash ON knowledge(bot_id, content_hash)")
+    
+    # 补算内容哈希（导入去重用）
+    cur.execute("SELECT id, title, content FROM knowledge WHERE content_hash IS NULL OR content_hash = ''")
+    missing = [(knowledge_hash(row[1], row[2]), row[0]) for row in cur.fetchall()]
+    if missing:
+        cur.executemany("UPDATE knowledge SET content_hash = ? WHERE id = ?", missing)
+        print(f"🧮 [知识库] 已补算 {len(missing)} 条知识的内容哈希")
+    
+    # 用户记忆全文索引
+    memory_fts_enabled = init_memory_fts(cur)
+    
+    # 补建标签索引：有标签但还没拆分过的知识
+    cur.execute(
+        """SELECT id, bot_id, tags FROM knowledge
+           WHERE tags != '' AND id NOT IN (SELECT knowledge_id FROM knowledge_tags)"""
+    )
+    missing = cur.fetchall()
+    for row in missing:
+        sync_knowledge_tags(cur, row[0], row[1] or "default", row[2])
+    if missing:
+        print(f"🏷️ [标签索引] 已补建 {len(missing)} 条知识的标签")
     
     conn.commit()
     conn.close()
 
 
+def split_tags(text: str) -> list:
+    """按逗号、顿号、分号拆分 knowledge.tags，保留原始大小写（用于展示）"""
+    return [tag.strip() for tag in re.split(r"[,，、;；]", text or "") if tag.strip()]
+
+
+def parse_tags(text: str) -> list:
+    """规范化标签：不区分大小写，去重保序"""
+    tags = []
+    for tag in split_tags(text):
+        tag = tag.lower()
+        if tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def knowledge_hash(title: str, content: str) -> str:
+    """知识的内容哈希（标题 + 内容，忽略首尾空白），同一个 BOT 下用于导入去重"""
+    return hashlib.sha256(f"{(title or '').strip()}\n{(content or '').strip()}".encode("utf-8")).hexdigest()
+
+
+def sync_knowledge_tags(cur, knowledge_id: int, bot_id: str, tags_text: str):
+    """重写某条知识的标签索引，增删改和导入知识后调用"""
+    cur.execute("DELETE FROM knowledge_tags WHERE knowledge_id = ?", (knowledge_id,))
+    cur.executemany(
+        "INSERT OR IGNORE INTO knowledge_tags (knowledge_id, bot_id, tag) VALUES (?, ?, ?)",
+        [(knowledge_id, bot_id, tag) for tag in parse_tags(tags_text)]
+    )
+
+
 class AskRequest(BaseModel):
     question: str
     image_urls: list = []
@@ -274,6 +521,74 @@ class AskRequest(BaseModel):
     user_name: str = ""
     user_id: str = ""
     bot_id: str = "default"
+    # 会话上下文缓存：带 channel_id 和 context_cursor 时，chat_history 只需包含 context_base 之后的新消息
+    channel_id: str = ""
+    context_base: str = ""  # 为空表示 chat_history 是完整列表
+    context_cursor: str = ""  # 本次 chat_history 最后一条消息的游标
+    context_limit: int = 0  # 提示词中使用的最近聊天记录条数，0 表示全部
+    channel_name: str = ""  # 频道名（含分类、父频道名），用于推断知识标签
+
+
+class ConversationContextStore:
+    """按 (bot_id, channel_id) 保存频道最近的聊天记录和滚动摘要
+
+    Bot 每次只发送上次确认的游标之后新增的消息；游标对不上（后端重启、并发请求、
+    消息被编辑删除等）时返回 None，由接口返回 409 让 Bot 重发完整列表。
+    每条记录带递增序号，summary_upto 之前的记录已折叠进 summary，提示词只用摘要和之后的原文。
+    """
+
+    def __init__(self, max_channels: int, max_lines: int):
+        self.max_channels = max_channels
+        self.max_lines = max_lines
+        self.contexts = OrderedDict()
+
+    def apply(self, bot_id: str, channel_id: str, base: str, cursor: str, lines: list):
+        key = (bot_id, channel_id)
+        ctx = self.contexts.get(key)
+        if not base:
+            if ctx is None:
+                ctx = {"seq": 0, "summary": "", "summary_upto": 0, "summarizing": False, "epoch": 0}
+            # 完整重发：新列表就是完整历史，旧摘要会和它重复，清空后重新折叠；
+            # epoch 变化后，进行中的摘要任务结果作废
+            ctx["summary"] = ""
+            ctx["summary_upto"] = ctx["seq"]
+            ctx["epoch"] += 1
+            ctx["lines"] = deque()
+        elif ctx is None or ctx["cursor"] != base:
+            return None
+        for line in lines:
+            ctx["seq"] += 1
+            ctx["lines"].append((ctx["seq"], line))
+        self._trim(ctx)
+        ctx["cursor"] = cursor
+        self.contexts[key] = ctx
+        self.contexts.move_to_end(key)
+        while len(self.contexts) > self.max_channels:
+            self.contexts.popitem(last=False)
+        return ctx
+
+    def _trim(self, ctx: dict):
+        """超过 max_lines 时先丢已折叠进摘要的记录，仍然超出（摘要一直失败）才丢最早的原文"""
+        lines = ctx["lines"]
+        while len(lines) > self.max_lines and lines[0][0] <= ctx["summary_upto"]:
+            lines.popleft()
+        while len(lines) > self.max_lines:
+            lines.popleft()
+
+    @staticmethod
+    def unsummarized(ctx: dict) -> list:
+        """还没折叠进摘要的记录 [(seq, line)]"""
+        return [item for item in ctx["lines"] if item[0] > ctx["summary_upto"]]
+
+
+context_store = ConversationContextStore(CONTEXT_STORE_MAX_CHANNELS, CONTEXT_STORE_MAX_LINES)
+
+
+def effective_llm_model(bot_model: str) -> str:
+    """BOT 自己填了模型就用它；为空或仍是建表默认值时沿用全局的 LLM_MODEL / config.json"""
+    if bot_model and bot_model != DEFAULT_CONFIG["llm_model"]:
+        return bot_model
+    return app_config.get("llm_model") or DEFAULT_CONFIG["llm_model"]
 
 
 def get_bot_config(bot_id: str) -> dict:
@@ -288,27 +603,52 @@ def get_bot_config(bot_id: str) -> dict:
         return {
             "llm_base_url": row["llm_base_url"] or DEFAULT_CONFIG["llm_base_url"],
             "llm_api_key": row["llm_api_key"] or "",
-            "llm_model": row["llm_model"] or DEFAULT_CONFIG["llm_model"],
+            "llm_model": effective_llm_model(row["llm_model"]),
             "bot_persona": row["bot_persona"] or DEFAULT_CONFIG["bot_persona"],
             "context_limit": row["context_limit"] or 100,
+            "discord_token": row["discord_token"] or "",
+            "llm_upstreams": row["llm_upstreams"] or "",
+            "llm_tiers": row["llm_tiers"] or "",
+            "faq_enabled": bool(row["faq_enabled"]),
+            "faq_threshold": row["faq_threshold"] if row["faq_threshold"] is not None else 0.9,
+            "faq_templates": row["faq_templates"] or "",
+            "knowledge_tag_mode": row["knowledge_tag_mode"] or "off",
         }
     # 没有配置则用默认
-    return DEFAULT_CONFIG.copy()
+    config = DEFAULT_CONFIG.copy()
+    config["llm_model"] = effective_llm_model("")
+    return config
+
+
+# bot_configs 中可保存的字段及默认值
+BOT_CONFIG_FIELDS = (
+    ("llm_base_url", ""),
+    ("llm_api_key", ""),
+    ("llm_model", ""),
+    ("bot_persona", ""),
+    ("context_limit", 100),
+    ("discord_token", ""),
+    ("llm_upstreams", ""),
+    ("llm_tiers", ""),
+    ("faq_enabled", 0),
+    ("faq_threshold", 0.9),
+    ("faq_templates", ""),
+    ("knowledge_tag_mode", "off"),
+)
 
 
 def save_bot_config(bot_id: str, config: dict):
     """保存指定BOT的配置"""
+    values = [config.get(field, default) for field, default in BOT_CONFIG_FIELDS]
+    columns = ", ".join(field for field, _ in BOT_CONFIG_FIELDS)
+    updates = ", ".join(f"{field} = excluded.{field}" for field, _ in BOT_CONFIG_FIELDS)
     conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        """INSERT INTO bot_configs (bot_id, llm_base_url, llm_api_key, llm_model, bot_persona, context_limit)
-           VALUES (?, ?, ?, ?, ?, ?)
-           ON CONFLICT(bot_id) DO UPDATE SET 
-           llm_base_url = ?, llm_api_key = ?, llm_model = ?, bot_persona = ?, context_limit = ?""",
-        (bot_id, config.get("llm_base_url", ""), config.get("llm_api_key", ""),
-         config.get("llm_model", ""), config.get("bot_persona", ""), config.get("context_limit", 100),
-         config.get("llm_base_url", ""), config.get("llm_api_key", ""),
-         config.get("llm_model", ""), config.get("bot_persona", ""), config.get("context_limit", 100))
+        f"""INSERT INTO bot_configs (bot_id, {columns})
+           VALUES (?{", ?" * len(BOT_CONFIG_FIELDS)})
+           ON CONFLICT(bot_id) DO UPDATE SET {updates}""",
+        [bot_id] + values
     )
     conn.commit()
     conn.close()
@@ -319,6 +659,397 @@ async def on_startup():
     init_db()
 
 
+# ==================== 录制/回放 ====================
+
+_cassette = None
+
+
+def get_cassette():
+    """按 CASSETTE_MODE 返回全局录制文件，off 时返回 None"""
+    global _cassette
+    if CASSETTE_MODE not in ("record", "replay"):
+        return None
+    if _cassette is None:
+        _cassette = Cassette(CASSETTE_MODE, CASSETTE_PATH, CASSETTE_LATENCY_SCALE)
+    return _cassette
+
+
+class LLMScheduler:
+    """LLM 调用的准入控制和公平排队
+
+    全局、每个 BOT 分别限制并发；排队的请求按流（用户/频道）做加权公平排队（SCFQ）：
+    每个请求的虚拟完成时间 = max(当前虚拟时间, 该流上一个请求的完成时间) + 1/权重，
+    总是先放行完成时间最小的，刷屏的用户只会排在自己后面，不会挤占其他人。
+    """
+
+    def __init__(self, max_concurrency: int, per_bot: int, queue_max: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.per_bot = per_bot
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.running_by_bot = {}
+        # (虚拟完成时间, 序号, 条目)
+        self.heap = []
+        self.waiting = 0
+        self.waiting_by_bot = {}
+        self.virtual_time = 0.0
+        self.flow_finish = {}
+        self.seq = 0
+        # 统计
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_ms = deque(maxlen=1000)
+
+    def _can_run(self, bot_id: str) -> bool:
+        return self.running < self.max_concurrency and self.running_by_bot.get(bot_id, 0) < self.per_bot
+
+    def _start(self, bot_id: str):
+        self.running += 1
+        self.running_by_bot[bot_id] = self.running_by_bot.get(bot_id, 0) + 1
+
+    def _dispatch(self):
+        """按虚拟完成时间依次放行，所属 BOT 已满的先跳过"""
+        skipped = []
+        while self.heap and self.running < self.max_concurrency:
+            item = heapq.heappop(self.heap)
+            finish, _, entry = item
+            if entry["future"].done():
+                continue
+            if not self._can_run(entry["bot_id"]):
+                skipped.append(item)
+                continue
+            self.virtual_time = max(self.virtual_time, finish)
+            self._dequeue(entry)
+            self._start(entry["bot_id"])
+            entry["future"].set_result(True)
+        for item in skipped:
+            heapq.heappush(self.heap, item)
+        # 已经空闲的流不再需要记录完成时间
+        if len(self.flow_finish) > 1000:
+            self.flow_finish = {k: v for k, v in self.flow_finish.items() if v > self.virtual_time}
+
+    def _dequeue(self, entry: dict):
+        self.waiting -= 1
+        self.waiting_by_bot[entry["bot_id"]] -= 1
+
+    def release(self, bot_id: str):
+        self.running -= 1
+        self.running_by_bot[bot_id] -= 1
+        self._dispatch()
+
+    async def acquire(self, bot_id: str, flow: str, weight: float = 1.0):
+        """获取一个调用名额，排队满了抛 503，等待超时抛 429"""
+        started = time.perf_counter()
+        if not self.heap and self._can_run(bot_id):
+            self._start(bot_id)
+            self.admitted += 1
+            self.wait_ms.append(0.0)
+            return
+        if self.waiting >= self.queue_max:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="llm_queue_full", headers={"Retry-After": "5"})
+        finish = max(self.virtual_time, self.flow_finish.get(flow, 0.0)) + 1.0 / max(weight, 0.01)
+        self.flow_finish[flow] = finish
+        self.seq += 1
+        entry = {"bot_id": bot_id, "future": asyncio.get_running_loop().create_future()}
+        heapq.heappush(self.heap, (finish, self.seq, entry))
+        self.waiting += 1
+        self.waiting_by_bot[bot_id] = self.waiting_by_bot.get(bot_id, 0) + 1
+        # 排在前面的可能都属于已满的 BOT，本 BOT 还有空位时立即放行
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(entry["future"]), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if entry["future"].done() and not entry["future"].cancelled():
+                # 刚好在超时的同时被放行，名额要还回去
+                self.release(bot_id)
+            else:
+                entry["future"].cancel()
+                self._dequeue(entry)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.timed_out += 1
+            raise HTTPException(status_code=429, detail="llm_busy", headers={"Retry-After": "3"})
+        self.admitted += 1
+        self.wait_ms.append((time.perf_counter() - started) * 1000)
+
+    @asynccontextmanager
+    async def slot(self, bot_id: str, flow: str, weight: float = 1.0):
+        await self.acquire(bot_id, flow, weight)
+        try:
+            yield
+        finally:
+            self.release(bot_id)
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_ms)
+
+        def pct(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))], 1) if waits else 0.0
+
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "running_by_bot": {k: v for k, v in self.running_by_bot.items() if v},
+            "waiting_by_bot": {k: v for k, v in self.waiting_by_bot.items() if v},
+            "max_concurrency": self.max_concurrency,
+            "max_concurrency_per_bot": self.per_bot,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": round(waits[-1], 1) if waits else 0.0},
+        }
+
+
+llm_scheduler = LLMScheduler(LLM_MAX_CONCURRENCY, LLM_MAX_CONCURRENCY_PER_BOT, LLM_QUEUE_MAX, LLM_QUEUE_TIMEOUT)
+
+
+class UpstreamHealth:
+    """单个上游的滚动健康数据：最近成功请求的耗时、最近的成败记录、熔断状态"""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=100)
+        self.results = deque(maxlen=50)
+        self.failures = 0
+        self.open_until = 0.0
+        self.in_flight = 0
+        # 被取消（对冲落败）的请求已等待的最长时长：只是耗时的下限，不算样本，下次成功后清零
+        self.slow_floor = 0.0
+
+    def record(self, ok: bool, latency_ms: float):
+        self.results.append(ok)
+        if ok:
+            self.latencies.append(latency_ms)
+            self.slow_floor = 0.0
+            self.failures = 0
+            self.open_until = 0.0
+            return
+        self.failures += 1
+        if self.failures >= LLM_CIRCUIT_FAILURES:
+            self.open_until = time.monotonic() + LLM_CIRCUIT_COOLDOWN
+
+    def is_open(self) -> bool:
+        return self.open_until > time.monotonic()
+
+    def error_rate(self) -> float:
+        return 1 - sum(self.results) / len(self.results) if self.results else 0.0
+
+    def percentile(self, q: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def cancelled(self, elapsed_ms: float):
+        self.slow_floor = max(self.slow_floor, elapsed_ms)
+
+    def score(self) -> float:
+        """越小越好：中位耗时（秒）按错误率放大，并考虑正在处理的请求数；没有样本的为 0，优先试探
+
+        被取消的慢请求只把耗时往上抬（下限），不会让上游显得更快。
+        """
+        p50 = self.percentile(0.5)
+        if p50 is None and not self.slow_floor:
+            return 0.0
+        p50 = max(p50 or 0.0, self.slow_floor)
+        return p50 / 1000 * (1 + 4 * self.error_rate()) * (1 + 0.1 * self.in_flight)
+
+
+class LLMRouter:
+    """在一个 BOT 的多个 OpenAI 兼容上游之间路由
+
+    - 按健康分选择最好的上游，熔断中的跳过（全部熔断时试探最早恢复的那个）
+    - 主上游超过 p95 耗时还没返回就向次优上游发对冲请求，先成功的胜出，另一个取消
+    - 主上游直接失败时立即切到次优上游；整轮都失败且可重试时按带抖动的指数退避再来一轮
+    """
+
+    def __init__(self):
+        self.health = {}
+
+    @staticmethod
+    def key(upstream: dict) -> str:
+        return f"{upstream['base_url']}|{upstream['model']}"
+
+    def get_health(self, upstream: dict) -> UpstreamHealth:
+        key = self.key(upstream)
+        if key not in self.health:
+            self.health[key] = UpstreamHealth()
+        return self.health[key]
+
+    def rank(self, upstreams: list) -> list:
+        available = [u for u in upstreams if not self.get_health(u).is_open()]
+        if not available:
+            return [min(upstreams, key=lambda u: self.get_health(u).open_until)]
+        return sorted(available, key=lambda u: self.get_health(u).score())
+
+    def hedge_delay(self, upstream: dict) -> float:
+        health = self.get_health(upstream)
+        p95 = health.percentile(0.95) if len(health.latencies) >= 10 else None
+        return max(LLM_HEDGE_MIN_DELAY, p95 / 1000 if p95 is not None else LLM_HEDGE_DEFAULT_DELAY)
+
+    async def _request(self, upstream: dict, payload: dict, deadline: float) -> dict:
+        health = self.get_health(upstream)
+        headers = {"Authorization": f"Bearer {upstream['api_key']}", "Content-Type": "application/json"}
+        result = {"ok": False, "upstream": upstream["name"], "model": upstream["model"], "status": 0}
+        health.in_flight += 1
+        started = time.perf_counter()
+        try:
+            timeout = max(0.1, min(LLM_TIMEOUT, deadline - time.monotonic()))
+            async with llm_http(timeout=timeout) as client:
+                resp = await client.post(
+                    f"{upstream['base_url']}/chat/completions",
+                    headers=headers,
+                    json=dict(payload, model=upstream["model"]),
+                )
+            result["status"] = resp.status_code
+            if resp.status_code != 200:
+                result["error"] = f"LLM 调用失败: {resp.status_code} {resp.text}"
+                result["retryable"] = resp.status_code == 429 or resp.status_code >= 500
+            else:
+                data = resp.json()
+                result.update(
+                    ok=True,
+                    content=data["choices"][0]["message"]["content"].strip(),
+                    usage=data.get("usage") or {},
+                )
+        except asyncio.CancelledError:
+            # 对冲落败被取消：不算失败也不算耗时样本（否则刚发出就被取消的请求会显得很快），
+            # 只把已等待的时长记作排序用的耗时下限，避免慢上游一直排在前面
+            health.cancelled((time.perf_counter() - started) * 1000)
+            raise
+        except Exception as e:
+            result["error"] = f"LLM 调用出错: {str(e)}"
+            result["retryable"] = True
+        finally:
+            health.in_flight -= 1
+        result["latency_ms"] = (time.perf_counter() - started) * 1000
+        if not result["ok"] and not result.get("retryable"):
+            # 401/404 等是 Key、模型名配置错误，不是上游不健康，不计入熔断
+            return result
+        was_open = health.is_open()
+        health.record(result["ok"], result["latency_ms"])
+        if health.is_open() and not was_open:
+            print(f"🔌 [LLM 熔断] {upstream['name']} 连续失败 {health.failures} 次，暂停 {LLM_CIRCUIT_COOLDOWN:.0f}s")
+        return result
+
+    async def _race(self, ranked: list, payload: dict, deadline: float) -> dict:
+        """向最优上游发请求，慢了就对冲、失败了就切换，返回第一个成功的结果（都失败则返回最后一个失败）
+
+        过了 deadline 不再对冲或切换，还没返回的请求直接取消。
+        """
+        backups = list(ranked[1:])
+        tasks = {asyncio.create_task(self._request(ranked[0], payload, deadline))}
+        hedged = False
+        result = None
+        try:
+            hedge_at = time.monotonic() + self.hedge_delay(ranked[0]) if LLM_HEDGE_ENABLED and backups else None
+            while tasks:
+                wait_until = min(deadline, hedge_at) if hedge_at is not None else deadline
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=max(0, wait_until - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    now = time.monotonic()
+                    if now >= deadline:
+                        result = {
+                            "ok": False, "upstream": ranked[0]["name"], "model": ranked[0]["model"], "status": 0,
+                            "error": f"LLM 调用超时: 超过 {LLM_DEADLINE:.0f}s", "retryable": False,
+                        }
+                        break
+                    if hedge_at is not None and now >= hedge_at and backups:
+                        # 主上游太慢，向次优上游发对冲请求（只对冲一次）
+                        hedge_at = None
+                        backup = backups.pop(0)
+                        print(f"⚡ [LLM 对冲] {ranked[0]['name']} 超过 {self.hedge_delay(ranked[0]):.1f}s，加发到 {backup['name']}")
+                        tasks.add(asyncio.create_task(self._request(backup, payload, deadline)))
+                        hedged = True
+                    # 提前醒来但还没到对冲时间：继续等
+                    continue
+                # 有请求结束后不再对冲，失败的由下面立即切换
+                hedge_at = None
+                for task in done:
+                    result = task.result()
+                    if result["ok"]:
+                        result["hedged"] = hedged
+                        return result
+                if not tasks and backups and time.monotonic() < deadline:
+                    # 失败了立即切到下一个上游
+                    tasks.add(asyncio.create_task(self._request(backups.pop(0), payload, deadline)))
+        finally:
+            for task in tasks:
+                task.cancel()
+        result["hedged"] = hedged
+        return result
+
+    async def complete(self, upstreams: list, payload: dict) -> dict:
+        deadline = time.monotonic() + LLM_DEADLINE
+        result = None
+        for attempt in range(LLM_MAX_ATTEMPTS):
+            result = await self._race(self.rank(upstreams), payload, deadline)
+            result["attempts"] = attempt + 1
+            if result["ok"] or not result.get("retryable"):
+                return result
+            if attempt < LLM_MAX_ATTEMPTS - 1:
+                delay = LLM_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if time.monotonic() + delay >= deadline:
+                    # 剩下的时间不够再来一轮，调用方那边也快超时了
+                    break
+                await asyncio.sleep(delay)
+        return result
+
+    def stats(self) -> dict:
+        stats = {}
+        for key, health in self.health.items():
+            stats[key] = {
+                "samples": len(health.latencies),
+                "p50_ms": round(health.percentile(0.5) or 0, 1),
+                "p95_ms": round(health.percentile(0.95) or 0, 1),
+                "error_rate": round(health.error_rate(), 3),
+                "consecutive_failures": health.failures,
+                "circuit_open": health.is_open(),
+                "in_flight": health.in_flight,
+            }
+        return stats
+
+
+llm_router = LLMRouter()
+
+
+def llm_upstreams_for(config: dict) -> list:
+    """BOT 的上游列表：主配置 + llm_upstreams 中的备用上游，未填写的 api_key / model 沿用主配置"""
+    primary = {
+        "name": "primary",
+        "base_url": config.get("llm_base_url", "").rstrip("/"),
+        "api_key": config.get("llm_api_key", ""),
+        "model": config.get("llm_model") or effective_llm_model(""),
+    }
+    upstreams = [primary] if primary["base_url"] else []
+    try:
+        extras = json.loads(config.get("llm_upstreams") or "[]")
+    except ValueError:
+        extras = []
+    for i, extra in enumerate(extras if isinstance(extras, list) else []):
+        if not isinstance(extra, dict) or not extra.get("base_url"):
+            continue
+        upstreams.append({
+            "name": extra.get("name") or f"backup{i + 1}",
+            "base_url": extra["base_url"].rstrip("/"),
+            "api_key": extra.get("api_key") or primary["api_key"],
+            "model": extra.get("model") or primary["model"],
+        })
+    return [u for u in upstreams if u["api_key"]]
+
+
+def llm_http(timeout: float = 90) -> httpx.AsyncClient:
+    """创建访问 LLM 上游的 HTTP 客户端（录制/回放模式下包一层 CassetteTransport）"""
+    cassette = get_cassette()
+    if cassette:
+        return httpx.AsyncClient(timeout=timeout, transport=CassetteTransport(cassette))
+    return httpx.AsyncClient(timeout=timeout)
+
+
 async def process_image_url(img_url: str) -> str:
     """处理图片URL，如果是GIF则转换成PNG的base64"""
     # 检查是否是GIF
@@ -360,17 +1091,260 @@ async def process_image_url(img_url: str) -> str:
         return None
 
 
-async def call_llm(prompt: str, image_urls: list = None, bot_id: str = "default") -> str:
-    """调用LLM，使用指定BOT的配置"""
-    config = get_bot_config(bot_id)
-    
-    if not config.get("llm_api_key"):
-        return "LLM_API_KEY 未配置，请在后台设置页面配置。"
+# ==================== 模型分级 ====================
+# 分级规则里可用的条件：布尔特征直接比较，数值特征用 min_ / max_ 前缀
+TIER_BOOL_FEATURES = ("has_images", "knowledge_hit", "has_memory")
+TIER_NUMBER_FEATURES = ("question_chars", "prompt_chars", "history_lines", "knowledge_hits")
+
+
+def prompt_features(question: str, prompt: str, chat_history: list, rows: list, image_urls: list, user_memory: str) -> dict:
+    """拼装提示词时顺带算出的请求特征，供模型分级规则使用"""
+    return {
+        "question_chars": len(question),
+        "prompt_chars": len(prompt),
+        "history_lines": len(chat_history),
+        "knowledge_hits": len(rows),
+        "knowledge_hit": bool(rows),
+        "has_images": bool(image_urls),
+        "has_memory": bool(user_memory),
+    }
+
 
-    base_url = config.get("llm_base_url", "").rstrip("/")
-    url = f"{base_url}/chat/completions"
-    headers = {"Authorization": f"Bearer {config['llm_api_key']}", "Content-Type": "application/json"}
+def validate_llm_tiers(text: str) -> str:
+    """检查分级配置，返回错误信息（没有错误返回空字符串）
+
+    保存时检查，select_llm_tier 每次也会检查，不合法的配置一律退回默认档位。
+    """
+    try:
+        spec = json.loads(text)
+    except ValueError:
+        return "不是合法的 JSON"
+    if not isinstance(spec, dict) or not isinstance(spec.get("tiers", {}), dict) or not isinstance(spec.get("rules", []), list):
+        return "需要 {\"tiers\": {...}, \"rules\": [...]}"
+    for name, tier in spec.get("tiers", {}).items():
+        if not isinstance(tier, dict):
+            return f"档位 {name} 需要是对象，如 {{\"model\": \"...\"}}"
+        for key in ("model", "base_url", "api_key"):
+            if key in tier and not isinstance(tier[key], str):
+                return f"档位 {name} 的 {key} 需要是字符串"
+        if "upstreams" in tier and not isinstance(tier["upstreams"], list):
+            return f"档位 {name} 的 upstreams 需要是列表"
+    numbers = {f"{p}_{f}" for f in TIER_NUMBER_FEATURES for p in ("min", "max")}
+    allowed = {"tier"} | set(TIER_BOOL_FEATURES) | numbers
+    for rule in spec.get("rules", []):
+        if not isinstance(rule, dict) or rule.get("tier") not in spec.get("tiers", {}):
+            return f"规则 {rule} 引用了未定义的档位"
+        unknown = set(rule) - allowed
+        if unknown:
+            return f"不支持的条件 {', '.join(sorted(unknown))}"
+        for key, value in rule.items():
+            # bool 是 int 的子类，要单独排除
+            if key in numbers and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                return f"条件 {key} 需要是数字，不能是 {json.dumps(value, ensure_ascii=False)}"
+            if key in TIER_BOOL_FEATURES and not isinstance(value, bool):
+                return f"条件 {key} 需要是 true 或 false"
+    return ""
+
+
+def rule_matches(rule: dict, features: dict) -> bool:
+    for key, expected in rule.items():
+        if key == "tier":
+            continue
+        if key.startswith("min_"):
+            if features.get(key[4:], 0) < expected:
+                return False
+        elif key.startswith("max_"):
+            if features.get(key[4:], 0) > expected:
+                return False
+        elif features.get(key) != expected:
+            return False
+    return True
+
+
+def select_llm_tier(config: dict, features: dict):
+    """按 BOT 的分级规则（从上到下第一条匹配的）选择档位，返回 (档位名, 调整后的配置)
+
+    档位可以覆盖 model / base_url / api_key / upstreams；换了 base_url 而没给 upstreams 时不再使用备用上游。
+    """
+    text = config.get("llm_tiers") or "{}"
+    error = validate_llm_tiers(text)
+    if error:
+        # 旧数据或手工改库留下的不合法配置：用默认档位，不让每次提问都报错
+        print(f"⚠️ [分级] 分级配置无效（{error}），使用默认档位")
+        return "default", config
+    spec = json.loads(text)
+    tiers = spec.get("tiers") or {}
+    for rule in spec.get("rules") or []:
+        tier = tiers.get(rule.get("tier"))
+        if tier is None or not rule_matches(rule, features):
+            continue
+        tiered = dict(config)
+        if tier.get("model"):
+            tiered["llm_model"] = tier["model"]
+        if tier.get("base_url"):
+            tiered["llm_base_url"] = tier["base_url"]
+            tiered["llm_upstreams"] = ""
+        if tier.get("api_key"):
+            tiered["llm_api_key"] = tier["api_key"]
+        if "upstreams" in tier:
+            tiered["llm_upstreams"] = json.dumps(tier["upstreams"])
+        return rule["tier"], tiered
+    return "default", config
+
+
+class TierStats:
+    """各档位的请求数、耗时和 token 用量（进程内，重启清零）"""
+
+    def __init__(self):
+        # (bot_id, 档位) -> 统计
+        self.tiers = {}
+
+    def record(self, bot_id: str, tier: str, result: dict):
+        stats = self.tiers.setdefault((bot_id, tier), {
+            "requests": 0, "errors": 0, "latencies": deque(maxlen=500),
+            "prompt_tokens": 0, "completion_tokens": 0, "model": "",
+        })
+        stats["requests"] += 1
+        if not result.get("ok"):
+            stats["errors"] += 1
+            return
+        stats["latencies"].append(result.get("latency_ms", 0))
+        usage = result.get("usage") or {}
+        stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        stats["completion_tokens"] += usage.get("completion_tokens") or 0
+        stats["model"] = result.get("model", "")
+
+    def summary(self, bot_id: str) -> list:
+        rows = []
+        for (bid, tier), stats in sorted(self.tiers.items()):
+            if bid != bot_id:
+                continue
+            latencies = sorted(stats["latencies"])
+            ok = stats["requests"] - stats["errors"]
+
+            def pct(q):
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * q))]) if latencies else 0
+
+            rows.append({
+                "tier": tier,
+                "model": stats["model"],
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "p50_ms": pct(0.5),
+                "p95_ms": pct(0.95),
+                "avg_prompt_tokens": stats["prompt_tokens"] // ok if ok else 0,
+                "avg_completion_tokens": stats["completion_tokens"] // ok if ok else 0,
+            })
+        return rows
+
+
+tier_stats = TierStats()
+
+
+def record_llm_usage(bot_id: str, result: dict, user_id: str = "", tier: str = "", sections: dict = None):
+    """把一次 LLM 调用的 usage 和耗时写入 llm_usage"""
+    if not result.get("upstream"):
+        # 没有真正发出请求（如未配置 Key）
+        return
+    usage = result.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens") or usage.get("cached_tokens") or 0
+    sections = sections or {}
+    try:
+        conn = get_db()
+        conn.execute(
+            """INSERT INTO llm_usage (bot_id, user_id, model, tier, upstream, ok, prompt_tokens, completion_tokens,
+                   cached_tokens, latency_ms, prompt_chars, memory_chars, history_chars, knowledge_chars)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (bot_id, user_id, result.get("model", ""), tier, result.get("upstream", ""), int(bool(result.get("ok"))),
+             usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0, cached,
+             int(result.get("latency_ms", 0)), sections.get("prompt", 0), sections.get("memory", 0),
+             sections.get("history", 0), sections.get("knowledge", 0))
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"记录 LLM 用量失败: {e}")
+
+
+def usage_rollups(cur, bot_id: str, days: int = 30) -> dict:
+    """llm_usage 按天、模型、用户汇总，以及提示词各部分的平均字数和估算 token"""
+    since = f"-{int(days)} days"
+    cur.execute(
+        """SELECT COUNT(*), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0),
+                  COALESCE(SUM(cached_tokens), 0), COALESCE(AVG(latency_ms), 0), COALESCE(SUM(1 - ok), 0)
+           FROM llm_usage WHERE bot_id = ? AND created_at >= DATE('now', ?)""",
+        (bot_id, since)
+    )
+    row = cur.fetchone()
+    totals = {
+        "requests": row[0], "prompt_tokens": row[1], "completion_tokens": row[2],
+        "cached_tokens": row[3], "avg_latency_ms": round(row[4]), "errors": row[5],
+    }
+    cur.execute(
+        """SELECT DATE(created_at) AS day, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens)
+           FROM llm_usage WHERE bot_id = ? AND created_at >= DATE('now', ?)
+           GROUP BY day ORDER BY day DESC""",
+        (bot_id, since)
+    )
+    by_day = [
+        {"date": r[0], "requests": r[1], "prompt_tokens": r[2], "completion_tokens": r[3], "cached_tokens": r[4]}
+        for r in cur.fetchall()
+    ]
+    cur.execute(
+        """SELECT model, tier, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), AVG(latency_ms)
+           FROM llm_usage WHERE bot_id = ? AND created_at >= DATE('now', ?)
+           GROUP BY model, tier ORDER BY SUM(prompt_tokens + completion_tokens) DESC""",
+        (bot_id, since)
+    )
+    by_model = [
+        {"model": r[0], "tier": r[1], "requests": r[2], "prompt_tokens": r[3], "completion_tokens": r[4],
+         "avg_latency_ms": round(r[5] or 0)}
+        for r in cur.fetchall()
+    ]
+    cur.execute(
+        """SELECT u.user_id, MAX(m.user_name), COUNT(*), SUM(u.prompt_tokens), SUM(u.completion_tokens)
+           FROM llm_usage u LEFT JOIN user_memories m ON m.bot_id = u.bot_id AND m.user_id = u.user_id
+           WHERE u.bot_id = ? AND u.user_id != '' AND u.created_at >= DATE('now', ?)
+           GROUP BY u.user_id ORDER BY SUM(u.prompt_tokens + u.completion_tokens) DESC LIMIT 20""",
+        (bot_id, since)
+    )
+    by_user = [
+        {"user_id": r[0], "user_name": r[1] or r[0], "requests": r[2], "prompt_tokens": r[3], "completion_tokens": r[4]}
+        for r in cur.fetchall()
+    ]
+    # 按字数占比把输入 token 摊到提示词各部分，看看哪部分最值得精简
+    cur.execute(
+        """SELECT AVG(prompt_chars), AVG(memory_chars), AVG(history_chars), AVG(knowledge_chars), AVG(prompt_tokens)
+           FROM llm_usage WHERE bot_id = ? AND ok = 1 AND prompt_chars > 0 AND created_at >= DATE('now', ?)""",
+        (bot_id, since)
+    )
+    row = cur.fetchone()
+    prompt_chars, prompt_tokens = row[0] or 0, row[4] or 0
+    sections = []
+    for name, chars in (("记忆", row[1]), ("聊天记录", row[2]), ("知识库", row[3])):
+        chars = chars or 0
+        sections.append({
+            "section": name,
+            "avg_chars": round(chars),
+            "est_tokens": round(prompt_tokens * chars / prompt_chars) if prompt_chars else 0,
+        })
+    return {"totals": totals, "by_day": by_day, "by_model": by_model, "by_user": by_user, "sections": sections}
+
+
+async def complete_llm(prompt: str, image_urls: list = None, bot_id: str = "default", config: dict = None,
+                       flow: str = "", weight: float = 1.0) -> dict:
+    """调用LLM，使用指定BOT的配置（可传入 config 覆盖，供回放对比候选配置）
+
+    返回 {"ok", "content" 或 "error", "upstream", "model", "latency_ms", "usage", ...}。
+    flow / weight 用于 llm_scheduler 的公平排队，排队满或超时会抛出 503 / 429。
+    """
+    config = config or get_bot_config(bot_id)
+    upstreams = llm_upstreams_for(config)
     
+    if not upstreams:
+        return {"ok": False, "error": "LLM_API_KEY 未配置，请在后台设置页面配置。"}
+
     # 获取机器人人设
     bot_persona = config.get("bot_persona", "你是一个友好的中文AI助手。")
     system_prompt = bot_persona
@@ -389,23 +1363,23 @@ async def call_llm(prompt: str, image_urls: list = None, bot_id: str = "default"
     else:
         user_content = prompt
 
+    # model 由路由按上游填入
     payload = {
-        "model": app_config.get("llm_model", "gemini-2.0-flash"),
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_content},
         ],
     }
 
-    try:
-        async with httpx.AsyncClient(timeout=90) as client:
-            resp = await client.post(url, headers=headers, json=payload)
-            if resp.status_code != 200:
-                return f"LLM 调用失败: {resp.status_code} {resp.text}"
-            data = resp.json()
-            return data["choices"][0]["message"]["content"].strip()
-    except Exception as e:
-        return f"LLM 调用出错: {str(e)}"
+    async with llm_scheduler.slot(bot_id, flow or bot_id, weight):
+        return await llm_router.complete(upstreams, payload)
+
+
+async def call_llm(prompt: str, image_urls: list = None, bot_id: str = "default", config: dict = None,
+                   flow: str = "", weight: float = 1.0) -> str:
+    """调用LLM，返回回复文本；失败时返回以 "LLM 调用失败/出错" 开头的错误信息"""
+    result = await complete_llm(prompt, image_urls, bot_id, config, flow, weight)
+    return result["content"] if result["ok"] else result["error"]
 
 
 @app.get("/login", response_class=HTMLResponse)
@@ -447,6 +1421,38 @@ async def admin_page(request: Request):
     return RedirectResponse(url="/admin/knowledge", status_code=302)
 
 
+# ============ 分页 ============
+
+def page_size(limit: int) -> int:
+    """每页条数：不传时用默认值，不超过上限"""
+    return max(1, min(limit or ADMIN_PAGE_SIZE, ADMIN_PAGE_SIZE_MAX))
+
+
+def encode_cursor(*values) -> str:
+    """把最后一行的排序键编码成游标"""
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, count: int) -> list:
+    """解析游标，格式不对时返回 400"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if isinstance(values, list) and len(values) == count:
+            return values
+    except (ValueError, TypeError):
+        pass
+    raise HTTPException(status_code=400, detail="cursor 无效")
+
+
+def fetch_page(cur, sql: str, params: list, limit: int, key) -> tuple:
+    """多取一行判断是否还有下一页，返回 (本页的行, 下一页游标)，没有下一页时游标为空"""
+    cur.execute(f"{sql} LIMIT ?", list(params) + [limit + 1])
+    rows = cur.fetchall()
+    if len(rows) <= limit:
+        return rows, ""
+    return rows[:limit], encode_cursor(*key(rows[limit - 1]))
+
+
 # ============ BOT 管理 API ============
 
 @app.get("/api/bots")
@@ -486,11 +1492,13 @@ async def delete_bot(bot_id: str):
     # 删除关联数据
     cur.execute("DELETE FROM bot_configs WHERE bot_id = ?", (bot_id,))
     cur.execute("DELETE FROM knowledge WHERE bot_id = ?", (bot_id,))
+    cur.execute("DELETE FROM knowledge_tags WHERE bot_id = ?", (bot_id,))
     cur.execute("DELETE FROM user_memories WHERE bot_id = ?", (bot_id,))
     cur.execute("DELETE FROM ask_logs WHERE bot_id = ?", (bot_id,))
     cur.execute("DELETE FROM bots WHERE id = ?", (bot_id,))
     conn.commit()
     conn.close()
+    faq_index.invalidate(bot_id)
     return {"success": True}
 
 
@@ -498,18 +1506,54 @@ async def delete_bot(bot_id: str):
 async def get_bot_config_api(bot_id: str):
     """获取指定BOT的配置（供其他BOT调用）"""
     config = get_bot_config(bot_id)
+    config.pop("discord_token", None)
     return config
 
 
+@app.get("/api/host/bots")
+async def list_host_bots(request: Request):
+    """列出配置了 Discord Token 的 BOT（供多 Bot 托管进程同步）
+
+    返回的是明文 Token，必须带上与 BOT_HOST_SECRET 一致的 X-Bot-Host-Secret 请求头。
+    """
+    secret = request.headers.get("X-Bot-Host-Secret", "")
+    if not BOT_HOST_SECRET:
+        raise HTTPException(status_code=403, detail="未设置 BOT_HOST_SECRET，不提供 Bot Token")
+    if not hmac.compare_digest(secret.encode("utf-8"), BOT_HOST_SECRET.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="X-Bot-Host-Secret 无效")
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT b.id, b.name, c.discord_token FROM bots b
+           JOIN bot_configs c ON c.bot_id = b.id
+           WHERE c.discord_token != '' ORDER BY b.created_at"""
+    )
+    bots = [{"bot_id": row["id"], "name": row["name"], "token": row["discord_token"]} for row in cur.fetchall()]
+    conn.close()
+    return {"bots": bots}
+
+
 @app.get("/admin/bots", response_class=HTMLResponse)
-async def bots_page(request: Request):
-    """BOT管理页面"""
+async def bots_page(request: Request, cursor: str = "", limit: int = 0):
+    """BOT管理页面（按创建时间分页）"""
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id, name, avatar, created_at FROM bots ORDER BY created_at")
-    bots = [dict(row) for row in cur.fetchall()]
+    sql = "SELECT id, name, avatar, created_at FROM bots"
+    params = []
+    if cursor:
+        sql += " WHERE (created_at, id) > (?, ?)"
+        params += decode_cursor(cursor, 2)
+    rows, next_cursor = fetch_page(
+        cur, sql + " ORDER BY created_at, id", params, page_size(limit),
+        lambda r: (r["created_at"], r["id"])
+    )
+    bots = [dict(row) for row in rows]
+    cur.execute("SELECT COUNT(*) FROM bots")
+    total = cur.fetchone()[0]
     conn.close()
-    return templates.TemplateResponse("bots.html", {"request": request, "bots": bots})
+    return templates.TemplateResponse("bots.html", {
+        "request": request, "bots": bots, "total": total, "next_cursor": next_cursor
+    })
 
 
 @app.get("/admin/stats", response_class=HTMLResponse)
@@ -534,32 +1578,107 @@ async def memories_page(request: Request):
     return templates.TemplateResponse("memories.html", {"request": request, "bots": bots})
 
 
+# 全文搜索结果里高亮关键词的标记，转义 HTML 后再换成 <mark>
+FTS_MARK_OPEN, FTS_MARK_CLOSE = "\x02", "\x03"
+
+
+def fts_highlight_html(text: str) -> str:
+    return html.escape(text or "").replace(FTS_MARK_OPEN, "<mark>").replace(FTS_MARK_CLOSE, "</mark>")
+
+
+def memory_fts_query(q: str) -> str:
+    """把搜索词转成 FTS5 查询：按空白拆成多个词，每个词作为短语，全部都要命中
+
+    trigram 至少要 3 个字，有更短的词时返回空串，由调用方改用 LIKE。
+    """
+    terms = q.split()
+    if not terms or any(len(term) < 3 for term in terms):
+        return ""
+    return " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def search_memories(cur, bot_id: str, match: str, cursor: str, limit: int) -> dict:
+    """全文搜索用户记忆，按相关度排序，返回带高亮的片段"""
+    # CROSS JOIN 固定由全文索引驱动；普通 JOIN 时统计查询会先按 bot_id 扫表，再逐行做 MATCH
+    base = """FROM user_memories_fts CROSS JOIN user_memories m ON m.id = user_memories_fts.rowid
+              WHERE user_memories_fts MATCH ? AND m.bot_id = ?"""
+    params = [match, bot_id]
+    result = {}
+    if not cursor:
+        cur.execute(f"SELECT COUNT(*), COALESCE(AVG(LENGTH(m.memory)), 0) {base}", params)
+        total, avg_length = cur.fetchone()
+        result.update(total=total, avg_length=int(avg_length))
+    sql = f"""SELECT m.id, m.user_id, m.user_name, m.memory, m.updated_at,
+                     bm25(user_memories_fts) AS rank,
+                     snippet(user_memories_fts, 0, '{FTS_MARK_OPEN}', '{FTS_MARK_CLOSE}', '…', 24) AS snippet,
+                     highlight(user_memories_fts, 1, '{FTS_MARK_OPEN}', '{FTS_MARK_CLOSE}') AS name_hl
+              {base}"""
+    # bm25 依赖全表统计，翻页期间有记忆增删改时分数会整体漂移，拿上一页的分数做键集游标会和新分数错位；
+    # 相关度排序改用偏移量游标，数据不变时翻页结果完整不重复，数据变了也只是排名跟着变
+    offset = 0
+    if cursor:
+        offset = decode_cursor(cursor, 1)[0]
+        if type(offset) is not int or offset < 0:
+            raise HTTPException(status_code=400, detail="cursor 无效")
+    size = page_size(limit)
+    cur.execute(sql + " ORDER BY rank, m.id LIMIT ? OFFSET ?", params + [size + 1, offset])
+    rows = cur.fetchall()
+    next_cursor = encode_cursor(offset + size) if len(rows) > size else ""
+    rows = rows[:size]
+    result["memories"] = [
+        {"user_id": r["user_id"], "user_name": r["user_name"], "memory": r["memory"], "updated_at": r["updated_at"],
+         "snippet_html": fts_highlight_html(r["snippet"]), "user_name_html": fts_highlight_html(r["name_hl"])}
+        for r in rows
+    ]
+    result["next_cursor"] = next_cursor
+    return result
+
+
 @app.get("/api/memories/{bot_id}")
-async def get_memories(bot_id: str, q: str = ""):
-    """获取用户记忆列表"""
+async def get_memories(bot_id: str, q: str = "", cursor: str = "", limit: int = 0):
+    """获取用户记忆列表（按更新时间倒序分页，第一页附带统计）
+
+    搜索词都不短于 3 个字时走全文索引，按相关度排序并返回高亮片段；否则用 LIKE 匹配。
+    """
     conn = get_db()
     cur = conn.cursor()
     
-    if q:
-        cur.execute(
-            "SELECT user_id, user_name, memory, updated_at FROM user_memories WHERE bot_id = ? AND (user_id LIKE ? OR memory LIKE ?) ORDER BY updated_at DESC",
-            (bot_id, f"%{q}%", f"%{q}%")
-        )
-    else:
-        cur.execute(
-            "SELECT user_id, user_name, memory, updated_at FROM user_memories WHERE bot_id = ? ORDER BY updated_at DESC",
-            (bot_id,)
-        )
-    
-    rows = cur.fetchall()
-    memories = [{"user_id": r[0], "user_name": r[1], "memory": r[2], "updated_at": r[3]} for r in rows]
-    
-    # 统计
-    total = len(memories)
-    avg_length = sum(len(m["memory"]) for m in memories) // total if total > 0 else 0
-    
+    q = q.strip()
+    match = memory_fts_query(q) if memory_fts_enabled else ""
+    if match:
+        result = search_memories(cur, bot_id, match, cursor, limit)
+        conn.close()
+        return result
+    
+    where = "WHERE bot_id = ?"
+    params = [bot_id]
+    # 和全文搜索一样按空白拆词，每个词都要命中
+    for term in q.split():
+        where += " AND (user_id LIKE ? OR user_name LIKE ? OR memory LIKE ?)"
+        params += [f"%{term}%"] * 3
+    
+    result = {}
+    if not cursor:
+        # 统计交给 SQL，不用把所有记忆读出来
+        cur.execute(f"SELECT COUNT(*), COALESCE(AVG(LENGTH(memory)), 0) FROM user_memories {where}", params)
+        total, avg_length = cur.fetchone()
+        result.update(total=total, avg_length=int(avg_length))
+    
+    sql = f"SELECT id, user_id, user_name, memory, updated_at FROM user_memories {where}"
+    if cursor:
+        sql += " AND (updated_at, id) < (?, ?)"
+        params += decode_cursor(cursor, 2)
+    rows, next_cursor = fetch_page(
+        cur, sql + " ORDER BY updated_at DESC, id DESC", params, page_size(limit),
+        lambda r: (r["updated_at"], r["id"])
+    )
     conn.close()
-    return {"memories": memories, "total": total, "avg_length": avg_length}
+    result["memories"] = [
+        {"user_id": r["user_id"], "user_name": r["user_name"], "memory": r["memory"], "updated_at": r["updated_at"]}
+        for r in rows
+    ]
+    result["next_cursor"] = next_cursor
+    return result
 
 
 @app.get("/api/memories/{bot_id}/{user_id}")
@@ -613,55 +1732,56 @@ class SaveMemoryRequest(BaseModel):
     memory: str
 
 
+def append_memory(cur, bot_id: str, user_id: str, user_name: str, memory: str):
+    """追加一段用户记忆（不提交事务，由调用方提交）"""
+    # 先按 (bot_id, user_id) 查找
+    cur.execute("SELECT memory FROM user_memories WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
+    row = cur.fetchone()
+    
+    if not row:
+        # 兼容旧数据：按 user_id 查找（旧表可能只有 user_id 唯一约束）
+        cur.execute("SELECT memory FROM user_memories WHERE user_id = ?", (user_id,))
+        row = cur.fetchone()
+        if row:
+            # 更新旧记录，同时设置 bot_id
+            old_memory = row["memory"] if row["memory"] else ""
+            new_memory = f"{old_memory}\n{memory}".strip()[-2000:]
+            cur.execute(
+                "UPDATE user_memories SET bot_id = ?, memory = ?, user_name = COALESCE(NULLIF(?, ''), user_name), updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+                (bot_id, new_memory, user_name, user_id)
+            )
+            return
+    
+    if row:
+        # 追加到现有记忆
+        old_memory = row["memory"] if row["memory"] else ""
+        new_memory = f"{old_memory}\n{memory}".strip()[-2000:]
+        cur.execute(
+            "UPDATE user_memories SET memory = ?, user_name = COALESCE(NULLIF(?, ''), user_name), updated_at = CURRENT_TIMESTAMP WHERE bot_id = ? AND user_id = ?",
+            (new_memory, user_name, bot_id, user_id)
+        )
+    else:
+        # 新建记忆
+        try:
+            cur.execute(
+                "INSERT INTO user_memories (bot_id, user_id, user_name, memory) VALUES (?, ?, ?, ?)",
+                (bot_id, user_id, user_name or user_id, memory[:2000])
+            )
+        except sqlite3.IntegrityError:
+            # 如果INSERT失败（旧唯一约束），改为UPDATE
+            cur.execute(
+                "UPDATE user_memories SET bot_id = ?, memory = ?, user_name = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
+                (bot_id, memory[:2000], user_name or user_id, user_id)
+            )
+
+
 @app.post("/api/memories/{bot_id}/{user_id}")
 async def save_memory(bot_id: str, user_id: str, body: SaveMemoryRequest):
     """保存或追加用户记忆"""
     try:
         conn = get_db()
         cur = conn.cursor()
-        
-        # 先按 (bot_id, user_id) 查找
-        cur.execute("SELECT memory FROM user_memories WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
-        row = cur.fetchone()
-        
-        if not row:
-            # 兼容旧数据：按 user_id 查找（旧表可能只有 user_id 唯一约束）
-            cur.execute("SELECT memory FROM user_memories WHERE user_id = ?", (user_id,))
-            row = cur.fetchone()
-            if row:
-                # 更新旧记录，同时设置 bot_id
-                old_memory = row["memory"] if row["memory"] else ""
-                new_memory = f"{old_memory}\n{body.memory}".strip()[-2000:]
-                cur.execute(
-                    "UPDATE user_memories SET bot_id = ?, memory = ?, user_name = COALESCE(NULLIF(?, ''), user_name), updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
-                    (bot_id, new_memory, body.user_name, user_id)
-                )
-                conn.commit()
-                conn.close()
-                return {"success": True}
-        
-        if row:
-            # 追加到现有记忆
-            old_memory = row["memory"] if row["memory"] else ""
-            new_memory = f"{old_memory}\n{body.memory}".strip()[-2000:]
-            cur.execute(
-                "UPDATE user_memories SET memory = ?, user_name = COALESCE(NULLIF(?, ''), user_name), updated_at = CURRENT_TIMESTAMP WHERE bot_id = ? AND user_id = ?",
-                (new_memory, body.user_name, bot_id, user_id)
-            )
-        else:
-            # 新建记忆
-            try:
-                cur.execute(
-                    "INSERT INTO user_memories (bot_id, user_id, user_name, memory) VALUES (?, ?, ?, ?)",
-                    (bot_id, user_id, body.user_name or user_id, body.memory[:2000])
-                )
-            except sqlite3.IntegrityError:
-                # 如果INSERT失败（旧唯一约束），改为UPDATE
-                cur.execute(
-                    "UPDATE user_memories SET bot_id = ?, memory = ?, user_name = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
-                    (bot_id, body.memory[:2000], body.user_name or user_id, user_id)
-                )
-        
+        append_memory(cur, bot_id, user_id, body.user_name, body.memory)
         conn.commit()
         conn.close()
         return {"success": True}
@@ -670,6 +1790,40 @@ async def save_memory(bot_id: str, user_id: str, body: SaveMemoryRequest):
         raise HTTPException(status_code=500, detail=f"保存失败: {str(e)}")
 
 
+class BulkMemoryItem(BaseModel):
+    user_id: str
+    user_name: str = ""
+    memory: str
+
+
+class BulkMemoryRequest(BaseModel):
+    items: list[BulkMemoryItem] = []
+
+
+@app.post("/api/memories_bulk/{bot_id}")
+async def save_memories_bulk(bot_id: str, body: BulkMemoryRequest):
+    """批量追加用户记忆（Bot 攒批后定期提交），所有用户在一个事务里写入"""
+    # 同一用户的多条按顺序合并，每个用户只读写一次
+    merged = {}
+    for item in body.items:
+        entry = merged.setdefault(item.user_id, {"user_name": "", "lines": []})
+        entry["user_name"] = item.user_name or entry["user_name"]
+        entry["lines"].append(item.memory)
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        for user_id, entry in merged.items():
+            append_memory(cur, bot_id, user_id, entry["user_name"], "\n".join(entry["lines"]))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"批量保存记忆失败: {e}")
+        raise HTTPException(status_code=500, detail=f"保存失败: {str(e)}")
+    finally:
+        conn.close()
+    return {"success": True, "users": len(merged), "items": len(body.items)}
+
+
 class LogQuestionRequest(BaseModel):
     question: str
 
@@ -685,6 +1839,18 @@ async def log_question(bot_id: str, body: LogQuestionRequest):
     return {"success": True}
 
 
+@app.get("/api/llm_queue")
+async def get_llm_queue():
+    """LLM 排队状态：运行中/排队中的数量、拒绝和超时次数、最近的排队耗时"""
+    return llm_scheduler.stats()
+
+
+@app.get("/api/llm_upstreams")
+async def get_llm_upstreams():
+    """各 LLM 上游的健康数据：耗时分位、错误率、熔断状态"""
+    return llm_router.stats()
+
+
 @app.get("/api/stats/{bot_id}")
 async def get_stats(bot_id: str):
     """获取统计数据"""
@@ -699,6 +1865,13 @@ async def get_stats(bot_id: str):
     cur.execute("SELECT COUNT(*) FROM ask_logs WHERE bot_id = ? AND DATE(created_at) = DATE('now')", (bot_id,))
     today_questions = cur.fetchone()[0]
     
+    # 今日 FAQ 快速回答数
+    cur.execute(
+        "SELECT COUNT(*) FROM ask_logs WHERE bot_id = ? AND fast_path = 1 AND DATE(created_at) = DATE('now')",
+        (bot_id,)
+    )
+    today_fast_path = cur.fetchone()[0]
+    
     # 知识条目数
     cur.execute("SELECT COUNT(*) FROM knowledge WHERE bot_id = ?", (bot_id,))
     total_knowledge = cur.fetchone()[0]
@@ -717,25 +1890,54 @@ async def get_stats(bot_id: str):
     
     # 最近提问
     cur.execute("""
-        SELECT question, created_at FROM ask_logs WHERE bot_id = ?
+        SELECT question, created_at, fast_path FROM ask_logs WHERE bot_id = ?
         ORDER BY id DESC LIMIT 20
     """, (bot_id,))
-    recent_questions = [{"question": row[0][:100], "time": row[1]} for row in cur.fetchall()]
+    recent_questions = [{"question": row[0][:100], "time": row[1], "fast_path": bool(row[2])} for row in cur.fetchall()]
+    
+    # LLM 用量（最近30天）
+    usage = usage_rollups(cur, bot_id)
     
     conn.close()
     
     return {
         "total_questions": total_questions,
         "today_questions": today_questions,
+        "today_fast_path": today_fast_path,
         "total_knowledge": total_knowledge,
         "total_users": total_users,
         "daily_stats": daily_stats,
-        "recent_questions": recent_questions
+        "recent_questions": recent_questions,
+        "tiers": tier_stats.summary(bot_id),
+        "usage": usage,
     }
 
 
+@app.get("/api/usage")
+async def get_usage(days: int = 30):
+    """各 BOT 的 LLM 用量汇总"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT u.bot_id, MAX(b.name), COUNT(*), SUM(u.prompt_tokens), SUM(u.completion_tokens),
+                  SUM(u.cached_tokens), AVG(u.latency_ms)
+           FROM llm_usage u LEFT JOIN bots b ON b.id = u.bot_id
+           WHERE u.created_at >= DATE('now', ?)
+           GROUP BY u.bot_id ORDER BY SUM(u.prompt_tokens + u.completion_tokens) DESC""",
+        (f"-{int(days)} days",)
+    )
+    by_bot = [
+        {"bot_id": r[0], "name": r[1] or r[0], "requests": r[2], "prompt_tokens": r[3],
+         "completion_tokens": r[4], "cached_tokens": r[5], "avg_latency_ms": round(r[6] or 0)}
+        for r in cur.fetchall()
+    ]
+    conn.close()
+    return {"days": days, "by_bot": by_bot}
+
+
 @app.get("/admin/knowledge", response_class=HTMLResponse)
-async def list_knowledge(request: Request, q: str = "", bot_id: str = "default"):
+async def list_knowledge(request: Request, q: str = "", tag: str = "", bot_id: str = "default",
+                         cursor: str = "", limit: int = 0):
     conn = get_db()
     cur = conn.cursor()
     
@@ -743,71 +1945,253 @@ async def list_knowledge(request: Request, q: str = "", bot_id: str = "default")
     cur.execute("SELECT id, name FROM bots ORDER BY created_at")
     bots = [dict(row) for row in cur.fetchall()]
     
+    # 标签按精确值筛选（走 knowledge_tags 索引），关键词搜索标题和内容，两者可以叠加
+    tag = tag.strip().lower()
+    sql = " FROM knowledge k"
+    params = []
+    if tag:
+        sql += " JOIN knowledge_tags kt ON kt.knowledge_id = k.id AND kt.bot_id = ? AND kt.tag = ?"
+        params += [bot_id, tag]
+    sql += " WHERE k.bot_id = ?"
+    params.append(bot_id)
     if q:
         search_term = f"%{q}%"
-        cur.execute(
-            "SELECT id, title, content, tags FROM knowledge WHERE bot_id = ? AND (title LIKE ? OR content LIKE ? OR tags LIKE ?) ORDER BY id DESC",
-            (bot_id, search_term, search_term, search_term)
-        )
-    else:
-        cur.execute("SELECT id, title, content, tags FROM knowledge WHERE bot_id = ? ORDER BY id DESC", (bot_id,))
-        
-    rows = cur.fetchall()
+        sql += " AND (k.title LIKE ? OR k.content LIKE ?)"
+        params += [search_term, search_term]
+    
+    # 标题显示的是当前筛选条件下的总数，翻到后面的页也要统计
+    cur.execute("SELECT COUNT(*)" + sql, params)
+    total = cur.fetchone()[0]
+    if cursor:
+        sql += " AND k.id < ?"
+        params += decode_cursor(cursor, 1)
+    page, next_cursor = fetch_page(
+        cur, "SELECT k.id, k.title, k.content, k.tags" + sql + " ORDER BY k.id DESC", params,
+        page_size(limit), lambda r: (r["id"],)
+    )
+    rows = [dict(row, tag_list=split_tags(row["tags"])) for row in page]
+    
+    # 标签列表（按使用次数）
+    cur.execute(
+        "SELECT tag, COUNT(*) AS count FROM knowledge_tags WHERE bot_id = ? GROUP BY tag ORDER BY count DESC, tag LIMIT 50",
+        (bot_id,)
+    )
+    all_tags = [dict(row) for row in cur.fetchall()]
     conn.close()
     return templates.TemplateResponse("knowledge_list.html", {
-        "request": request, "items": rows, "q": q, 
-        "bots": bots, "current_bot": bot_id
+        "request": request, "items": rows, "q": q, "tag": tag, "all_tags": all_tags,
+        "total": total, "next_cursor": next_cursor, "bots": bots, "current_bot": bot_id
     })
 
 
+def iter_knowledge_export(bot_id: str, fmt: str):
+    """按 id 分批读取某个 BOT 的知识并逐块输出（NDJSON 或 JSON 数组）
+
+    StreamingResponse 会在线程池里调用同步生成器，前后两次可能落在不同线程上，
+    所以每批单独开关一次连接，不跨批持有连接和读事务。
+    """
+    last_id = 0
+    first = True
+    if fmt == "json":
+        yield "[\n"
+    while True:
+        conn = get_db()
+        try:
+            rows = conn.execute(
+                "SELECT id, title, content, tags FROM knowledge WHERE bot_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (bot_id, last_id, KNOWLEDGE_EXPORT_BATCH)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        lines = [
+            json.dumps({"title": row["title"], "content": row["content"], "tags": row["tags"] or ""}, ensure_ascii=False)
+            for row in rows
+        ]
+        if fmt == "json":
+            yield ("" if first else ",\n") + ",\n".join(lines)
+        else:
+            yield "\n".join(lines) + "\n"
+        first = False
+        if len(rows) < KNOWLEDGE_EXPORT_BATCH:
+            break
+    if fmt == "json":
+        yield "\n]\n"
+
+
 @app.get("/admin/knowledge/export")
-async def export_knowledge():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT title, content, tags FROM knowledge")
-    # 将 sqlite3.Row 转换为字典列表
-    rows = [dict(row) for row in cur.fetchall()]
-    conn.close()
-    
-    # 返回 JSON 文件下载
-    return JSONResponse(
-        content=rows,
-        headers={"Content-Disposition": "attachment; filename=knowledge_backup.json"}
+async def export_knowledge(bot_id: str = "default", format: str = "ndjson"):
+    if format not in ("ndjson", "json"):
+        raise HTTPException(status_code=400, detail="format 只支持 ndjson 或 json")
+    filename = f"knowledge_{re.sub(r'[^A-Za-z0-9_.-]', '_', bot_id)}.{format}"
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+    # 逐批输出，不把整个知识库读进内存
+    return StreamingResponse(
+        iter_knowledge_export(bot_id, format),
+        media_type=f"{media_type}; charset=utf-8",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 
-@app.post("/admin/knowledge/import")
-async def import_knowledge(file: UploadFile = File(...)):
+def iter_json_items(f, chunk_size: int = 1 << 20, max_item_size: int = 10 << 20):
+    """增量解析 JSON 数组或 NDJSON（每行一个对象），逐个产出元素，不把整个文件读进内存"""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    started = False
+    while True:
+        # 跳过空白和元素之间的逗号
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                return
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+            continue
+        if not started:
+            started = True
+            if buf[pos] == "[":
+                pos += 1
+                continue
+        if buf[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            # 当前元素还没读完整：再读一块接着解析
+            if eof:
+                raise ValueError(f"JSON 格式错误: {e.msg}")
+            if len(buf) - pos > max_item_size:
+                raise ValueError(f"单条数据超过 {max_item_size >> 20}MB")
+            more = f.read(chunk_size)
+            eof = not more
+            buf, pos = buf[pos:] + more, 0
+            continue
+        yield item
+        pos = end
+
+
+# 知识库导入任务：job_id -> 进度，只保留最近的若干个
+knowledge_import_jobs = OrderedDict()
+KNOWLEDGE_IMPORT_JOBS_KEEP = 20
+
+
+def import_knowledge_batch(bot_id: str, items: list, seen: set) -> tuple:
+    """插入一批知识（一个短事务），按内容哈希跳过重复，返回 (插入条数, 重复条数)"""
+    rows = []
+    for title, content, tags in items:
+        content_hash = knowledge_hash(title, content)
+        if content_hash in seen:
+            continue
+        seen.add(content_hash)
+        rows.append((bot_id, title, content, tags, content_hash))
+    if not rows:
+        return 0, len(items)
+    conn = get_db()
     try:
-        content = await file.read()
-        data = json.loads(content)
-        
-        if not isinstance(data, list):
-            raise ValueError("JSON 格式错误，必须是列表")
-            
-        conn = get_db()
-        cur = conn.cursor()
-        count = 0
-        for item in data:
-            # 简单的重复检查：如果标题完全一样，就跳过？或者直接追加？这里选择直接追加
-            if item.get("title") and item.get("content"):
+        with conn:
+            cur = conn.cursor()
+            placeholders = ",".join("?" * len(rows))
+            cur.execute(
+                f"SELECT content_hash FROM knowledge WHERE bot_id = ? AND content_hash IN ({placeholders})",
+                [bot_id] + [row[4] for row in rows]
+            )
+            existing = {row[0] for row in cur.fetchall()}
+            rows = [row for row in rows if row[4] not in existing]
+            cur.executemany(
+                "INSERT INTO knowledge (bot_id, title, content, tags, content_hash) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            # 带标签的行查回 id，写入标签索引
+            tagged = {row[4]: row[3] for row in rows if row[3]}
+            if tagged:
+                placeholders = ",".join("?" * len(tagged))
                 cur.execute(
-                    "INSERT INTO knowledge (title, content, tags) VALUES (?, ?, ?)",
-                    (item.get("title"), item.get("content"), item.get("tags", ""))
+                    f"SELECT id, content_hash FROM knowledge WHERE bot_id = ? AND content_hash IN ({placeholders})",
+                    [bot_id] + list(tagged)
                 )
-                count += 1
-        conn.commit()
+                for knowledge_id, content_hash in cur.fetchall():
+                    sync_knowledge_tags(cur, knowledge_id, bot_id, tagged[content_hash])
+    finally:
         conn.close()
-        
-        return RedirectResponse(
-            url=f"/admin/knowledge?message=成功导入 {count} 条数据&message_type=success",
-            status_code=302
-        )
+    return len(rows), len(items) - len(rows)
+
+
+def run_knowledge_import(job: dict, path: str):
+    """在线程里执行导入：边解析边按批插入，每批提交一次，期间更新 job 里的进度"""
+    bot_id = job["bot_id"]
+    started = time.perf_counter()
+    seen = set()
+    batch = []
+
+    def flush():
+        inserted, skipped = import_knowledge_batch(bot_id, batch, seen)
+        job["inserted"] += inserted
+        job["skipped"] += skipped
+        batch.clear()
+
+    try:
+        with open(path, "rb") as raw:
+            for item in iter_json_items(TextIOWrapper(raw, encoding="utf-8-sig")):
+                job["read"] += 1
+                if not isinstance(item, dict) or not item.get("title") or not item.get("content"):
+                    job["invalid"] += 1
+                    continue
+                tags = item.get("tags") or ""
+                if isinstance(tags, list):
+                    tags = ", ".join(str(tag) for tag in tags)
+                batch.append((str(item["title"]), str(item["content"]), str(tags)))
+                if len(batch) >= KNOWLEDGE_IMPORT_BATCH:
+                    flush()
+                    job["bytes"] = raw.tell()
+            if batch:
+                flush()
+            job["bytes"] = job["total_bytes"]
+        job["status"] = "done"
+        job["message"] = f"成功导入 {job['inserted']} 条，跳过重复 {job['skipped']} 条"
+        if job["invalid"]:
+            job["message"] += f"，缺少标题或内容 {job['invalid']} 条"
     except Exception as e:
-        return RedirectResponse(
-            url=f"/admin/knowledge?message=导入失败: {str(e)}&message_type=error",
-            status_code=302
-        )
+        job["status"] = "error"
+        job["message"] = f"导入失败: {e}（已导入 {job['inserted']} 条）"
+    finally:
+        os.remove(path)
+        faq_index.invalidate(bot_id)
+    print(
+        f"📥 [知识库] {bot_id} 导入{'完成' if job['status'] == 'done' else '失败'}："
+        f"读取 {job['read']} 条，插入 {job['inserted']} 条，重复 {job['skipped']} 条，"
+        f"耗时 {time.perf_counter() - started:.1f}s"
+    )
+
+
+@app.post("/admin/knowledge/import")
+async def import_knowledge(file: UploadFile = File(...), bot_id: str = Form("default")):
+    # 上传内容先转存到自己的临时文件（请求结束后 UploadFile 会被关闭），再在后台线程里分批导入
+    fd, path = tempfile.mkstemp(prefix="knowledge_import_", suffix=".json")
+    with os.fdopen(fd, "wb") as out:
+        await asyncio.to_thread(shutil.copyfileobj, file.file, out, 1 << 20)
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        "job_id": job_id, "bot_id": bot_id, "filename": file.filename or "",
+        "status": "running", "message": "",
+        "read": 0, "inserted": 0, "skipped": 0, "invalid": 0,
+        "bytes": 0, "total_bytes": os.path.getsize(path),
+    }
+    knowledge_import_jobs[job_id] = job
+    while len(knowledge_import_jobs) > KNOWLEDGE_IMPORT_JOBS_KEEP:
+        knowledge_import_jobs.popitem(last=False)
+    asyncio.create_task(asyncio.to_thread(run_knowledge_import, job, path))
+    return {"job_id": job_id}
+
+
+@app.get("/admin/knowledge/import/{job_id}")
+async def get_import_job(job_id: str):
+    job = knowledge_import_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="导入任务不存在")
+    return job
 
 
 class GenerateRequest(BaseModel):
@@ -826,7 +2210,10 @@ async def generate_content(req: GenerateRequest):
 2. 格式可以是纯文本或简单的Markdown。
 3. 不要包含"好的，这是生成的内容"之类的废话，直接给干货。
 """
-    content = await call_llm(prompt)
+    try:
+        content = await call_llm(prompt, flow="admin")
+    except HTTPException:
+        return {"error": "AI 正忙，请稍后再试"}
     return {"content": content}
 
 
@@ -885,10 +2272,38 @@ async def save_settings(
     llm_model: str = Form(""),
     bot_persona: str = Form(""),
     context_limit: int = Form(100),
+    discord_token: str = Form(""),
+    llm_upstreams: str = Form(""),
+    llm_tiers: str = Form(""),
+    faq_enabled: str = Form(""),
+    faq_threshold: float = Form(0.9),
+    faq_templates: str = Form(""),
+    knowledge_tag_mode: str = Form("off"),
     admin_password: str = Form(""),
 ):
     global app_config
     
+    # 备用上游必须是 JSON 数组
+    llm_upstreams = llm_upstreams.strip()
+    if llm_upstreams:
+        try:
+            parsed = json.loads(llm_upstreams)
+            if not isinstance(parsed, list) or not all(isinstance(u, dict) and u.get("base_url") for u in parsed):
+                raise ValueError
+        except ValueError:
+            return RedirectResponse(
+                url=f"/admin/settings?bot_id={bot_id}&message=备用上游格式错误，需要是包含 base_url 的 JSON 数组&message_type=error",
+                status_code=302
+            )
+    llm_tiers = llm_tiers.strip()
+    if llm_tiers:
+        error = validate_llm_tiers(llm_tiers)
+        if error:
+            return RedirectResponse(
+                url=f"/admin/settings?bot_id={bot_id}&message=模型分级规则错误：{error}&message_type=error",
+                status_code=302
+            )
+    
     # 保存BOT专属配置
     bot_config = {
         "llm_base_url": llm_base_url.strip(),
@@ -896,6 +2311,13 @@ async def save_settings(
         "llm_model": llm_model.strip(),
         "bot_persona": bot_persona.strip(),
         "context_limit": context_limit,
+        "discord_token": discord_token.strip(),
+        "llm_upstreams": llm_upstreams,
+        "llm_tiers": llm_tiers,
+        "faq_enabled": 1 if faq_enabled else 0,
+        "faq_threshold": min(1.0, max(0.5, faq_threshold)),
+        "faq_templates": faq_templates.strip(),
+        "knowledge_tag_mode": knowledge_tag_mode if knowledge_tag_mode in KNOWLEDGE_TAG_MODES else "off",
     }
     save_bot_config(bot_id, bot_config)
     
@@ -915,9 +2337,14 @@ async def save_settings(
 async def create_knowledge(title: str = Form(...), content: str = Form(...), tags: str = Form(""), bot_id: str = Form("default")):
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("INSERT INTO knowledge (bot_id, title, content, tags) VALUES (?, ?, ?, ?)", (bot_id, title, content, tags))
+    cur.execute(
+        "INSERT INTO knowledge (bot_id, title, content, tags, content_hash) VALUES (?, ?, ?, ?, ?)",
+        (bot_id, title, content, tags, knowledge_hash(title, content))
+    )
+    sync_knowledge_tags(cur, cur.lastrowid, bot_id, tags)
     conn.commit()
     conn.close()
+    faq_index.invalidate(bot_id)
     return RedirectResponse(url=f"/admin/knowledge?bot_id={bot_id}", status_code=302)
 
 
@@ -937,9 +2364,17 @@ async def edit_knowledge_page(request: Request, item_id: int):
 async def update_knowledge(item_id: int, title: str = Form(...), content: str = Form(...), tags: str = Form(""), bot_id: str = Form("default")):
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("UPDATE knowledge SET title = ?, content = ?, tags = ? WHERE id = ?", (title, content, tags, item_id))
+    cur.execute(
+        "UPDATE knowledge SET title = ?, content = ?, tags = ?, content_hash = ? WHERE id = ?",
+        (title, content, tags, knowledge_hash(title, content), item_id)
+    )
+    cur.execute("SELECT bot_id FROM knowledge WHERE id = ?", (item_id,))
+    row = cur.fetchone()
+    if row:
+        sync_knowledge_tags(cur, item_id, row["bot_id"] or "default", tags)
     conn.commit()
     conn.close()
+    faq_index.invalidate()
     return RedirectResponse(url=f"/admin/knowledge?bot_id={bot_id}", status_code=302)
 
 
@@ -948,42 +2383,234 @@ async def delete_knowledge(item_id: int, bot_id: str = Form("default")):
     conn = get_db()
     cur = conn.cursor()
     cur.execute("DELETE FROM knowledge WHERE id = ?", (item_id,))
+    cur.execute("DELETE FROM knowledge_tags WHERE knowledge_id = ?", (item_id,))
     conn.commit()
     conn.close()
+    faq_index.invalidate()
     return RedirectResponse(url=f"/admin/knowledge?bot_id={bot_id}", status_code=302)
 
 
-@app.post("/api/ask")
-async def api_ask(body: AskRequest):
-    question = body.question.strip()
-    if not question:
-        raise HTTPException(status_code=400, detail="问题不能为空")
+# 同一时间只跑一个摘要任务，避免和正常问答抢上游额度
+_summary_semaphore = asyncio.Semaphore(1)
 
-    conn = get_db()
-    cur = conn.cursor()
-    
-    bot_id = body.bot_id or "default"
-    
-    # 记录调用日志
-    cur.execute("INSERT INTO ask_logs (bot_id, question) VALUES (?, ?)", (bot_id, question[:100]))
-    conn.commit()
-    
-    # 获取用户记忆
-    user_memory = ""
-    if body.user_id:
-        cur.execute("SELECT memory FROM user_memories WHERE bot_id = ? AND user_id = ?", (bot_id, body.user_id))
-        row = cur.fetchone()
-        if row and row["memory"]:
-            user_memory = row["memory"]
-    
+
+def schedule_channel_summary(bot_id: str, ctx: dict, context_limit: int = 0):
+    """未折叠的记录攒够一批，或者超出了提示词的 context_limit 窗口时，在后台把较早的部分折叠进摘要"""
+    pending = ConversationContextStore.unsummarized(ctx)
+    if ctx["summarizing"]:
+        return
+    keep = CONTEXT_RAW_KEEP
+    if context_limit > 0 and len(pending) > context_limit:
+        # 窗口外的原文不会进提示词，不能直接丢掉：折叠进摘要，原文保留半个窗口
+        keep = min(keep, context_limit // 2)
+    elif len(pending) < CONTEXT_RAW_KEEP + CONTEXT_SUMMARY_BATCH:
+        return
+    fold = pending[:-keep] if keep > 0 else pending
+    ctx["summarizing"] = True
+    asyncio.create_task(summarize_channel_context(bot_id, ctx, fold, ctx["epoch"]))
+
+
+async def summarize_channel_context(bot_id: str, ctx: dict, fold: list, epoch: int):
+    """把一批聊天记录和已有摘要合并成新的摘要"""
+    try:
+        async with _summary_semaphore:
+            history_text = "\n".join(line for _, line in fold)
+            prompt = (
+                "请把下面的【已有摘要】和【新的聊天记录】合并成一段新的摘要，"
+                f"保留参与者、主要话题、约定和没解决的问题，不超过{CONTEXT_SUMMARY_MAX_CHARS // 2}字，直接输出摘要：\n\n"
+                f"【已有摘要】\n{ctx['summary'] or '(无)'}\n\n【新的聊天记录】\n{history_text}"
+            )
+            config = dict(get_bot_config(bot_id), bot_persona="你是负责整理群聊记录的助手，只输出客观摘要。")
+            result = await complete_llm(
+                prompt, None, bot_id, config=config,
+                flow=f"{bot_id}:summary", weight=LLM_SUMMARY_WEIGHT,
+            )
+            record_llm_usage(bot_id, result, tier="summary")
+            summary = result["content"] if result["ok"] else result["error"]
+        if summary.startswith(("LLM 调用失败", "LLM 调用出错", "LLM_API_KEY 未配置")):
+            print(f"[频道摘要失败] {summary[:200]}")
+            return
+        if ctx["epoch"] != epoch:
+            # 期间收到了完整重发，这批记录已经不在当前历史里
+            return
+        ctx["summary"] = summary[:CONTEXT_SUMMARY_MAX_CHARS]
+        ctx["summary_upto"] = max(ctx["summary_upto"], fold[-1][0])
+        print(f"📝 [频道摘要已更新] bot={bot_id} 折叠 {len(fold)} 条")
+    except Exception as e:
+        print(f"[频道摘要失败] {e}")
+    finally:
+        ctx["summarizing"] = False
+
+
+# 频道标签的使用方式：off 不使用；boost 带频道标签的知识排在前面；restrict 只检索带频道标签的知识
+KNOWLEDGE_TAG_MODES = ("off", "boost", "restrict")
+
+
+# 中日韩文字（汉字、假名、谚文），这些文字的频道名通常不用分隔符断词
+CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uac00-\ud7af]+")
+
+
+def name_tokens(text: str) -> list:
+    """把频道名或标签按空格、连字符、下划线、"/" 和 emoji 等符号切成小写词"""
+    return [t for t in re.split(r"[\W_]+", (text or "").lower()) if t]
+
+
+def tag_in_tokens(tag: str, tokens: list) -> bool:
+    """标签的词序列在频道名里连续出现才算命中，不做子串匹配（"ai" 不会命中 "main"）
+
+    中日韩文没有分词符，"原神攻略" 是一个词，所以两个字以上的纯中日韩文标签允许在词内部匹配。
+    """
+    parts = name_tokens(tag)
+    if not parts:
+        return False
+    if len(parts) == 1 and len(parts[0]) >= 2 and CJK_RE.fullmatch(parts[0]):
+        return any(parts[0] in token for token in tokens)
+    n = len(parts)
+    return any(tokens[i:i + n] == parts for i in range(len(tokens) - n + 1))
+
+
+def infer_channel_tags(cur, bot_id: str, channel_name: str) -> list:
+    """从频道名推断知识标签：该 BOT 已有的标签作为完整的词出现在频道名里即算命中"""
+    tokens = name_tokens(channel_name)
+    if not tokens:
+        return []
+    cur.execute("SELECT DISTINCT tag FROM knowledge_tags WHERE bot_id = ?", (bot_id,))
+    return [row[0] for row in cur.fetchall() if tag_in_tokens(row[0], tokens)]
+
+
+def retrieve_knowledge(cur, bot_id: str, question: str, tags: list = None, tag_mode: str = "off") -> list:
+    """检索知识库，返回命中的条目（最多5条）
+
+    传入频道标签时按 tag_mode 加权或限定范围，没有标签时和普通检索一样。
+    """
     pattern = f"%{question[:20]}%"  # 简单 LIKE 匹配
+    if not tags or tag_mode not in ("boost", "restrict"):
+        cur.execute(
+            "SELECT title, content, tags FROM knowledge WHERE bot_id = ? AND (title LIKE ? OR content LIKE ?) ORDER BY id DESC LIMIT 5",
+            (bot_id, pattern, pattern),
+        )
+        return cur.fetchall()
+    marks = ", ".join("?" * len(tags))
+    tagged = f"k.id IN (SELECT knowledge_id FROM knowledge_tags WHERE bot_id = ? AND tag IN ({marks}))"
+    if tag_mode == "restrict":
+        where, order = f" AND {tagged}", "k.id DESC"
+    else:
+        where, order = "", f"({tagged}) DESC, k.id DESC"
     cur.execute(
-        "SELECT title, content, tags FROM knowledge WHERE bot_id = ? AND (title LIKE ? OR content LIKE ?) ORDER BY id DESC LIMIT 5",
-        (bot_id, pattern, pattern),
+        f"""SELECT k.title, k.content, k.tags FROM knowledge k
+            WHERE k.bot_id = ? AND (k.title LIKE ? OR k.content LIKE ?){where}
+            ORDER BY {order} LIMIT 5""",
+        [bot_id, pattern, pattern, bot_id] + list(tags),
     )
-    rows = cur.fetchall()
-    conn.close()
+    return cur.fetchall()
+
+
+def normalize_faq_text(text: str) -> str:
+    """FAQ 匹配前的归一化：转小写，去掉空白、标点和符号"""
+    return "".join(
+        ch for ch in unicodedata.normalize("NFKC", text).lower()
+        if unicodedata.category(ch)[0] not in "PSZC"
+    )
+
 
+class FaqIndex:
+    """按 BOT 缓存的知识库标题索引，用于 FAQ 快速回答
+
+    标题归一化后完全相同的直接命中；否则用 SequenceMatcher 计算相似度。
+    相似度达到阈值 t 时，标题至少要包含问题里 t*len/(2-t) 个字，所以只需查看
+    含有问题中最少见的那几个字的标题（字 → 标题的倒排表），再用 quick_ratio 剪枝，
+    没命中的问题也不用扫描整个知识库。
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # bot_id -> {"loaded_at": 时间, "exact": {归一化标题: 条目}, "entries": [(归一化标题, 条目)],
+        #            "postings": {字: [entries 下标]}}
+        self.indexes = {}
+
+    def invalidate(self, bot_id: str = None):
+        if bot_id is None:
+            self.indexes.clear()
+        else:
+            self.indexes.pop(bot_id, None)
+
+    def _load(self, cur, bot_id: str) -> dict:
+        index = self.indexes.get(bot_id)
+        if index and time.monotonic() - index["loaded_at"] < self.ttl:
+            return index
+        cur.execute("SELECT id, title, content FROM knowledge WHERE bot_id = ? ORDER BY id DESC", (bot_id,))
+        exact = {}
+        entries = []
+        postings = {}
+        for row in cur.fetchall():
+            key = normalize_faq_text(row["title"])
+            if not key or not row["content"]:
+                continue
+            entry = {"id": row["id"], "title": row["title"], "content": row["content"]}
+            # 标题重复时保留最新的一条
+            if key not in exact:
+                exact[key] = entry
+                for ch in set(key):
+                    postings.setdefault(ch, []).append(len(entries))
+                entries.append((key, entry))
+        index = {"loaded_at": time.monotonic(), "exact": exact, "entries": entries, "postings": postings}
+        self.indexes[bot_id] = index
+        return index
+
+    def match(self, cur, bot_id: str, question: str, threshold: float):
+        """返回 (最高分, 条目)，没有达到阈值的返回 (0, None)"""
+        key = normalize_faq_text(question)
+        if not key:
+            return 0.0, None
+        index = self._load(cur, bot_id)
+        entry = index["exact"].get(key)
+        if entry:
+            return 1.0, entry
+        if threshold <= 0:
+            return 0.0, None
+        postings = index["postings"]
+        # 按出现次数从少到多排列问题里的每个字，标题必须包含前 prefix 个字中的至少一个
+        min_shared = int(-(-(threshold * len(key) / (2 - threshold) - 1e-9) // 1))
+        prefix = len(key) - min_shared + 1
+        chars = sorted(key, key=lambda ch: len(postings.get(ch, ())))[:prefix]
+        candidates = set()
+        for ch in set(chars):
+            candidates.update(postings.get(ch, ()))
+        matcher = SequenceMatcher(autojunk=False)
+        matcher.set_seq2(key)
+        best_score, best_entry = 0.0, None
+        floor = threshold
+        for i in sorted(candidates):
+            title_key, entry = index["entries"][i]
+            # ratio 不会超过 2*min(长度)/长度之和
+            if 2 * min(len(key), len(title_key)) / (len(key) + len(title_key)) < floor:
+                continue
+            matcher.set_seq1(title_key)
+            if matcher.quick_ratio() < floor:
+                continue
+            score = matcher.ratio()
+            if score >= floor:
+                best_score, best_entry = score, entry
+                floor = score
+        return best_score, best_entry
+
+
+faq_index = FaqIndex(FAQ_INDEX_TTL)
+
+
+def render_faq_answer(config: dict, entry: dict, user_label: str) -> str:
+    """从人设模板里随机挑一行包装知识库内容，没配置模板时直接返回原文"""
+    templates_lines = [line.strip() for line in (config.get("faq_templates") or "").splitlines() if line.strip()]
+    if not templates_lines:
+        return entry["content"]
+    line = random.choice(templates_lines)
+    if "{answer}" not in line:
+        line = line + "\n{answer}"
+    return line.replace("{user}", user_label).replace("{title}", entry["title"]).replace("{answer}", entry["content"])
+
+
+def build_ask_prompt(question: str, user_label: str, user_memory: str, chat_history: list, rows: list, emojis_info: str = "", channel_summary: str = "") -> str:
+    """拼装 /api/ask 的用户提示词"""
     knowledge_texts = []
     for r in rows:
         k = f"标题: {r['title']}\n标签: {r['tags']}\n内容: {r['content']}"
@@ -995,13 +2622,16 @@ async def api_ask(body: AskRequest):
     prompt_parts = []
     
     # 用户记忆
-    user_label = body.user_name if body.user_name else "用户"
     if user_memory:
         prompt_parts.append(f"【关于 {user_label} 的记忆】\n{user_memory}")
     
+    # 更早聊天记录的摘要
+    if channel_summary:
+        prompt_parts.append(f"【更早的聊天摘要】\n{channel_summary}")
+    
     # 添加聊天历史上下文
-    if body.chat_history:
-        history_text = "\n".join(body.chat_history)  # 不限制条数
+    if chat_history:
+        history_text = "\n".join(chat_history)  # 不限制条数
         prompt_parts.append(f"【频道最近的聊天记录】\n{history_text}")
     
     # 当前用户的问题
@@ -1020,13 +2650,117 @@ async def api_ask(body: AskRequest):
     prompt = "\n\n".join(prompt_parts)
     
     # 添加表情包信息
-    if body.emojis_info:
-        prompt += f"\n\n{body.emojis_info}\n你可以在回复中适当使用这些表情来让回答更生动，直接复制表情代码即可。"
+    if emojis_info:
+        prompt += f"\n\n{emojis_info}\n你可以在回复中适当使用这些表情来让回答更生动，直接复制表情代码即可。"
+    return prompt
+
+
+def prepare_ask(cur, bot_id: str, bot_config: dict, question: str, *, user_label: str = "用户",
+                user_memory: str = "", chat_history: list = None, channel_name: str = "",
+                image_urls: list = None, emojis_info: str = "", channel_summary: str = "",
+                faq: "FaqIndex" = None) -> dict:
+    """/api/ask 调用 LLM 之前的部分：FAQ 快速回答、按频道标签检索、拼提示词、选模型档位
+
+    replay.py 回放历史提问也走这里，和线上保持同一套流程。
+    命中 FAQ 时 faq 为条目（带 score）；否则返回 rows / prompt / features / tier / config。
+    """
+    chat_history = chat_history or []
+    faq = faq or faq_index
+    if bot_config.get("faq_enabled") and not image_urls:
+        score, entry = faq.match(cur, bot_id, question, bot_config.get("faq_threshold", 0.9))
+        if entry:
+            return {"faq": entry, "score": score}
+
+    # 按频道推断标签，给检索加权或限定范围
+    tag_mode = bot_config.get("knowledge_tag_mode", "off")
+    channel_tags = infer_channel_tags(cur, bot_id, channel_name) if tag_mode != "off" else []
+    rows = retrieve_knowledge(cur, bot_id, question, channel_tags, tag_mode)
+    prompt = build_ask_prompt(question, user_label, user_memory, chat_history, rows, emojis_info, channel_summary)
+
+    # 按请求特征选择模型档位
+    features = prompt_features(question, prompt, chat_history, rows, image_urls, user_memory)
+    tier, config = select_llm_tier(bot_config, features)
+    return {"faq": None, "rows": rows, "prompt": prompt, "features": features, "tier": tier, "config": config}
+
 
+@app.post("/api/ask")
+async def api_ask(body: AskRequest):
+    question = body.question.strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="问题不能为空")
+
+    bot_id = body.bot_id or "default"
+
+    # 合并会话上下文缓存
+    chat_history = body.chat_history
+    channel_summary = ""
+    if body.channel_id and body.context_cursor:
+        ctx = context_store.apply(bot_id, body.channel_id, body.context_base, body.context_cursor, body.chat_history)
+        if ctx is None:
+            raise HTTPException(status_code=409, detail="context_cursor_mismatch")
+        if CONTEXT_SUMMARY_ENABLED:
+            channel_summary = ctx["summary"]
+            chat_history = [line for _, line in context_store.unsummarized(ctx)]
+            schedule_channel_summary(bot_id, ctx, body.context_limit)
+        else:
+            chat_history = [line for _, line in ctx["lines"]]
+        if body.context_limit > 0:
+            chat_history = chat_history[-body.context_limit:]
+
+    conn = get_db()
+    cur = conn.cursor()
+    user_label = body.user_name if body.user_name else "用户"
+    bot_config = get_bot_config(bot_id)
+    
+    # 获取用户记忆
+    user_memory = ""
+    if body.user_id:
+        cur.execute("SELECT memory FROM user_memories WHERE bot_id = ? AND user_id = ?", (bot_id, body.user_id))
+        row = cur.fetchone()
+        if row and row["memory"]:
+            user_memory = row["memory"]
+    
     # 获取图片URL列表
     image_urls = body.image_urls if body.image_urls else None
     
-    answer = await call_llm(prompt, image_urls, bot_id)
+    started = time.perf_counter()
+    prepared = prepare_ask(
+        cur, bot_id, bot_config, question,
+        user_label=user_label, user_memory=user_memory, chat_history=chat_history,
+        channel_name=body.channel_name, image_urls=image_urls,
+        emojis_info=body.emojis_info, channel_summary=channel_summary,
+    )
+    
+    # 记录调用日志
+    entry = prepared["faq"]
+    cur.execute(
+        "INSERT INTO ask_logs (bot_id, question, fast_path) VALUES (?, ?, ?)",
+        (bot_id, question[:100], 1 if entry else 0)
+    )
+    conn.commit()
+    conn.close()
+    
+    # FAQ 快速回答：问题和知识库标题几乎一致时直接返回内容，不调用 LLM
+    if entry:
+        print(
+            f"⚡ [FAQ 快速回答] bot={bot_id} 相似度={prepared['score']:.2f} 标题={entry['title'][:30]} "
+            f"耗时={(time.perf_counter() - started) * 1000:.1f}ms"
+        )
+        return {"answer": render_faq_answer(bot_config, entry, user_label), "fast_path": True}
+    
+    prompt, rows, tier, config = prepared["prompt"], prepared["rows"], prepared["tier"], prepared["config"]
+    
+    # 按用户排队（没有用户 ID 时按频道），同一个人刷屏只会排在自己后面
+    flow = f"{bot_id}:user:{body.user_id}" if body.user_id else f"{bot_id}:channel:{body.channel_id}"
+    result = await complete_llm(prompt, image_urls, bot_id, config, flow=flow)
+    tier_stats.record(bot_id, tier, result)
+    record_llm_usage(bot_id, result, body.user_id, tier, {
+        "prompt": len(prompt),
+        "memory": len(user_memory),
+        "history": sum(len(line) for line in chat_history) + len(channel_summary),
+        "knowledge": sum(len(r["title"]) + len(r["content"]) for r in rows),
+    })
+    answer = result["content"] if result["ok"] else result["error"]
     
     # 解析并保存记忆更新
     if body.user_id and "【记住】" in answer:
@@ -1099,26 +2833,38 @@ class NewApiUserRequest(BaseModel):
     newapi_token: str = ""
 
 
-@app.get("/admin/newapi-users", response_class=HTMLResponse)
-async def newapi_users_page(request: Request):
-    """New API 用户管理页面"""
+def list_newapi_users(q: str, cursor: str, limit: int) -> dict:
+    """按绑定先后倒序分页列出 New API 用户绑定，每页都附带总数（管理页面的统计卡片要用）"""
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT id, discord_id, discord_name, newapi_username, created_at FROM newapi_users ORDER BY created_at DESC")
-    users = [dict(row) for row in cur.fetchall()]
+    where = ""
+    params = []
+    if q:
+        where = " WHERE (discord_id LIKE ? OR discord_name LIKE ? OR newapi_username LIKE ?)"
+        params += [f"%{q}%"] * 3
+    cur.execute(f"SELECT COUNT(*) FROM newapi_users{where}", params)
+    result = {"total": cur.fetchone()[0]}
+    sql = f"SELECT id, discord_id, discord_name, newapi_username, created_at FROM newapi_users{where}"
+    if cursor:
+        sql += (" AND" if where else " WHERE") + " id < ?"
+        params += decode_cursor(cursor, 1)
+    rows, next_cursor = fetch_page(cur, sql + " ORDER BY id DESC", params, page_size(limit), lambda r: (r["id"],))
     conn.close()
-    return templates.TemplateResponse("newapi_users.html", {"request": request, "users": users})
+    result.update(users=[dict(row) for row in rows], next_cursor=next_cursor)
+    return result
+
+
+@app.get("/admin/newapi-users", response_class=HTMLResponse)
+async def newapi_users_page(request: Request, q: str = "", cursor: str = "", limit: int = 0):
+    """New API 用户管理页面"""
+    data = list_newapi_users(q, cursor, limit)
+    return templates.TemplateResponse("newapi_users.html", dict(data, request=request, q=q))
 
 
 @app.get("/api/newapi-users")
-async def get_newapi_users():
-    """获取所有 New API 用户绑定"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, discord_id, discord_name, newapi_username, created_at FROM newapi_users ORDER BY created_at DESC")
-    users = [dict(row) for row in cur.fetchall()]
-    conn.close()
-    return {"users": users}
+async def get_newapi_users(q: str = "", cursor: str = "", limit: int = 0):
+    """获取 New API 用户绑定（分页）"""
+    return list_newapi_users(q, cursor, limit)
 
 
 @app.get("/api/newapi-users/by-discord/{discord_id}")
@@ -1194,5 +2940,24 @@ async def update_newapi_token(discord_id: str, token: str):
     return {"success": True}
 
 
+def serve(host: str = "0.0.0.0", port: int = 8001, uds: str = ""):
+    """启动后端；指定 uds 时同一个服务同时监听 TCP（管理后台）和 Unix socket（同机的 Bot）"""
+    if not uds:
+        uvicorn.run(app, host=host, port=port, reload=False)
+        return
+
+    import socket
+    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_sock.bind((host, port))
+    if os.path.exists(uds):
+        os.remove(uds)
+    unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unix_sock.bind(uds)
+    os.chmod(uds, 0o660)
+    print(f"🔌 后端监听 http://{host}:{port} 和 unix:{uds}")
+    uvicorn.Server(uvicorn.Config(app, host=host, port=port)).run(sockets=[tcp_sock, unix_sock])
+
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=False)
+    serve(port=int(os.getenv("BACKEND_PORT", "8001")), uds=os.getenv("BACKEND_UDS", ""))
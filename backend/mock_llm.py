@@ -0,0 +1,73 @@
+"""
+本地模拟的 OpenAI 兼容 LLM 上游，用于测试多上游路由（对冲、重试、熔断）
+
+    python mock_llm.py --port 9001 --latency 0.3
+    python mock_llm.py --port 9002 --latency 2 --jitter 1 --error-rate 0.3 --name slow
+
+然后在后台「设置」的备用上游里填写：
+    [{"base_url": "http://127.0.0.1:9002/v1", "api_key": "test", "model": "mock"}]
+主上游的 API Base URL 填 http://127.0.0.1:9001/v1，API Key 随便填。
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def create_app(name: str, latency: float, jitter: float, error_rate: float, error_status: int) -> FastAPI:
+    app = FastAPI()
+    stats = {"requests": 0, "errors": 0}
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": f"{name} 模拟错误"}}, status_code=error_status)
+        messages = body.get("messages") or [{}]
+        question = messages[-1].get("content", "")
+        if isinstance(question, list):
+            question = " ".join(part.get("text", "") for part in question if isinstance(part, dict))
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 2
+        return {
+            "id": f"mock-{int(time.time() * 1000)}",
+            "object": "chat.completion",
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"[{name}] 收到：{question[-50:]}"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20, "total_tokens": prompt_tokens + 20},
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟 OpenAI 兼容的 LLM 上游")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--name", default="mock", help="写在回复里的上游名，便于看出是谁回答的")
+    parser.add_argument("--latency", type=float, default=0.3, help="平均响应耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.1, help="耗时随机浮动（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的概率 0~1")
+    parser.add_argument("--error-status", type=int, default=500, help="错误时的 HTTP 状态码")
+    args = parser.parse_args()
+
+    app = create_app(args.name, args.latency, args.jitter, args.error_rate, args.error_status)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
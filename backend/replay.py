@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+回放 ask_logs 里的历史提问，对比当前配置和候选配置的检索/提示词表现
+
+用法（在 backend 目录下运行）:
+    python replay.py --bot default --sample 200
+    python replay.py --bot default --candidate-config candidate.json --llm mock
+    python replay.py --bot default --candidate-db /path/to/new/knowledge.db
+
+候选配置是一个 JSON 文件，字段同 bot_configs（如 bot_persona、llm_model），只需写要覆盖的字段。
+候选知识库是另一个 knowledge.db（如导入了新知识的副本），检索时用它代替当前数据库。
+每条问题都走和 /api/ask 相同的 main.prepare_ask（FAQ 快速回答、频道标签检索、拼提示词、模型分级），
+但 ask_logs 里没有用户、频道和聊天记录，所以不含用户记忆、频道标签和会话摘要，
+报告中的提示词大小只包含人设、问题和知识库部分。
+"""
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import statistics
+import time
+
+import main
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def sample_questions(bot_id: str, n: int, seed: int, days: int) -> list:
+    """从 ask_logs 中随机抽取问题"""
+    conn = main.get_db()
+    cur = conn.cursor()
+    if days > 0:
+        cur.execute(
+            "SELECT question FROM ask_logs WHERE bot_id = ? AND created_at >= DATE('now', ?)",
+            (bot_id, f"-{days} days")
+        )
+    else:
+        cur.execute("SELECT question FROM ask_logs WHERE bot_id = ?", (bot_id,))
+    questions = [r[0] for r in cur.fetchall() if r[0] and r[0].strip()]
+    conn.close()
+    if len(questions) > n:
+        questions = random.Random(seed).sample(questions, n)
+    return questions
+
+
+async def mock_llm(prompt: str, latency: float) -> str:
+    """模拟 LLM：固定延迟，回复长度与提示词无关"""
+    await asyncio.sleep(latency)
+    return "喵～（模拟回复）"
+
+
+async def run_variant(name: str, bot_id: str, questions: list, config: dict, db_path: str, llm: str, mock_latency: float) -> dict:
+    """用一套配置跑完所有问题，返回统计结果"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    persona = config.get("bot_persona", "")
+    # 每套配置各用一份 FAQ 索引，候选知识库不会读到当前库的缓存
+    faq = main.FaqIndex(main.FAQ_INDEX_TTL)
+
+    retrieval_ms, prompt_chars, llm_ms = [], [], []
+    hits = 0
+    fast_path = 0
+    tiers = {}
+    for question in questions:
+        start = time.perf_counter()
+        prepared = main.prepare_ask(cur, bot_id, config, question, faq=faq)
+        retrieval_ms.append((time.perf_counter() - start) * 1000)
+        if prepared["faq"]:
+            fast_path += 1
+            continue
+        if prepared["rows"]:
+            hits += 1
+        tiers[prepared["tier"]] = tiers.get(prepared["tier"], 0) + 1
+
+        prompt = prepared["prompt"]
+        prompt_chars.append(len(persona) + len(prompt))
+
+        if llm == "none":
+            continue
+        start = time.perf_counter()
+        if llm == "mock":
+            await mock_llm(prompt, mock_latency)
+        else:
+            await main.call_llm(prompt, None, bot_id, config=prepared["config"])
+        llm_ms.append((time.perf_counter() - start) * 1000)
+    conn.close()
+
+    return {
+        "name": name,
+        "count": len(questions),
+        "hit_rate": hits / len(questions) if questions else 0.0,
+        "fast_path_rate": fast_path / len(questions) if questions else 0.0,
+        "tiers": tiers,
+        "retrieval_ms": retrieval_ms,
+        "prompt_chars": prompt_chars,
+        "llm_ms": llm_ms,
+    }
+
+
+def print_report(results: list):
+    print()
+    print(f"{'指标':<20}" + "".join(f"{r['name']:>16}" for r in results))
+    print("-" * (20 + 16 * len(results)))
+
+    def row(label, fn):
+        print(f"{label:<20}" + "".join(f"{fn(r):>16}" for r in results))
+
+    row("问题数", lambda r: r["count"])
+    row("FAQ 快速回答率", lambda r: f"{r['fast_path_rate'] * 100:.1f}%")
+    row("知识库命中率", lambda r: f"{r['hit_rate'] * 100:.1f}%")
+    row("检索 p50 (ms)", lambda r: f"{percentile(r['retrieval_ms'], 50):.2f}")
+    row("检索 p95 (ms)", lambda r: f"{percentile(r['retrieval_ms'], 95):.2f}")
+    row("检索 max (ms)", lambda r: f"{max(r['retrieval_ms'], default=0):.2f}")
+    row("模型档位", lambda r: " ".join(f"{k}:{v}" for k, v in sorted(r["tiers"].items())) or "-")
+    row("提示词 平均 (字)", lambda r: f"{statistics.mean(r['prompt_chars']) if r['prompt_chars'] else 0:.0f}")
+    row("提示词 p50 (字)", lambda r: f"{percentile(r['prompt_chars'], 50):.0f}")
+    row("提示词 p95 (字)", lambda r: f"{percentile(r['prompt_chars'], 95):.0f}")
+    row("提示词 max (字)", lambda r: f"{max(r['prompt_chars'], default=0)}")
+    if any(r["llm_ms"] for r in results):
+        row("LLM p50 (ms)", lambda r: f"{percentile(r['llm_ms'], 50):.0f}")
+        row("LLM p95 (ms)", lambda r: f"{percentile(r['llm_ms'], 95):.0f}")
+
+
+async def main_async(args):
+    questions = sample_questions(args.bot, args.sample, args.seed, args.days)
+    if not questions:
+        print(f"❌ ask_logs 中没有 bot_id={args.bot} 的提问")
+        return
+    print(f"📋 抽取了 {len(questions)} 条历史提问（bot_id={args.bot}）")
+
+    current_config = main.get_bot_config(args.bot)
+    results = [await run_variant("当前", args.bot, questions, current_config, main.DB_PATH, args.llm, args.mock_latency)]
+
+    if args.candidate_config or args.candidate_db:
+        candidate_config = dict(current_config)
+        if args.candidate_config:
+            with open(args.candidate_config, "r", encoding="utf-8") as f:
+                candidate_config.update(json.load(f))
+        candidate_db = args.candidate_db or main.DB_PATH
+        results.append(await run_variant("候选", args.bot, questions, candidate_config, candidate_db, args.llm, args.mock_latency))
+
+    print_report(results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="回放 ask_logs 历史提问，对比检索和提示词表现")
+    parser.add_argument("--bot", default="default", help="BOT ID")
+    parser.add_argument("--sample", type=int, default=200, help="抽取的提问数量")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子（保证两次运行抽到同一批问题）")
+    parser.add_argument("--days", type=int, default=0, help="只抽取最近 N 天的提问，0 表示不限")
+    parser.add_argument("--candidate-config", help="候选配置 JSON 文件")
+    parser.add_argument("--candidate-db", help="候选知识库 SQLite 文件")
+    parser.add_argument("--llm", choices=["none", "mock", "real"], default="none",
+                        help="none: 不调用 LLM；mock: 模拟 LLM；real: 调用真实 LLM（可配合 CASSETTE_MODE=replay）")
+    parser.add_argument("--mock-latency", type=float, default=0.8, help="模拟 LLM 的延迟（秒）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main_async(parse_args()))
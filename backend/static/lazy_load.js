@@ -0,0 +1,47 @@
+// 后台列表分页加载：页面底部的 a.load-more 指向下一页，
+// 点击或滚动到它时取下一页的 HTML，把其中的列表项追加到当前列表
+function setupLazyLoad(listSelector, itemSelector) {
+  const link = document.querySelector("a.load-more");
+  if (!link) return;
+  let loading = false;
+
+  const observer = new IntersectionObserver((entries) => {
+    if (entries.some((entry) => entry.isIntersecting)) loadMore();
+  });
+
+  async function loadMore() {
+    if (loading) return;
+    loading = true;
+    try {
+      const resp = await fetch(link.getAttribute("href"));
+      const doc = new DOMParser().parseFromString(
+        await resp.text(),
+        "text/html"
+      );
+      const list = document.querySelector(listSelector);
+      doc
+        .querySelectorAll(`${listSelector} ${itemSelector}`)
+        .forEach((item) => list.appendChild(document.importNode(item, true)));
+      const next = doc.querySelector("a.load-more");
+      if (next) {
+        link.setAttribute("href", next.getAttribute("href"));
+        // 重新观察一次，加载完仍在可视区域时继续加载
+        observer.unobserve(link);
+        observer.observe(link);
+      } else {
+        observer.disconnect();
+        link.remove();
+      }
+    } catch (e) {
+      console.error("加载下一页失败:", e);
+    } finally {
+      loading = false;
+    }
+  }
+
+  link.addEventListener("click", (e) => {
+    e.preventDefault();
+    loadMore();
+  });
+  observer.observe(link);
+}
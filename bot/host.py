@@ -0,0 +1,130 @@
+"""
+多 Bot 托管进程：一个 Python 进程里同时运行多个 BOT_ID
+
+所有 Bot 共用同一个事件循环、HTTP 连接池、频道历史和表情缓存，
+省去每个 Bot 单独一个进程的内存和连接开销。
+
+    BOT_HOST_SOURCE=env BOT_TOKENS="default:xxx,cat2:yyy" python host.py
+    BOT_HOST_SOURCE=backend BOT_HOST_SECRET=xxx python host.py   # 从后台「设置」里填写的 Discord Token 读取，定期同步
+"""
+import asyncio
+import os
+
+import discord
+
+import main as bot
+
+# Bot 列表来源：env（读取 BOT_TOKENS）或 backend（读取后端 /api/host/bots）
+BOT_HOST_SOURCE = os.getenv("BOT_HOST_SOURCE", "backend").lower()
+# env 模式下的 Bot 列表，格式 bot_id:token，多个用逗号分隔
+BOT_TOKENS = os.getenv("BOT_TOKENS", "")
+# backend 模式下重新拉取 Bot 列表的间隔（秒），新增的 Bot 自动启动，删除或清空 Token 的自动停止
+BOT_HOST_SYNC_INTERVAL = float(os.getenv("BOT_HOST_SYNC_INTERVAL", "60"))
+# backend 模式下读取 Token 的共享密钥，需与后端的 BOT_HOST_SECRET 一致
+BOT_HOST_SECRET = os.getenv("BOT_HOST_SECRET", "")
+
+
+def parse_bot_tokens(text: str) -> dict:
+    """解析 bot_id:token 列表"""
+    tokens = {}
+    for item in text.split(","):
+        bot_id, sep, token = item.strip().partition(":")
+        if sep and bot_id.strip() and token.strip():
+            tokens[bot_id.strip()] = token.strip()
+    return tokens
+
+
+class BotHost:
+    """管理多个 MeowClient 的启动和停止"""
+
+    def __init__(self):
+        # bot_id -> (token, client, task)
+        self.bots = {}
+
+    async def start_bot(self, bot_id: str, token: str):
+        if bot_id in self.bots:
+            return
+        client = bot.MeowClient(bot_id)
+        task = asyncio.create_task(self._run(bot_id, client, token))
+        self.bots[bot_id] = (token, client, task)
+        print(f"🤖 [托管] 启动 Bot: {bot_id}", flush=True)
+
+    async def stop_bot(self, bot_id: str):
+        entry = self.bots.pop(bot_id, None)
+        if entry is None:
+            return
+        _, client, task = entry
+        await client.close()
+        try:
+            await asyncio.wait_for(task, timeout=10)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            task.cancel()
+        print(f"🛑 [托管] 已停止 Bot: {bot_id}", flush=True)
+
+    async def _run(self, bot_id: str, client: bot.MeowClient, token: str):
+        try:
+            await client.start(token)
+        except discord.LoginFailure:
+            print(f"❌ [托管] Bot {bot_id} 的 Token 无效", flush=True)
+        except Exception as e:
+            print(f"❌ [托管] Bot {bot_id} 异常退出: {e}", flush=True)
+        finally:
+            if not client.is_closed():
+                await client.close()
+            # 异常退出的从列表中移除，下次同步时重新启动
+            entry = self.bots.get(bot_id)
+            if entry and entry[1] is client:
+                self.bots.pop(bot_id, None)
+
+    async def sync(self, desired: dict):
+        """让正在运行的 Bot 与期望列表一致：启动新增的、停止移除的、Token 变化的重启"""
+        for bot_id in list(self.bots):
+            if desired.get(bot_id) != self.bots[bot_id][0]:
+                await self.stop_bot(bot_id)
+        for bot_id, token in desired.items():
+            await self.start_bot(bot_id, token)
+
+    async def fetch_desired(self):
+        """读取期望运行的 Bot 列表，后端不可用时返回 None（保持现状）"""
+        if BOT_HOST_SOURCE == "env":
+            return parse_bot_tokens(BOT_TOKENS)
+        if not BOT_HOST_SECRET:
+            print("⚠️ [托管] backend 模式需要设置 BOT_HOST_SECRET（与后端一致）", flush=True)
+            return None
+        try:
+            resp = await bot.http_clients.backend.get(
+                "/api/host/bots", headers={"X-Bot-Host-Secret": BOT_HOST_SECRET}
+            )
+            resp.raise_for_status()
+            return {item["bot_id"]: item["token"] for item in resp.json().get("bots", [])}
+        except Exception as e:
+            print(f"⚠️ [托管] 获取 Bot 列表失败: {e}", flush=True)
+            return None
+
+    async def run(self):
+        # 托管进程自己持有一份连接池引用，单个 Bot 停止时不会被关掉
+        bot.http_clients.open()
+        try:
+            while True:
+                desired = await self.fetch_desired()
+                if desired is not None:
+                    if not desired:
+                        print("⚠️ [托管] 没有需要运行的 Bot", flush=True)
+                    # env 模式下列表不变，定期同步只用来拉起异常退出的 Bot
+                    await self.sync(desired)
+                await asyncio.sleep(BOT_HOST_SYNC_INTERVAL)
+        finally:
+            for bot_id in list(self.bots):
+                await self.stop_bot(bot_id)
+            await bot.http_clients.close()
+
+
+def main():
+    try:
+        asyncio.run(BotHost().run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,30 @@
 import os
 import re
+import sys
 import discord
 from discord import app_commands
 import httpx
 import json
 import asyncio
 import hashlib
+import time
+from collections import OrderedDict
+
+from newapi_client import NewApiClient
+from state import BotState
+
+# 后端和 Bot 共用的模块放在项目根目录的 common/ 下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.cassette import Cassette, CassetteTransport
 
 TOKEN = os.getenv("DISCORD_BOT_TOKEN", "")
 BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8001")
 BOT_ID = os.getenv("BOT_ID", "default")
+# 后端的 Unix socket 路径（同机部署时使用，代替 TCP 回环）
+BACKEND_UDS = os.getenv("BACKEND_UDS", "")
+
+# 单进程模式下由 start.py 注入后端模块：其他接口走进程内 ASGI，/api/ask 直接以协程调用
+LOCAL_BACKEND = None
 
 # New API 配置
 NEWAPI_URL = os.getenv("NEWAPI_URL", "")  # New API 地址，例如 https://api.example.com
@@ -17,58 +32,315 @@ NEWAPI_ADMIN_KEY = os.getenv("NEWAPI_ADMIN_KEY", "")  # 管理员 API Key（用
 ADMIN_USER_IDS = os.getenv("ADMIN_USER_IDS", "").split(",")  # 管理员 Discord ID 列表
 NEWAPI_VERIFY_SSL = os.getenv("NEWAPI_VERIFY_SSL", "false").lower() == "true"  # 是否验证SSL证书
 
-# 用户消息计数器（用于定期总结）
-user_message_counts = {}
+# HTTP 连接池：后端和 New API 分开设置超时（秒）和最大连接数
+BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", "10"))
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "20"))
+NEWAPI_TIMEOUT = float(os.getenv("NEWAPI_TIMEOUT", "30"))
+NEWAPI_MAX_CONNECTIONS = int(os.getenv("NEWAPI_MAX_CONNECTIONS", "10"))
 
+# New API 查询缓存（秒）：绑定关系、用户名→ID、余额快照，以及每类缓存的最大条数
+NEWAPI_BINDING_CACHE_TTL = float(os.getenv("NEWAPI_BINDING_CACHE_TTL", "300"))
+NEWAPI_USER_ID_CACHE_TTL = float(os.getenv("NEWAPI_USER_ID_CACHE_TTL", "3600"))
+NEWAPI_BALANCE_CACHE_TTL = float(os.getenv("NEWAPI_BALANCE_CACHE_TTL", "30"))
+NEWAPI_CACHE_SIZE = int(os.getenv("NEWAPI_CACHE_SIZE", "10000"))
+# /令牌 的本地令牌索引：分页大小、完整重扫间隔（秒）、两次增量扫描的最短间隔（秒）
+NEWAPI_TOKEN_PAGE_SIZE = int(os.getenv("NEWAPI_TOKEN_PAGE_SIZE", "100"))
+NEWAPI_TOKEN_INDEX_TTL = float(os.getenv("NEWAPI_TOKEN_INDEX_TTL", "600"))
+NEWAPI_TOKEN_REFRESH_TTL = float(os.getenv("NEWAPI_TOKEN_REFRESH_TTL", "30"))
 
-async def save_user_memory(user_id: str, user_name: str, user_msg: str):
-    """直接记录用户发言到记忆"""
-    try:
-        async with httpx.AsyncClient(timeout=5) as http:
-            await http.post(
-                f"{BACKEND_URL.rstrip('/')}/api/memories/{BOT_ID}/{user_id}",
-                json={"user_name": user_name, "memory": user_msg[:200]}
-            )
-            print(f'🧠 [记忆已追加] {user_name}: {user_msg[:30]}...', flush=True)
-    except Exception as e:
-        print(f'🧠 [记忆追加失败] {e}', flush=True)
+# 录制/回放模式（off / record / replay），用于离线复现 New API 流量
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.getenv(
+    "CASSETTE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cassettes", "newapi.jsonl")
+)
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "1.0"))  # 回放延迟倍数，0 表示不等待
+
+# 机器人自己最近发送的消息 ID 缓存条数（用于判断“回复了机器人”）
+OWN_MESSAGE_CACHE_SIZE = int(os.getenv("OWN_MESSAGE_CACHE_SIZE", "2000"))
+
+# 频道聊天记录缓存：每个频道保留条数、最多缓存频道数、总内存上限（字节，估算值）
+HISTORY_BUFFER_SIZE = int(os.getenv("HISTORY_BUFFER_SIZE", "200"))
+HISTORY_MAX_CHANNELS = int(os.getenv("HISTORY_MAX_CHANNELS", "500"))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# 上下文收集各步骤的超时（秒），超时后用已有的部分结果继续回复
+CONTEXT_HISTORY_TIMEOUT = float(os.getenv("CONTEXT_HISTORY_TIMEOUT", "1.5"))
+REPLY_RESOLVE_TIMEOUT = float(os.getenv("REPLY_RESOLVE_TIMEOUT", "3"))
+
+# 启动时强制同步斜杠命令（默认只在命令定义变化时同步）
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "false").lower() == "true"
+
+# 后端 LLM 排队满或超时（429/503）时的回复
+BUSY_REPLY = os.getenv("BUSY_REPLY", "现在找我的人有点多，稍等一下再叫我吧～")
+
+# 每次提问附带的服务器表情数量上限
+EMOJI_PROMPT_LIMIT = int(os.getenv("EMOJI_PROMPT_LIMIT", "8"))
+
+# Bot 本地状态（消息计数、登录 Token）的快照文件、内存中每类最多保留的条数、写盘间隔（秒）
+BOT_STATE_PATH = os.getenv(
+    "BOT_STATE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "bot_state.db")
+)
+BOT_STATE_MAX_ENTRIES = int(os.getenv("BOT_STATE_MAX_ENTRIES", "100000"))
+BOT_STATE_SNAPSHOT_INTERVAL = float(os.getenv("BOT_STATE_SNAPSHOT_INTERVAL", "60"))
+
+bot_state = BotState(BOT_STATE_PATH, BOT_STATE_MAX_ENTRIES, BOT_STATE_SNAPSHOT_INTERVAL)
+
+# 用户发言写入记忆的批量提交间隔（秒），以及缓冲达到多少条时提前提交
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "3"))
+MEMORY_FLUSH_MAX_ITEMS = int(os.getenv("MEMORY_FLUSH_MAX_ITEMS", "200"))
+# 后端连不上时每个 Bot 最多积压多少条待提交的发言，超出后丢弃最早的
+MEMORY_BACKLOG_MAX = int(os.getenv("MEMORY_BACKLOG_MAX", "5000"))
+
+# 用户消息计数器（用于定期总结），键为 "bot_id:user_id"
+user_message_counts = bot_state.counts
+
+
+class MemoryBuffer:
+    """用户发言的写回缓冲：先记在内存里，每隔几秒批量提交到后端 /api/memories_bulk
+
+    网络错误或后端 5xx 时放回缓冲下次重试，4xx 说明这批数据本身有问题，记日志后丢弃；
+    每个 Bot 的积压不超过 backlog_max 条，超出时丢弃最早的。关闭 Bot 时会先把缓冲全部写完。
+    """
+
+    def __init__(self, interval: float, max_items: int, backlog_max: int):
+        self.interval = interval
+        self.max_items = max_items
+        self.backlog_max = backlog_max
+        # bot_id -> [{"user_id", "user_name", "memory"}]
+        self.pending = {}
+        self.count = 0
+        self.refs = 0
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def add(self, bot_id: str, user_id: str, user_name: str, user_msg: str):
+        self.pending.setdefault(bot_id, []).append(
+            {"user_id": user_id, "user_name": user_name, "memory": user_msg[:200]}
+        )
+        self.count += 1
+        self._trim(bot_id)
+        if self.count >= self.max_items:
+            self._wakeup.set()
+
+    def _trim(self, bot_id: str):
+        """积压超过上限时丢弃最早的发言"""
+        items = self.pending.get(bot_id)
+        overflow = len(items) - self.backlog_max if items else 0
+        if overflow > 0:
+            del items[:overflow]
+            self.count -= overflow
+            print(f'🧠 [记忆积压过多] {bot_id}: 丢弃最早的 {overflow} 条', flush=True)
+
+    async def flush(self, bot_id: str = None):
+        """提交缓冲中的记忆，指定 bot_id 时只提交这个 Bot 的"""
+        async with self._lock:
+            bot_ids = [bot_id] if bot_id is not None else list(self.pending)
+            for bid in bot_ids:
+                items = self.pending.pop(bid, None)
+                if not items:
+                    continue
+                self.count -= len(items)
+                try:
+                    resp = await http_clients.backend.post(f"/api/memories_bulk/{bid}", json={"items": items})
+                except httpx.TransportError as e:
+                    self._requeue(bid, items, f"{type(e).__name__}: {e}")
+                    continue
+                if resp.status_code >= 500:
+                    self._requeue(bid, items, f"HTTP {resp.status_code}")
+                elif resp.is_error:
+                    # 重试也不会成功，继续放着只会一直堵在队首
+                    print(f'🧠 [记忆追加被拒绝] {bid}: HTTP {resp.status_code}，丢弃 {len(items)} 条: {resp.text[:200]}', flush=True)
+                else:
+                    print(f'🧠 [记忆已追加] {bid}: {len(items)} 条', flush=True)
+
+    def _requeue(self, bot_id: str, items: list, reason: str):
+        # 放回队首，保持先后顺序
+        self.pending[bot_id] = items + self.pending.get(bot_id, [])
+        self.count += len(items)
+        print(f'🧠 [记忆追加失败] {bot_id}: {reason}，{len(items)} 条稍后重试', flush=True)
+        self._trim(bot_id)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def open(self):
+        self.refs += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        self.refs = max(0, self.refs - 1)
+        if not self.refs and self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
 
 
-async def summarize_user_memory(user_id: str, user_name: str):
+memory_buffer = MemoryBuffer(MEMORY_FLUSH_INTERVAL, MEMORY_FLUSH_MAX_ITEMS, MEMORY_BACKLOG_MAX)
+
+
+async def summarize_user_memory(bot_id: str, user_id: str, user_name: str):
     """每50条消息总结一次用户记忆"""
     try:
-        async with httpx.AsyncClient(timeout=30) as http:
-            # 获取当前记忆
-            resp = await http.get(f"{BACKEND_URL.rstrip('/')}/api/memories/{BOT_ID}/{user_id}")
-            if resp.status_code != 200:
-                return
-            data = resp.json()
-            current_memory = data.get('memory', '')
-            
-            if len(current_memory) < 500:
-                return
-            
-            # 调用后端 AI 总结（使用 /api/ask）
-            summary_resp = await http.post(
-                f"{BACKEND_URL.rstrip('/')}/api/ask",
-                json={
-                    "question": f"请将以下聊天记录整理成简洁的个人信息摘要，提取关键信息如姓名、爱好、性格等，用简短要点：\n{current_memory[-2000:]}",
-                    "bot_id": BOT_ID,
-                }
-            )
-            if summary_resp.status_code == 200:
-                summary = summary_resp.json().get('answer', '')
-                if summary:
-                    # 更新为总结后的记忆
-                    await http.put(
-                        f"{BACKEND_URL.rstrip('/')}/api/memories/{BOT_ID}/{user_id}",
-                        json={"memory": summary[:1500]}
-                    )
-                    print(f'🧠 [记忆已总结] {user_name}', flush=True)
+        # 先把缓冲里的发言写进去，总结才能看到最新记录
+        await memory_buffer.flush(bot_id)
+        http = http_clients.backend
+        # 获取当前记忆
+        resp = await http.get(f"/api/memories/{bot_id}/{user_id}")
+        if resp.status_code != 200:
+            return
+        data = resp.json()
+        current_memory = data.get('memory', '')
+        
+        if len(current_memory) < 500:
+            return
+        
+        # 调用后端 AI 总结（使用 /api/ask）
+        summary_resp = await http.post(
+            "/api/ask",
+            json={
+                "question": f"请将以下聊天记录整理成简洁的个人信息摘要，提取关键信息如姓名、爱好、性格等，用简短要点：\n{current_memory[-2000:]}",
+                "bot_id": bot_id,
+            },
+            timeout=30
+        )
+        if summary_resp.status_code == 200:
+            summary = summary_resp.json().get('answer', '')
+            if summary:
+                # 更新为总结后的记忆
+                await http.put(
+                    f"/api/memories/{bot_id}/{user_id}",
+                    json={"memory": summary[:1500]}
+                )
+                print(f'🧠 [记忆已总结] {user_name}', flush=True)
     except Exception as e:
         print(f'🧠 [记忆总结失败] {e}', flush=True)
 
 
+# ==================== 录制/回放 ====================
+
+_cassette = None
+
+
+def get_cassette():
+    """按 CASSETTE_MODE 返回全局录制文件，off 时返回 None"""
+    global _cassette
+    if CASSETTE_MODE not in ("record", "replay"):
+        return None
+    if _cassette is None:
+        _cassette = Cassette(CASSETTE_MODE, CASSETTE_PATH, CASSETTE_LATENCY_SCALE)
+    return _cassette
+
+
+class HttpClients:
+    """Bot 共享的 HTTP 客户端：后端和 New API 各一个连接池，复用长连接和 TLS 会话
+
+    在 setup_hook 中创建，关闭 Bot 时释放。多 Bot 托管时所有客户端共用，
+    按引用计数在最后一个 Bot 关闭时才真正释放。
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.newapi = None
+        self.refs = 0
+
+    def open(self):
+        self.refs += 1
+        if self.backend is None:
+            limits = httpx.Limits(
+                max_connections=BACKEND_MAX_CONNECTIONS,
+                max_keepalive_connections=BACKEND_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            )
+            if LOCAL_BACKEND is not None:
+                transport = httpx.ASGITransport(app=LOCAL_BACKEND.app)
+            else:
+                transport = httpx.AsyncHTTPTransport(uds=BACKEND_UDS or None, limits=limits)
+            self.backend = httpx.AsyncClient(
+                base_url=BACKEND_URL.rstrip("/"),
+                timeout=httpx.Timeout(BACKEND_TIMEOUT),
+                transport=transport,
+            )
+        if self.newapi is None:
+            # New API 可能是自签证书，单独的 verify 设置和连接上限
+            transport = httpx.AsyncHTTPTransport(
+                verify=NEWAPI_VERIFY_SSL,
+                limits=httpx.Limits(
+                    max_connections=NEWAPI_MAX_CONNECTIONS,
+                    max_keepalive_connections=NEWAPI_MAX_CONNECTIONS,
+                    keepalive_expiry=60,
+                ),
+            )
+            cassette = get_cassette()
+            if cassette:
+                transport = CassetteTransport(cassette, transport)
+            self.newapi = httpx.AsyncClient(
+                base_url=NEWAPI_URL.rstrip("/"),
+                timeout=httpx.Timeout(NEWAPI_TIMEOUT),
+                transport=transport,
+            )
+
+    async def close(self):
+        self.refs = max(0, self.refs - 1)
+        if self.refs:
+            return
+        for name in ("backend", "newapi"):
+            client = getattr(self, name)
+            if client is not None:
+                setattr(self, name, None)
+                await client.aclose()
+
+
+http_clients = HttpClients()
+newapi_client = NewApiClient(
+    http_clients,
+    NEWAPI_ADMIN_KEY,
+    binding_ttl=NEWAPI_BINDING_CACHE_TTL,
+    user_id_ttl=NEWAPI_USER_ID_CACHE_TTL,
+    snapshot_ttl=NEWAPI_BALANCE_CACHE_TTL,
+    maxsize=NEWAPI_CACHE_SIZE,
+    token_page_size=NEWAPI_TOKEN_PAGE_SIZE,
+    token_index_ttl=NEWAPI_TOKEN_INDEX_TTL,
+    token_refresh_ttl=NEWAPI_TOKEN_REFRESH_TTL,
+)
+
+
+def channel_label(channel) -> str:
+    """分类名、父频道名（子区）和频道名，后端据此推断知识标签"""
+    names = []
+    parent = getattr(channel, "parent", None)
+    category = getattr(parent or channel, "category", None)
+    for obj in (category, parent, channel):
+        name = getattr(obj, "name", None)
+        if name:
+            names.append(name)
+    return " / ".join(names)
+
+
+async def post_ask(payload: dict):
+    """调用后端 /api/ask，返回 (状态码, 响应数据)"""
+    if LOCAL_BACKEND is not None:
+        try:
+            return 200, await LOCAL_BACKEND.api_ask(LOCAL_BACKEND.AskRequest(**payload))
+        except LOCAL_BACKEND.HTTPException as e:
+            return e.status_code, {"detail": e.detail}
+    resp = await http_clients.backend.post("/api/ask", json=payload, timeout=90)
+    try:
+        data = resp.json()
+    except ValueError:
+        data = {"detail": resp.text}
+    return resp.status_code, data
+
+
 # 配置文件路径
 CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "config.json")
 
@@ -95,6 +367,264 @@ intents = discord.Intents.default()
 intents.message_content = True
 
 
+# ==================== 频道聊天记录缓存 ====================
+
+class ChannelHistoryBuffer:
+    """按频道缓存最近的聊天记录
+
+    由 on_message / 编辑 / 删除事件增量维护，只有频道第一次被用到（冷启动）时才调用
+    history() 回填。频道之间按最近使用做 LRU 淘汰，同时受频道数和总内存上限约束。
+    """
+
+    # 每条记录除正文外的大致固定开销（字节）
+    ENTRY_OVERHEAD = 120
+
+    def __init__(self, per_channel: int, max_channels: int, max_bytes: int):
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self.max_bytes = max_bytes
+        # channel_id -> OrderedDict(message_id -> (author_id, author_name, author_is_bot, content))，按时间从旧到新
+        self.channels = OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.warm = set()
+        self._backfills = {}
+        # channel_id -> {bot_id: 后端已确认的上下文游标}，缓存内容被改动时作废，下次发送完整记录
+        self.acked = {}
+
+    @staticmethod
+    def make_entry(msg: discord.Message):
+        content = msg.content[:200] if msg.content else ""
+        # 处理附件说明
+        if not content and msg.attachments:
+            content = "[发送了附件]"
+        if not content:
+            return None
+        return (msg.author.id, msg.author.display_name, msg.author.bot, content)
+
+    def _entry_size(self, entry) -> int:
+        return self.ENTRY_OVERHEAD + len(entry[1]) + len(entry[3]) * 3
+
+    def _channel(self, channel_id: int) -> OrderedDict:
+        buf = self.channels.get(channel_id)
+        if buf is None:
+            buf = self.channels[channel_id] = OrderedDict()
+            self.sizes[channel_id] = 0
+        self.channels.move_to_end(channel_id)
+        return buf
+
+    def _put(self, channel_id: int, buf: OrderedDict, message_id: int, entry, oldest: bool = False):
+        old = buf.get(message_id)
+        if old is not None:
+            self._account(channel_id, -self._entry_size(old))
+        buf[message_id] = entry
+        self._account(channel_id, self._entry_size(entry))
+        if oldest:
+            buf.move_to_end(message_id, last=False)
+
+    def _pop(self, channel_id: int, buf: OrderedDict, message_id: int = None):
+        if message_id is None:
+            _, entry = buf.popitem(last=False)
+        else:
+            entry = buf.pop(message_id, None)
+        if entry is not None:
+            self._account(channel_id, -self._entry_size(entry))
+
+    def _account(self, channel_id: int, delta: int):
+        self.sizes[channel_id] += delta
+        self.total_bytes += delta
+
+    def _evict(self):
+        """LRU 淘汰最久没用的频道，至少保留最近使用的那个"""
+        while len(self.channels) > 1 and (len(self.channels) > self.max_channels or self.total_bytes > self.max_bytes):
+            channel_id, _ = self.channels.popitem(last=False)
+            self.total_bytes -= self.sizes.pop(channel_id, 0)
+            self.warm.discard(channel_id)
+            self.acked.pop(channel_id, None)
+
+    def add(self, msg: discord.Message) -> bool:
+        """记录一条新消息，返回是否第一次见到（多个 Bot 在同一频道会各收到一次）"""
+        entry = self.make_entry(msg)
+        if entry is None:
+            return False
+        channel_id = msg.channel.id
+        buf = self._channel(channel_id)
+        if msg.id in buf:
+            return False
+        self._put(channel_id, buf, msg.id, entry)
+        while len(buf) > self.per_channel:
+            self._pop(channel_id, buf)
+        self._evict()
+        return True
+
+    def edit(self, channel_id: int, message_id: int, content: str):
+        buf = self.channels.get(channel_id)
+        if not buf or message_id not in buf or not content:
+            return
+        author_id, author_name, author_is_bot, _ = buf[message_id]
+        self._put(channel_id, buf, message_id, (author_id, author_name, author_is_bot, content[:200]))
+        self.acked.pop(channel_id, None)
+
+    def delete(self, channel_id: int, message_id: int):
+        buf = self.channels.get(channel_id)
+        if buf and message_id in buf:
+            self._pop(channel_id, buf, message_id)
+            self.acked.pop(channel_id, None)
+
+    def invalidate(self, channel_ids=None, bot_id: str = None):
+        """断线重连后可能漏掉事件，下次使用时重新回填
+
+        多 Bot 托管时各 Bot 共用这份缓存，只处理重连的那个 Bot 能看到的频道和它自己的游标，
+        不传参数时全部作废。
+        """
+        if channel_ids is None:
+            self.warm.clear()
+            self.acked.clear()
+            return
+        for channel_id in channel_ids:
+            self.warm.discard(channel_id)
+            # 重新回填后缓存内容会变，这些频道上所有 Bot 的游标都要作废
+            self.acked.pop(channel_id, None)
+        for acked in self.acked.values():
+            acked.pop(bot_id, None)
+
+    def get_acked(self, channel_id: int, bot_id: str) -> str:
+        return self.acked.get(channel_id, {}).get(bot_id, "")
+
+    def set_acked(self, channel_id: int, bot_id: str, cursor: str):
+        if channel_id in self.channels:
+            self.acked.setdefault(channel_id, {})[bot_id] = cursor
+
+    async def _backfill(self, channel):
+        channel_id = channel.id
+        try:
+            async for msg in channel.history(limit=self.per_channel):
+                buf = self._channel(channel_id)
+                if len(buf) >= self.per_channel:
+                    break
+                if msg.id in buf:
+                    continue
+                entry = self.make_entry(msg)
+                if entry is not None:
+                    # history() 从新到旧返回，依次插到最前面
+                    self._put(channel_id, buf, msg.id, entry, oldest=True)
+            self.warm.add(channel_id)
+            self._evict()
+        except Exception as e:
+            print(f"[上下文读取错误] {e}")
+
+    async def ensure_backfilled(self, channel):
+        """冷启动的频道回填一次历史记录，同一频道并发调用只回填一次"""
+        if channel.id in self.warm:
+            return
+        task = self._backfills.get(channel.id)
+        if task is None:
+            task = asyncio.create_task(self._backfill(channel))
+            self._backfills[channel.id] = task
+            task.add_done_callback(lambda _: self._backfills.pop(channel.id, None))
+        # shield：调用方超时取消时回填继续在后台完成
+        await asyncio.shield(task)
+
+    def recent(self, channel_id: int, limit: int, exclude_id: int = None) -> list:
+        """返回频道最近 limit 条记录 [(message_id, entry)]（从旧到新）"""
+        buf = self.channels.get(channel_id)
+        if not buf:
+            return []
+        self.channels.move_to_end(channel_id)
+        items = [item for item in reversed(buf.items()) if item[0] != exclude_id][:limit]
+        items.reverse()
+        return items
+
+
+channel_history = ChannelHistoryBuffer(HISTORY_BUFFER_SIZE, HISTORY_MAX_CHANNELS, HISTORY_MAX_BYTES)
+
+
+# ==================== 服务器表情目录 ====================
+
+EMOJI_PATTERN = re.compile(r'<a?:(\w+):(\d+)>')
+
+
+class EmojiCatalog:
+    """按服务器缓存表情目录，每次提问只挑出少量相关表情
+
+    目录在第一次使用时生成，收到 on_guild_emojis_update 时重建。
+    挑选顺序：名字出现在问题里的 > 最近在服务器里用得多的 > 目录中靠前的。
+    """
+
+    # 使用次数总和超过该值时整体减半，让“最近”用得多的排在前面
+    USAGE_DECAY_AT = 1000
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        # guild_id -> {emoji_id: (name_lower, code)}
+        self.catalogs = {}
+        # guild_id -> {emoji_id: count}
+        self.usage = {}
+
+    def refresh(self, guild: discord.Guild, emojis=None):
+        catalog = {}
+        for emoji in (guild.emojis if emojis is None else emojis):
+            if emoji.animated:
+                code = f"<a:{emoji.name}:{emoji.id}>"
+            else:
+                code = f"<:{emoji.name}:{emoji.id}>"
+            catalog[emoji.id] = (emoji.name.lower(), code)
+        self.catalogs[guild.id] = catalog
+        usage = self.usage.get(guild.id)
+        if usage:
+            self.usage[guild.id] = {k: v for k, v in usage.items() if k in catalog}
+        return catalog
+
+    def get(self, guild: discord.Guild) -> dict:
+        catalog = self.catalogs.get(guild.id)
+        if catalog is None:
+            catalog = self.refresh(guild)
+        return catalog
+
+    def record_usage(self, message: discord.Message):
+        """统计消息里用到的本服务器表情"""
+        if not message.guild or not message.content or "<" not in message.content:
+            return
+        catalog = self.catalogs.get(message.guild.id)
+        if not catalog:
+            return
+        usage = self.usage.setdefault(message.guild.id, {})
+        for _, emoji_id in EMOJI_PATTERN.findall(message.content):
+            emoji_id = int(emoji_id)
+            if emoji_id in catalog:
+                usage[emoji_id] = usage.get(emoji_id, 0) + 1
+        if sum(usage.values()) > self.USAGE_DECAY_AT:
+            self.usage[message.guild.id] = {k: v // 2 for k, v in usage.items() if v > 1}
+
+    def select(self, guild: discord.Guild, text: str) -> list:
+        catalog = self.get(guild)
+        if not catalog:
+            return []
+        text = text.lower()
+        picked = [emoji_id for emoji_id, (name, _) in catalog.items() if len(name) >= 2 and name in text]
+        usage = self.usage.get(guild.id, {})
+        for emoji_id in sorted(usage, key=usage.get, reverse=True):
+            if len(picked) >= self.limit:
+                break
+            if emoji_id not in picked:
+                picked.append(emoji_id)
+        for emoji_id in catalog:
+            if len(picked) >= self.limit:
+                break
+            if emoji_id not in picked:
+                picked.append(emoji_id)
+        return [catalog[emoji_id][1] for emoji_id in picked[:self.limit]]
+
+    def prompt_info(self, guild: discord.Guild, text: str) -> str:
+        codes = self.select(guild, text)
+        if not codes:
+            return ""
+        return "可用的服务器表情：" + " ".join(codes)
+
+
+emoji_catalog = EmojiCatalog(EMOJI_PROMPT_LIMIT)
+
+
 # ==================== New API 功能 ====================
 
 async def newapi_register(username: str, password: str, display_name: str = ""):
@@ -103,31 +633,31 @@ async def newapi_register(username: str, password: str, display_name: str = ""):
         return {"success": False, "message": "New API 未配置"}
     
     try:
-        async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-            # 使用管理员创建用户接口
-            resp = await http.post(
-                f"{NEWAPI_URL.rstrip('/')}/api/user/",
-                json={
-                    "username": username,
-                    "password": password,
-                    "display_name": display_name or username,
-                    "quota": 0,
-                    "group": "default",
-                    "status": 1
-                },
-                headers={
-                    "Authorization": f"Bearer {NEWAPI_ADMIN_KEY}",
-                    "New-Api-User": "1"
-                }
-            )
-            print(f"[New API 注册] 状态码: {resp.status_code}, 响应: {resp.text[:500]}")
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get("success"):
-                    return {"success": True, "message": "注册成功", "data": data.get("data")}
-                return {"success": False, "message": data.get("message", "注册失败")}
-            else:
-                return {"success": False, "message": f"HTTP {resp.status_code}: {resp.text[:200]}"}
+        http = http_clients.newapi
+        # 使用管理员创建用户接口
+        resp = await http.post(
+            "/api/user/",
+            json={
+                "username": username,
+                "password": password,
+                "display_name": display_name or username,
+                "quota": 0,
+                "group": "default",
+                "status": 1
+            },
+            headers={
+                "Authorization": f"Bearer {NEWAPI_ADMIN_KEY}",
+                "New-Api-User": "1"
+            }
+        )
+        print(f"[New API 注册] 状态码: {resp.status_code}, 响应: {resp.text[:500]}")
+        if resp.status_code == 200:
+            data = resp.json()
+            if data.get("success"):
+                return {"success": True, "message": "注册成功", "data": data.get("data")}
+            return {"success": False, "message": data.get("message", "注册失败")}
+        else:
+            return {"success": False, "message": f"HTTP {resp.status_code}: {resp.text[:200]}"}
     except Exception as e:
         return {"success": False, "message": f"请求失败: {e}"}
 
@@ -138,19 +668,19 @@ async def newapi_login(username: str, password: str):
         return {"success": False, "message": "New API 未配置"}
     
     try:
-        async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-            resp = await http.post(
-                f"{NEWAPI_URL.rstrip('/')}/api/user/login",
-                json={"username": username, "password": password}
-            )
-            print(f"[New API 登录] 状态码: {resp.status_code}, 响应: {resp.text[:500]}")
-            data = resp.json()
-            if resp.status_code == 200 and data.get("success"):
-                # token 可能在不同位置
-                token = data.get("data", {}).get("token") or data.get("data", {}).get("access_token") or data.get("token")
-                print(f"[New API 登录] 获取到的 token: {token}")
-                return {"success": True, "token": token, "data": data.get("data")}
-            return {"success": False, "message": data.get("message", "登录失败")}
+        http = http_clients.newapi
+        resp = await http.post(
+            "/api/user/login",
+            json={"username": username, "password": password}
+        )
+        print(f"[New API 登录] 状态码: {resp.status_code}, 响应: {resp.text[:500]}")
+        data = resp.json()
+        if resp.status_code == 200 and data.get("success"):
+            # token 可能在不同位置
+            token = data.get("data", {}).get("token") or data.get("data", {}).get("access_token") or data.get("token")
+            print(f"[New API 登录] 获取到的 token: {token}")
+            return {"success": True, "token": token, "data": data.get("data")}
+        return {"success": False, "message": data.get("message", "登录失败")}
     except Exception as e:
         return {"success": False, "message": f"请求失败: {e}"}
 
@@ -161,22 +691,21 @@ async def newapi_get_user_info(token: str):
         return {"success": False, "message": "New API 未配置"}
     
     try:
-        async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-            resp = await http.get(
-                f"{NEWAPI_URL.rstrip('/')}/api/user/self",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            data = resp.json()
-            if resp.status_code == 200 and data.get("success"):
-                return {"success": True, "data": data.get("data")}
-            return {"success": False, "message": data.get("message", "获取失败")}
+        http = http_clients.newapi
+        resp = await http.get(
+            "/api/user/self",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        data = resp.json()
+        if resp.status_code == 200 and data.get("success"):
+            return {"success": True, "data": data.get("data")}
+        return {"success": False, "message": data.get("message", "获取失败")}
     except Exception as e:
         return {"success": False, "message": f"请求失败: {e}"}
 
 
-# 用户 Token 存储（内存中，重启会丢失）
-# 实际使用建议存储到后端数据库
-user_tokens = {}
+# 用户 Token 存储（discord_id -> token），只在内存里，重启后从后端绑定读取
+user_tokens = bot_state.tokens
 
 
 def is_admin(user_id: str) -> bool:
@@ -185,54 +714,60 @@ def is_admin(user_id: str) -> bool:
 
 
 class MeowClient(discord.Client):
-    def __init__(self):
+    def __init__(self, bot_id: str = BOT_ID):
         super().__init__(intents=intents)
+        self.bot_id = bot_id
+        self.http_opened = False
         self.tree = app_commands.CommandTree(self)
+        # 机器人最近发送的消息 ID（LRU），命中即可确定是回复机器人，无需请求 Discord API
+        self.own_message_ids = OrderedDict()
+
+    def remember_own_message(self, message_id: int):
+        """记录机器人发送的消息 ID"""
+        self.own_message_ids[message_id] = True
+        self.own_message_ids.move_to_end(message_id)
+        while len(self.own_message_ids) > OWN_MESSAGE_CACHE_SIZE:
+            self.own_message_ids.popitem(last=False)
+
+    def reply_target_from_cache(self, message: discord.Message):
+        """不发请求判断消息是否回复了机器人，无法判断时返回 None"""
+        ref = message.reference
+        if ref.message_id in self.own_message_ids:
+            return True
+        # 网关事件里通常已带上被回复的消息
+        resolved = ref.resolved
+        if isinstance(resolved, discord.DeletedReferencedMessage):
+            return False
+        if isinstance(resolved, discord.Message):
+            return resolved.author.id == self.user.id
+        # 客户端消息缓存
+        cached = ref.cached_message
+        if cached is not None:
+            return cached.author.id == self.user.id
+        return None
+
+    async def is_reply_to_self(self, message: discord.Message) -> bool:
+        """判断消息是否回复了机器人，缓存都没命中时才请求 Discord API"""
+        result = self.reply_target_from_cache(message)
+        if result is not None:
+            return result
+        try:
+            replied_msg = await message.channel.fetch_message(message.reference.message_id)
+        except Exception:
+            return False
+        if replied_msg.author.id == self.user.id:
+            self.remember_own_message(replied_msg.id)
+            return True
+        return False
 
     async def setup_hook(self):
-        """注册斜杠命令"""
-        
-        # 检查用户是否已绑定
-        async def check_user_bindng(discord_id: str):
-            """检查用户是否已在后端绑定"""
-            try:
-                async with httpx.AsyncClient(timeout=10) as http:
-                    resp = await http.get(f"{BACKEND_URL.rstrip('/')}/api/newapi-users/by-discord/{discord_id}")
-                    if resp.status_code == 200:
-                        return resp.json()
-            except:
-                pass
-            return {"exists": False}
-        
-        # 保存用户绑定到后端
-        async def save_user_binding(discord_id: str, discord_name: str, newapi_username: str, token: str = ""):
-            """保存用户绑定到后端"""
-            try:
-                async with httpx.AsyncClient(timeout=10) as http:
-                    await http.post(
-                        f"{BACKEND_URL.rstrip('/')}/api/newapi-users",
-                        json={
-                            "discord_id": discord_id,
-                            "discord_name": discord_name,
-                            "newapi_username": newapi_username,
-                            "newapi_token": token
-                        }
-                    )
-            except Exception as e:
-                print(f"保存绑定失败: {e}")
-        
-        # 更新用户 Token
-        async def update_user_token(discord_id: str, token: str):
-            """更新用户 Token"""
-            try:
-                async with httpx.AsyncClient(timeout=10) as http:
-                    await http.put(
-                        f"{BACKEND_URL.rstrip('/')}/api/newapi-users/{discord_id}/token",
-                        params={"token": token}
-                    )
-            except:
-                pass
+        """创建 HTTP 连接池并注册斜杠命令"""
+        http_clients.open()
+        bot_state.open()
+        memory_buffer.open()
+        self.http_opened = True
         
+        # 绑定查询、用户名→ID、余额快照都走 newapi_client 的缓存
         # 注册命令（用户自己注册）
         @self.tree.command(name="注册", description="注册你的 New API 账号")
         @app_commands.describe(用户名="设置你的用户名（英文字母和数字）", 密码="设置你的密码（至少8位）")
@@ -253,7 +788,7 @@ class MeowClient(discord.Client):
             discord_name = interaction.user.display_name
             
             # 检查是否已绑定
-            binding = await check_user_bindng(discord_id)
+            binding = await newapi_client.get_binding(discord_id)
             if binding.get("exists"):
                 existing = binding.get("user", {})
                 await interaction.followup.send(
@@ -269,56 +804,59 @@ class MeowClient(discord.Client):
             result = await newapi_register(username, 密码, discord_name)
             if result["success"]:
                 # 保存绑定关系到后端
-                await save_user_binding(discord_id, discord_name, username)
+                bound = await newapi_client.save_binding(discord_id, discord_name, username)
+                newapi_client.invalidate(username=username)
+                bind_warning = "" if bound else "\n\n⚠️ 账号已创建，但绑定关系保存失败，请联系管理员在后台补录绑定"
                 
                 # 获取新用户的 ID 并创建默认 Key
-                user_id = await get_newapi_user_id(username)
+                user_id = await newapi_client.get_user_id(username)
                 api_key = ""
                 if user_id:
                     try:
-                        async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-                            # 1. 先创建令牌（归属管理员）
-                            resp = await http.post(
-                                f"{NEWAPI_URL.rstrip('/')}/api/token/",
-                                json={
-                                    "name": f"{username}_default",
-                                    "remain_quota": 0,
-                                    "unlimited_quota": True
-                                },
-                                headers={
-                                    "Authorization": f"{NEWAPI_ADMIN_KEY}",
-                                    "New-Api-User": "1"
-                                }
-                            )
-                            data = resp.json()
-                            print(f"[注册创建Key] 创建响应: {data}")
+                        http = http_clients.newapi
+                        # 1. 先创建令牌（归属管理员）
+                        resp = await http.post(
+                            "/api/token/",
+                            json={
+                                "name": f"{username}_default",
+                                "remain_quota": 0,
+                                "unlimited_quota": True
+                            },
+                            headers={
+                                "Authorization": f"{NEWAPI_ADMIN_KEY}",
+                                "New-Api-User": "1"
+                            }
+                        )
+                        data = resp.json()
+                        print(f"[注册创建Key] 创建响应: {data}")
+                        
+                        if data.get("success"):
+                            token_data = data.get("data", {})
+                            if isinstance(token_data, dict):
+                                token_id = token_data.get("id")
+                                api_key = token_data.get("key", "")
+                            else:
+                                api_key = str(token_data)
+                                token_id = None
+                            
+                            # 2. 修改令牌归属用户
+                            if token_id:
+                                resp2 = await http.put(
+                                    "/api/token/",
+                                    json={
+                                        "id": token_id,
+                                        "user_id": user_id
+                                    },
+                                    headers={
+                                        "Authorization": f"{NEWAPI_ADMIN_KEY}",
+                                        "New-Api-User": "1"
+                                    }
+                                )
+                                print(f"[注册创建Key] 修改归属响应: {resp2.json()}")
+                                newapi_client.invalidate(tokens=True)
                             
-                            if data.get("success"):
-                                token_data = data.get("data", {})
-                                if isinstance(token_data, dict):
-                                    token_id = token_data.get("id")
-                                    api_key = token_data.get("key", "")
-                                else:
-                                    api_key = str(token_data)
-                                    token_id = None
-                                
-                                # 2. 修改令牌归属用户
-                                if token_id:
-                                    resp2 = await http.put(
-                                        f"{NEWAPI_URL.rstrip('/')}/api/token/",
-                                        json={
-                                            "id": token_id,
-                                            "user_id": user_id
-                                        },
-                                        headers={
-                                            "Authorization": f"{NEWAPI_ADMIN_KEY}",
-                                            "New-Api-User": "1"
-                                        }
-                                    )
-                                    print(f"[注册创建Key] 修改归属响应: {resp2.json()}")
-                                
-                                if api_key and not api_key.startswith("sk-"):
-                                    api_key = f"sk-{api_key}"
+                            if api_key and not api_key.startswith("sk-"):
+                                api_key = f"sk-{api_key}"
                     except Exception as e:
                         print(f"[注册创建Key] 错误: {e}")
                 
@@ -328,7 +866,7 @@ class MeowClient(discord.Client):
                         f"� 用户名：`{username}`\n"
                         f"🔐 密码：`{密码}`\n\n"
                         f"� **你的 API Key**：\n```\n{api_key}\n```\n"
-                        f"⚠️ 请妥善保管！",
+                        f"⚠️ 请妥善保管！{bind_warning}",
                         ephemeral=True
                     )
                 else:
@@ -336,7 +874,7 @@ class MeowClient(discord.Client):
                         f"✅ 注册成功！\n"
                         f"👤 用户名：`{username}`\n"
                         f"🔐 密码：`{密码}`\n\n"
-                        f"使用 `/创建令牌 名称` 来创建 API Key",
+                        f"使用 `/创建令牌 名称` 来创建 API Key{bind_warning}",
                         ephemeral=True
                     )
             else:
@@ -351,7 +889,7 @@ class MeowClient(discord.Client):
             discord_id = str(interaction.user.id)
             
             # 检查是否已绑定
-            binding = await check_user_bindng(discord_id)
+            binding = await newapi_client.get_binding(discord_id)
             if not binding.get("exists"):
                 await interaction.followup.send(
                     "❌ 你还没有注册账号，请联系管理员使用 /注册 命令为你开通",
@@ -368,11 +906,12 @@ class MeowClient(discord.Client):
                 print(f"[登录] discord_id={discord_id}, token={token}")
                 if token:
                     # 保存到内存
-                    user_tokens[discord_id] = token
+                    user_tokens.set(discord_id, token)
                     # 更新到后端
-                    await update_user_token(discord_id, token)
+                    saved = await newapi_client.update_token(discord_id, token)
+                    save_warning = "" if saved else "\n\n⚠️ 登录状态没能保存到后台，Bot 重启后需要重新登录"
                     await interaction.followup.send(
-                        f"✅ 登录成功！\n👤 账号：`{username}`\n\n现在可以使用 /账号 /余额 /令牌 等命令了",
+                        f"✅ 登录成功！\n👤 账号：`{username}`\n\n现在可以使用 /账号 /余额 /令牌 等命令了{save_warning}",
                         ephemeral=True
                     )
                 else:
@@ -389,38 +928,19 @@ class MeowClient(discord.Client):
             discord_id = str(interaction.user.id)
             
             # 检查是否已绑定
-            binding = await check_user_bindng(discord_id)
+            binding = await newapi_client.get_binding(discord_id)
             if not binding.get("exists"):
                 await interaction.response.send_message("❌ 你还没有注册账号，请使用 /注册 命令", ephemeral=True)
                 return
             
             await interaction.response.defer(ephemeral=True)
             
-            # 使用管理员 Key 查询用户信息
+            # 使用管理员 Key 查询用户信息（短时间内与 /余额 共用同一份快照）
             username = binding["user"]["newapi_username"]
-            try:
-                async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-                    # 使用搜索接口
-                    resp = await http.get(
-                        f"{NEWAPI_URL.rstrip('/')}/api/user/search",
-                        params={"keyword": username},
-                        headers={
-                            "Authorization": f"{NEWAPI_ADMIN_KEY}",
-                            "New-Api-User": "1"
-                        }
-                    )
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        if data.get("success"):
-                            # 数据在 data.items 里
-                            items = data.get("data", {}).get("items", [])
-                            user = None
-                            for u in items:
-                                if isinstance(u, dict) and u.get("username") == username:
-                                    user = u
-                                    break
-                            if user:
-                                info = f"""📋 **账号信息**
+            result = await newapi_client.search_user(username)
+            if result["success"]:
+                user = result["user"]
+                info = f"""📋 **账号信息**
 👤 用户名：`{user.get('username', 'N/A')}`
 📛 昵称：{user.get('display_name', 'N/A')}
 💰 余额：**${user.get('quota', 0) / 500000:.4f}**
@@ -429,18 +949,9 @@ class MeowClient(discord.Client):
 🎭 角色：{'管理员' if user.get('role') == 100 else '普通用户'}
 📊 状态：{'✅ 正常' if user.get('status') == 1 else '❌ 禁用'}
 """
-                                await interaction.followup.send(info, ephemeral=True)
-                                return
-                            await interaction.followup.send(f"❌ 未找到用户 (共{len(items)}个结果)", ephemeral=True)
-                            return
-                        await interaction.followup.send(f"❌ {data.get('message', '查询失败')}", ephemeral=True)
-                    else:
-                        await interaction.followup.send(f"❌ HTTP {resp.status_code}", ephemeral=True)
-                    return
-            except Exception as e:
-                import traceback
-                print(f"[账号查询错误] {traceback.format_exc()}")
-                await interaction.followup.send(f"❌ 请求失败: {type(e).__name__}: {e}", ephemeral=True)
+                await interaction.followup.send(info, ephemeral=True)
+            else:
+                await interaction.followup.send(f"❌ {result['message']}", ephemeral=True)
             return
             
             result = await newapi_get_user_info(token)
@@ -468,79 +979,36 @@ class MeowClient(discord.Client):
             discord_id = str(interaction.user.id)
             
             # 检查是否已绑定
-            binding = await check_user_bindng(discord_id)
+            binding = await newapi_client.get_binding(discord_id)
             if not binding.get("exists"):
                 await interaction.response.send_message("❌ 你还没有注册账号，请使用 /注册 命令", ephemeral=True)
                 return
             
             await interaction.response.defer(ephemeral=True)
             
-            # 使用管理员 Key 查询用户信息
+            # 使用管理员 Key 查询用户信息（余额快照缓存 NEWAPI_BALANCE_CACHE_TTL 秒）
             username = binding["user"]["newapi_username"]
-            try:
-                async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-                    resp = await http.get(
-                        f"{NEWAPI_URL.rstrip('/')}/api/user/search",
-                        params={"keyword": username},
-                        headers={
-                            "Authorization": f"{NEWAPI_ADMIN_KEY}",
-                            "New-Api-User": "1"
-                        }
-                    )
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        if data.get("success"):
-                            items = data.get("data", {}).get("items", [])
-                            user = None
-                            for u in items:
-                                if isinstance(u, dict) and u.get("username") == username:
-                                    user = u
-                                    break
-                            if user:
-                                quota = user.get('quota', 0) / 500000
-                                used = user.get('used_quota', 0) / 500000
-                                await interaction.followup.send(
-                                    f"💰 **余额查询**\n"
-                                    f"可用余额：**${quota:.4f}**\n"
-                                    f"已使用：${used:.4f}",
-                                    ephemeral=True
-                                )
-                                return
-                    await interaction.followup.send("❌ 查询失败", ephemeral=True)
-            except Exception as e:
-                await interaction.followup.send(f"❌ 请求失败: {e}", ephemeral=True)
+            result = await newapi_client.search_user(username)
+            if result["success"]:
+                user = result["user"]
+                quota = user.get('quota', 0) / 500000
+                used = user.get('used_quota', 0) / 500000
+                await interaction.followup.send(
+                    f"💰 **余额查询**\n"
+                    f"可用余额：**${quota:.4f}**\n"
+                    f"已使用：${used:.4f}",
+                    ephemeral=True
+                )
+                return
+            await interaction.followup.send("❌ 查询失败", ephemeral=True)
 
-        # 获取用户 New API ID 的辅助函数
-        async def get_newapi_user_id(username: str):
-            """通过用户名获取 New API 用户 ID"""
-            try:
-                async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-                    resp = await http.get(
-                        f"{NEWAPI_URL.rstrip('/')}/api/user/search",
-                        params={"keyword": username},
-                        headers={
-                            "Authorization": f"{NEWAPI_ADMIN_KEY}",
-                            "New-Api-User": "1"
-                        }
-                    )
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        if data.get("success"):
-                            items = data.get("data", {}).get("items", [])
-                            for u in items:
-                                if u.get("username") == username:
-                                    return u.get("id")
-            except:
-                pass
-            return None
-        
         # 令牌/Key 命令
         @self.tree.command(name="令牌", description="查看你的 API Key")
         async def cmd_token(interaction: discord.Interaction):
             discord_id = str(interaction.user.id)
             
             # 检查是否已绑定
-            binding = await check_user_bindng(discord_id)
+            binding = await newapi_client.get_binding(discord_id)
             if not binding.get("exists"):
                 await interaction.response.send_message("❌ 你还没有注册账号，请使用 /注册 命令", ephemeral=True)
                 return
@@ -548,67 +1016,42 @@ class MeowClient(discord.Client):
             await interaction.response.defer(ephemeral=True)
             
             username = binding["user"]["newapi_username"]
-            user_id = await get_newapi_user_id(username)
+            user_id = await newapi_client.get_user_id(username)
             if not user_id:
                 await interaction.followup.send("❌ 无法获取用户信息", ephemeral=True)
                 return
             
-            # 管理员获取所有令牌，然后过滤
+            # 有登录 Token 时只查自己的令牌，否则走管理员接口的本地索引（增量分页扫描）
+            user_token = user_tokens.get(discord_id) or binding["user"].get("newapi_token") or ""
             try:
-                async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-                    resp = await http.get(
-                        f"{NEWAPI_URL.rstrip('/')}/api/token/",
-                        params={"p": 0, "size": 1000},
-                        headers={
-                            "Authorization": f"{NEWAPI_ADMIN_KEY}",
-                            "New-Api-User": "1"
-                        }
-                    )
-                    data = resp.json()
-                    print(f"[令牌] user_id={user_id}, 响应: {str(data)[:500]}")
+                result = await newapi_client.list_user_tokens(user_id, user_token)
+                print(f"[令牌] user_id={user_id}, 用户令牌: {len(result.get('tokens', []))}")
+                
+                if result["success"]:
+                    tokens = result["tokens"]
+                    if not tokens:
+                        await interaction.followup.send(
+                            f"📭 你还没有 API Key\n\n"
+                            f"使用 `/创建令牌 名称` 来创建一个！",
+                            ephemeral=True
+                        )
+                        return
                     
-                    if resp.status_code == 200 and data.get("success"):
-                        tokens_data = data.get("data", {})
-                        if isinstance(tokens_data, dict):
-                            all_tokens = tokens_data.get("data", []) or tokens_data.get("items", [])
-                        elif isinstance(tokens_data, list):
-                            all_tokens = tokens_data
-                        else:
-                            all_tokens = []
-                        
-                        # 过滤当前用户的令牌
-                        tokens = [t for t in all_tokens if str(t.get("user_id")) == str(user_id)]
-                        # 打印所有令牌的 user_id
-                        token_user_ids = [t.get("user_id") for t in all_tokens[:10]]
-                        print(f"[令牌] 总数: {len(all_tokens)}, 用户令牌: {len(tokens)}, 令牌user_ids: {token_user_ids}")
-                        
-                        if not tokens:
-                            # 显示前几个令牌的 user_id 帮助调试
-                            sample_ids = [t.get("user_id") for t in all_tokens[:5]]
-                            await interaction.followup.send(
-                                f"📭 你还没有 API Key\n\n"
-                                f"使用 `/创建令牌 名称` 来创建一个！\n\n"
-                                f"🔍 调试: 你的user_id={user_id}, 总令牌={len(all_tokens)}\n"
-                                f"📋 令牌user_ids: {sample_ids}",
-                                ephemeral=True
-                            )
-                            return
-                        
-                        msg = "🔑 **你的 API Keys**\n"
-                        for t in tokens[:5]:
-                            name = t.get('name', '未命名')
-                            key = t.get('key', '')
-                            if key and not key.startswith('sk-'):
-                                key = f"sk-{key}"
-                            status = "✅" if t.get('status') == 1 else "❌"
-                            quota = t.get('remain_quota', 0)
-                            unlimited = t.get('unlimited_quota', False)
-                            quota_str = "无限" if unlimited else f"${quota / 500000:.4f}"
-                            msg += f"\n{status} **{name}** (额度: {quota_str})\n`{key}`\n"
-                        
-                        await interaction.followup.send(msg, ephemeral=True)
-                    else:
-                        await interaction.followup.send(f"❌ {data.get('message', '获取失败')}", ephemeral=True)
+                    msg = "🔑 **你的 API Keys**\n"
+                    for t in tokens[:5]:
+                        name = t.get('name', '未命名')
+                        key = t.get('key', '')
+                        if key and not key.startswith('sk-'):
+                            key = f"sk-{key}"
+                        status = "✅" if t.get('status') == 1 else "❌"
+                        quota = t.get('remain_quota', 0)
+                        unlimited = t.get('unlimited_quota', False)
+                        quota_str = "无限" if unlimited else f"${quota / 500000:.4f}"
+                        msg += f"\n{status} **{name}** (额度: {quota_str})\n`{key}`\n"
+                    
+                    await interaction.followup.send(msg, ephemeral=True)
+                else:
+                    await interaction.followup.send(f"❌ {result['message']}", ephemeral=True)
             except Exception as e:
                 await interaction.followup.send(f"❌ 请求失败: {e}", ephemeral=True)
         
@@ -619,7 +1062,7 @@ class MeowClient(discord.Client):
             discord_id = str(interaction.user.id)
             
             # 检查是否已绑定
-            binding = await check_user_bindng(discord_id)
+            binding = await newapi_client.get_binding(discord_id)
             if not binding.get("exists"):
                 await interaction.response.send_message("❌ 你还没有注册账号，请使用 /注册 命令", ephemeral=True)
                 return
@@ -627,53 +1070,54 @@ class MeowClient(discord.Client):
             await interaction.response.defer(ephemeral=True)
             
             username = binding["user"]["newapi_username"]
-            user_id = await get_newapi_user_id(username)
+            user_id = await newapi_client.get_user_id(username)
             if not user_id:
                 await interaction.followup.send("❌ 无法获取用户信息", ephemeral=True)
                 return
             
             # 管理员帮用户创建令牌
             try:
-                async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-                    resp = await http.post(
-                        f"{NEWAPI_URL.rstrip('/')}/api/token/",
-                        json={
-                            "name": 名称,
-                            "user_id": user_id,
-                            "remain_quota": 0,
-                            "unlimited_quota": True
-                        },
-                        headers={
-                            "Authorization": f"{NEWAPI_ADMIN_KEY}"
-                        }
-                    )
-                    data = resp.json()
-                    print(f"[创建令牌] user_id={user_id}, 响应: {data}")
+                http = http_clients.newapi
+                resp = await http.post(
+                    "/api/token/",
+                    json={
+                        "name": 名称,
+                        "user_id": user_id,
+                        "remain_quota": 0,
+                        "unlimited_quota": True
+                    },
+                    headers={
+                        "Authorization": f"{NEWAPI_ADMIN_KEY}"
+                    }
+                )
+                data = resp.json()
+                print(f"[创建令牌] user_id={user_id}, 响应: {data}")
+                
+                if resp.status_code == 200 and data.get("success"):
+                    newapi_client.invalidate(username=username, tokens=True)
+                    token_key = data.get("data", "")
+                    if isinstance(token_key, dict):
+                        token_key = token_key.get("key", "")
+                    if token_key and not token_key.startswith('sk-'):
+                        token_key = f"sk-{token_key}"
                     
-                    if resp.status_code == 200 and data.get("success"):
-                        token_key = data.get("data", "")
-                        if isinstance(token_key, dict):
-                            token_key = token_key.get("key", "")
-                        if token_key and not token_key.startswith('sk-'):
-                            token_key = f"sk-{token_key}"
-                        
-                        if token_key:
-                            await interaction.followup.send(
-                                f"✅ 令牌创建成功！\n\n"
-                                f"📛 名称：**{名称}**\n"
-                                f"🔑 Key：\n```\n{token_key}\n```\n"
-                                f"⚠️ 请妥善保管，此 Key 只显示一次！",
-                                ephemeral=True
-                            )
-                        else:
-                            await interaction.followup.send(
-                                f"✅ 令牌创建成功！\n\n"
-                                f"📛 名称：**{名称}**\n"
-                                f"🔑 使用 `/令牌` 查看你的 Key",
-                                ephemeral=True
-                            )
+                    if token_key:
+                        await interaction.followup.send(
+                            f"✅ 令牌创建成功！\n\n"
+                            f"📛 名称：**{名称}**\n"
+                            f"🔑 Key：\n```\n{token_key}\n```\n"
+                            f"⚠️ 请妥善保管，此 Key 只显示一次！",
+                            ephemeral=True
+                        )
                     else:
-                        await interaction.followup.send(f"❌ {data.get('message', '创建失败')}", ephemeral=True)
+                        await interaction.followup.send(
+                            f"✅ 令牌创建成功！\n\n"
+                            f"📛 名称：**{名称}**\n"
+                            f"🔑 使用 `/令牌` 查看你的 Key",
+                            ephemeral=True
+                        )
+                else:
+                    await interaction.followup.send(f"❌ {data.get('message', '创建失败')}", ephemeral=True)
             except Exception as e:
                 await interaction.followup.send(f"❌ 请求失败: {e}", ephemeral=True)
 
@@ -691,58 +1135,173 @@ class MeowClient(discord.Client):
             
             await interaction.response.defer(ephemeral=True)
             try:
-                async with httpx.AsyncClient(timeout=30, verify=NEWAPI_VERIFY_SSL) as http:
-                    resp = await http.get(
-                        f"{NEWAPI_URL.rstrip('/')}/api/user/search?keyword={用户名}",
-                        headers={"Authorization": f"Bearer {NEWAPI_ADMIN_KEY}"}
-                    )
-                    data = resp.json()
-                    if resp.status_code == 200 and data.get("success"):
-                        users = data.get("data", [])
-                        if not users:
-                            await interaction.followup.send(f"❌ 未找到用户 `{用户名}`", ephemeral=True)
-                            return
-                        
-                        user = users[0]
-                        info = f"""📋 **用户信息**
+                http = http_clients.newapi
+                resp = await http.get(
+                    f"/api/user/search?keyword={用户名}",
+                    headers={"Authorization": f"Bearer {NEWAPI_ADMIN_KEY}"}
+                )
+                data = resp.json()
+                if resp.status_code == 200 and data.get("success"):
+                    users = data.get("data", [])
+                    if not users:
+                        await interaction.followup.send(f"❌ 未找到用户 `{用户名}`", ephemeral=True)
+                        return
+                    
+                    user = users[0]
+                    info = f"""📋 **用户信息**
 👤 用户名：`{user.get('username', 'N/A')}`
 📛 昵称：{user.get('display_name', 'N/A')}
 💰 余额：**${user.get('quota', 0) / 500000:.4f}**
 🎫 已用：${user.get('used_quota', 0) / 500000:.4f}
 📊 状态：{'✅ 正常' if user.get('status') == 1 else '❌ 禁用'}
 """
-                        await interaction.followup.send(info, ephemeral=True)
-                    else:
-                        await interaction.followup.send(f"❌ {data.get('message', '查询失败')}", ephemeral=True)
+                    await interaction.followup.send(info, ephemeral=True)
+                else:
+                    await interaction.followup.send(f"❌ {data.get('message', '查询失败')}", ephemeral=True)
             except Exception as e:
                 await interaction.followup.send(f"❌ 请求失败: {e}", ephemeral=True)
 
-        # 同步命令
+        # 同步命令（命令定义没变时跳过，避免每次启动都触发 Discord 的限流）
+        await self.sync_commands()
+
+    def command_tree_hash(self) -> str:
+        """斜杠命令定义的哈希，与 tree.sync() 上传的内容一致"""
+        commands = [cmd.to_dict(self.tree) for cmd in self.tree.get_commands()]
+        commands.sort(key=lambda c: (c.get("type", 1), c["name"]))
+        payload = json.dumps(commands, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def sync_commands(self):
+        key = f"command_tree:{self.application_id}"
+        tree_hash = self.command_tree_hash()
+        if not FORCE_COMMAND_SYNC and bot_state.get_kv(key) == tree_hash:
+            print(f"✅ 斜杠命令未变化，跳过同步")
+            return
         await self.tree.sync()
+        await bot_state.set_kv(key, tree_hash)
         print(f"✅ 斜杠命令已注册")
 
+    async def close(self):
+        await super().close()
+        # 登录失败时 setup_hook 没跑过，不能释放别的 Bot 还在用的连接池
+        if self.http_opened:
+            self.http_opened = False
+            await bot_state.close()
+            await memory_buffer.close()
+            await http_clients.close()
+
     async def on_ready(self):
-        print(f"Logged in as {self.user} (ID: {self.user.id})")
+        print(f"Logged in as {self.user} (ID: {self.user.id}, BOT_ID: {self.bot_id})")
+        channel_ids = {channel.id for channel in self.private_channels}
+        for guild in self.guilds:
+            channel_ids.update(channel.id for channel in guild.channels)
+            channel_ids.update(thread.id for thread in guild.threads)
+        channel_history.invalidate(channel_ids, self.bot_id)
         if NEWAPI_URL:
             print(f"✅ New API 已配置: {NEWAPI_URL}")
 
+    async def on_guild_emojis_update(self, guild: discord.Guild, before, after):
+        emoji_catalog.refresh(guild, after)
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if "content" in payload.data:
+            channel_history.edit(payload.channel_id, payload.message_id, payload.data["content"])
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        channel_history.delete(payload.channel_id, payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            channel_history.delete(payload.channel_id, message_id)
+
+    async def _timed(self, timings: dict, name: str, coro, default):
+        """执行一个上下文收集步骤并记录耗时，出错或超时时返回默认值"""
+        start = time.perf_counter()
+        try:
+            return await coro
+        except asyncio.TimeoutError:
+            print(f"[上下文超时] {name}", flush=True)
+            return default
+        except Exception as e:
+            print(f"[上下文错误] {name}: {e}", flush=True)
+            return default
+        finally:
+            timings[name] = (time.perf_counter() - start) * 1000
+
+    async def select_emojis(self, message: discord.Message, question: str) -> str:
+        """获取服务器表情包列表"""
+        if not message.guild:
+            return ""
+        return emoji_catalog.prompt_info(message.guild, question)
+
+    async def load_chat_history(self, message: discord.Message) -> list:
+        """获取频道最近的聊天记录作为上下文（来自本地缓存，冷启动时回填一次），返回 [(message_id, 文本)]"""
+        limit = get_context_limit()
+        if not limit:
+            return []
+        try:
+            await asyncio.wait_for(channel_history.ensure_backfilled(message.channel), CONTEXT_HISTORY_TIMEOUT)
+        except asyncio.TimeoutError:
+            # 回填在后台继续，这次先用已经拿到的部分记录
+            print(f"[上下文超时] 聊天记录回填超过 {CONTEXT_HISTORY_TIMEOUT}s，使用部分记录", flush=True)
+
+        chat_history = []
+        for message_id, (author_id, author_name, author_is_bot, msg_content) in channel_history.recent(message.channel.id, limit, exclude_id=message.id):
+            # 标识发送者
+            if author_id == self.user.id:
+                author_name = "你(机器人)"
+            elif author_is_bot:
+                author_name = f"{author_name}(机器人)"
+            chat_history.append((message_id, f"{author_name}: {msg_content}"))
+        return chat_history
+
+    async def ask_backend(self, channel_id: int, payload: dict, chat_history: list):
+        """调用后端 /api/ask，聊天记录只发送后端上次确认之后的新消息，返回 (状态码, 响应数据)
+
+        后端游标对不上时（409）重发一次完整记录。
+        """
+        ids = [str(message_id) for message_id, _ in chat_history]
+        lines = [line for _, line in chat_history]
+        payload = dict(
+            payload,
+            channel_id=str(channel_id),
+            context_cursor=ids[-1] if ids else "0",
+            context_limit=len(lines),
+        )
+        base = channel_history.get_acked(channel_id, self.bot_id)
+        if base and base in ids:
+            payload.update(chat_history=lines[ids.index(base) + 1:], context_base=base)
+            status, data = await post_ask(payload)
+            if status != 409:
+                if status == 200:
+                    channel_history.set_acked(channel_id, self.bot_id, payload["context_cursor"])
+                return status, data
+        payload.update(chat_history=lines, context_base="")
+        status, data = await post_ask(payload)
+        if status == 200:
+            channel_history.set_acked(channel_id, self.bot_id, payload["context_cursor"])
+        return status, data
+
     async def on_message(self, message: discord.Message):
+        if channel_history.add(message):
+            emoji_catalog.record_usage(message)
+        if message.author.id == self.user.id:
+            self.remember_own_message(message.id)
         if message.author.bot:
             return
 
         # 检测是否应该响应：被@了 或者 回复了机器人的消息
         is_mentioned = self.user in message.mentions
-        is_reply_to_bot = False
-        if message.reference and message.reference.message_id:
-            try:
-                replied_msg = await message.channel.fetch_message(message.reference.message_id)
-                if replied_msg.author.id == self.user.id:
-                    is_reply_to_bot = True
-            except:
-                pass
-        
-        if not is_mentioned and not is_reply_to_bot:
-            return
+        reply_check = None
+        if not is_mentioned:
+            if not (message.reference and message.reference.message_id):
+                return
+            is_reply_to_bot = self.reply_target_from_cache(message)
+            if is_reply_to_bot is False:
+                return
+            if is_reply_to_bot is None:
+                # 缓存没命中，需要请求 Discord API，和下面的上下文收集并行进行
+                reply_check = asyncio.wait_for(self.is_reply_to_self(message), REPLY_RESOLVE_TIMEOUT)
 
         content = message.content.strip()
         # 提取问题（用正则去掉所有@mention）
@@ -758,79 +1317,73 @@ class MeowClient(discord.Client):
             if att.content_type and att.content_type.startswith("image/"):
                 image_urls.append(att.url)
 
-        # 获取服务器表情包列表
-        emojis_info = ""
-        if message.guild:
-            emoji_list = []
-            for emoji in message.guild.emojis[:50]:
-                if emoji.animated:
-                    emoji_list.append(f"<a:{emoji.name}:{emoji.id}>")
-                else:
-                    emoji_list.append(f"<:{emoji.name}:{emoji.id}>")
-            if emoji_list:
-                emojis_info = "可用的服务器表情：" + " ".join(emoji_list)
-
-        # 获取频道最近的聊天记录作为上下文
-        chat_history = []
-        limit = get_context_limit()
-        if limit:
-            try:
-                async for msg in message.channel.history(limit=limit + 1):
-                    if msg.id == message.id:
-                        continue
-                    # 获取消息内容，保留@标记
-                    msg_content = msg.content[:200] if msg.content else ""
-                    # 处理附件说明
-                    if not msg_content and msg.attachments:
-                        msg_content = "[发送了附件]"
-                    if not msg_content:
-                        continue
-                    # 标识发送者
-                    if msg.author.id == self.user.id:
-                        author_name = "你(机器人)"
-                    elif msg.author.bot:
-                        author_name = f"{msg.author.display_name}(机器人)"
-                    else:
-                        author_name = msg.author.display_name
-                    chat_history.append(f"{author_name}: {msg_content}")
-                chat_history.reverse()
-            except Exception as e:
-                print(f"[上下文读取错误] {e}")
+        # 并行收集上下文：服务器表情、频道聊天记录、（必要时）回复目标
+        timings = {}
+        started = time.perf_counter()
+        if reply_check is not None and message.channel.id not in channel_history.warm:
+            # 冷频道的聊天记录要回填上百条，先确认是回复机器人再回填，不回答的消息不白拉一次历史
+            if not await self._timed(timings, "回复目标", reply_check, False):
+                return
+            reply_check = None
+        steps = [
+            self._timed(timings, "表情", self.select_emojis(message, question), ""),
+            self._timed(timings, "聊天记录", self.load_chat_history(message), []),
+        ]
+        if reply_check is not None:
+            steps.append(self._timed(timings, "回复目标", reply_check, False))
+        results = await asyncio.gather(*steps)
+        emojis_info, chat_history = results[0], results[1]
+        if reply_check is not None and not results[2]:
+            return
+        context_ms = (time.perf_counter() - started) * 1000
 
         async with message.channel.typing():
             try:
-                async with httpx.AsyncClient(timeout=90) as http:
-                    resp = await http.post(
-                        f"{BACKEND_URL.rstrip('/')}/api/ask",
-                        json={
-                            "question": question, 
-                            "image_urls": image_urls,
-                            "emojis_info": emojis_info,
-                            "chat_history": chat_history,
-                            "user_name": message.author.display_name,
-                            "user_id": str(message.author.id),
-                            "bot_id": BOT_ID,
-                        },
-                    )
-                if resp.status_code != 200:
-                    await message.reply(f"后端错误：{resp.status_code} {resp.text}")
+                backend_started = time.perf_counter()
+                status, data = await self.ask_backend(
+                    message.channel.id,
+                    {
+                        "question": question, 
+                        "image_urls": image_urls,
+                        "emojis_info": emojis_info,
+                        "user_name": message.author.display_name,
+                        "user_id": str(message.author.id),
+                        "bot_id": self.bot_id,
+                        "channel_name": channel_label(message.channel),
+                    },
+                    chat_history,
+                )
+                backend_ms = (time.perf_counter() - backend_started) * 1000
+                steps_text = " / ".join(f"{name} {ms:.0f}ms" for name, ms in timings.items())
+                print(
+                    f"[耗时] 上下文 {context_ms:.0f}ms（串行需 {sum(timings.values()):.0f}ms: {steps_text}）"
+                    f" | 后端 {backend_ms:.0f}ms",
+                    flush=True
+                )
+                if status in (429, 503):
+                    # 后端 LLM 排队已满或等待超时
+                    await message.reply(BUSY_REPLY)
+                    return
+                if status != 200:
+                    await message.reply(f"后端错误：{status} {data.get('detail', data)}")
                     return
-                data = resp.json()
                 answer = data.get("answer", "(后端没有返回answer字段)")
                 if len(answer) > 1800:
                     answer = answer[:1800] + "..."
-                await message.reply(answer)
+                sent = await message.reply(answer)
+                self.remember_own_message(sent.id)
                 
                 # 记录用户发言到记忆
                 user_id = str(message.author.id)
                 user_name = message.author.display_name
-                asyncio.create_task(save_user_memory(user_id, user_name, question))
+                memory_buffer.add(self.bot_id, user_id, user_name, question)
                 
                 # 更新消息计数，每50条自动总结
-                user_message_counts[user_id] = user_message_counts.get(user_id, 0) + 1
-                if user_message_counts[user_id] >= 50:
-                    user_message_counts[user_id] = 0
-                    asyncio.create_task(summarize_user_memory(user_id, user_name))
+                count_key = f"{self.bot_id}:{user_id}"
+                count = user_message_counts.get(count_key, 0) + 1
+                user_message_counts.set(count_key, 0 if count >= 50 else count)
+                if count >= 50:
+                    asyncio.create_task(summarize_user_memory(self.bot_id, user_id, user_name))
             except Exception as e:
                 await message.reply(f"请求后端失败：{e}")
 
@@ -0,0 +1,347 @@
+"""
+New API 查询层：带缓存的绑定关系、用户名→ID、余额快照
+
+斜杠命令每次都要先查后端绑定，再调用 New API 的 /api/user/search 把用户名换成 ID，
+这里把这些结果按 TTL+LRU 缓存起来，同一个 key 的并发刷新只发一次请求。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+# 缓存未命中的标记（缓存值本身可能是 None）
+MISS = object()
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存，load() 对同一个 key 的并发刷新只执行一次"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (过期时间, 值)
+        self.items = OrderedDict()
+        self.inflight = {}
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return MISS
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self.items.pop(key, None)
+            return MISS
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self.items[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key):
+        self.items.pop(key, None)
+        # 正在进行的刷新结果可能已经过时，不再写回缓存
+        self.inflight.pop(key, None)
+
+    async def load(self, key, loader):
+        """读缓存，未命中时调用 loader() 刷新
+
+        loader 返回 (值, 缓存秒数)，秒数为 None 时用默认 TTL，为 0 时不缓存；
+        抛出异常时不缓存，所有等待者收到同一个异常。
+        """
+        value = self.get(key)
+        if value is not MISS:
+            return value
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, loader))
+            self.inflight[key] = task
+        # 某个调用方被取消时不影响其他等待者
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader):
+        try:
+            value, ttl = await loader()
+            if ttl != 0 and self.inflight.get(key) is asyncio.current_task():
+                self.set(key, value, ttl)
+            return value
+        finally:
+            if self.inflight.get(key) is asyncio.current_task():
+                self.inflight.pop(key, None)
+
+
+def parse_token_page(data) -> list:
+    """兼容不同版本 New API 的令牌列表结构"""
+    tokens_data = data.get("data", {})
+    if isinstance(tokens_data, dict):
+        return tokens_data.get("data", []) or tokens_data.get("items", []) or []
+    if isinstance(tokens_data, list):
+        return tokens_data
+    return []
+
+
+class TokenIndex:
+    """令牌 ID → 用户的本地索引
+
+    管理员接口按 ID 倒序分页返回所有用户的令牌。记录已扫描到的最大 ID（高水位），
+    之后只需从第一页往后翻到高水位为止；每隔 full_ttl 秒完整重扫一次，清掉已删除的令牌。
+    """
+
+    # 只保存展示需要的字段
+    FIELDS = ("id", "user_id", "name", "key", "status", "remain_quota", "unlimited_quota")
+
+    def __init__(self, full_ttl: float, refresh_ttl: float):
+        self.full_ttl = full_ttl
+        self.refresh_ttl = refresh_ttl
+        self.tokens = {}
+        self.by_user = {}
+        self.high_water = 0
+        self.full_at = 0.0
+        self.checked_at = 0.0
+        self.dirty = True
+        self.lock = asyncio.Lock()
+
+    def put(self, token: dict):
+        token_id = token.get("id")
+        if not token_id:
+            return
+        record = {field: token[field] for field in self.FIELDS if field in token}
+        old = self.tokens.get(token_id)
+        if old and str(old.get("user_id")) != str(record.get("user_id")):
+            self.by_user.get(str(old.get("user_id")), set()).discard(token_id)
+        self.tokens[token_id] = record
+        self.by_user.setdefault(str(record.get("user_id")), set()).add(token_id)
+
+    def replace_user(self, user_id, tokens: list):
+        """用某个用户的完整令牌列表覆盖索引"""
+        for token_id in self.by_user.pop(str(user_id), set()):
+            self.tokens.pop(token_id, None)
+        for token in tokens:
+            self.put(dict(token, user_id=token.get("user_id", user_id)))
+
+    def user_tokens(self, user_id) -> list:
+        ids = sorted(self.by_user.get(str(user_id), ()), reverse=True)
+        return [self.tokens[token_id] for token_id in ids]
+
+    def needs_full_scan(self) -> bool:
+        return time.monotonic() - self.full_at > self.full_ttl
+
+    def is_fresh(self) -> bool:
+        return not self.dirty and time.monotonic() - self.checked_at < self.refresh_ttl
+
+
+class NewApiClient:
+    """斜杠命令用到的 New API / 后端绑定查询，结果带缓存
+
+    - 绑定关系（Discord ID → New API 用户名）：后端查询，注册、登录后失效
+    - 用户名 → ID：基本不会变，缓存较久
+    - 用户信息快照（余额、用量）：短时间缓存，/账号 和 /余额 共用，创建令牌后失效
+    """
+
+    def __init__(self, http_clients, admin_key: str, binding_ttl: float, user_id_ttl: float,
+                 snapshot_ttl: float, maxsize: int, token_page_size: int = 100,
+                 token_index_ttl: float = 600, token_refresh_ttl: float = 30):
+        self.http_clients = http_clients
+        self.admin_key = admin_key
+        self.binding_ttl = binding_ttl
+        self.bindings = TTLCache(maxsize, binding_ttl)
+        self.user_ids = TTLCache(maxsize, user_id_ttl)
+        self.snapshots = TTLCache(maxsize, snapshot_ttl)
+        self.token_page_size = token_page_size
+        self.token_index = TokenIndex(token_index_ttl, token_refresh_ttl)
+
+    def admin_headers(self) -> dict:
+        return {"Authorization": f"{self.admin_key}", "New-Api-User": "1"}
+
+    # ---------- 绑定关系 ----------
+
+    async def get_binding(self, discord_id: str) -> dict:
+        """查询用户是否已在后端绑定，返回 {"exists": bool, "user": {...}}"""
+        async def loader():
+            resp = await self.http_clients.backend.get(f"/api/newapi-users/by-discord/{discord_id}")
+            resp.raise_for_status()
+            data = resp.json()
+            # 未绑定的结果只短暂缓存，管理员在后台补录后能尽快生效
+            return data, None if data.get("exists") else min(30, self.binding_ttl)
+
+        try:
+            return await self.bindings.load(discord_id, loader)
+        except Exception:
+            return {"exists": False}
+
+    async def save_binding(self, discord_id: str, discord_name: str, newapi_username: str, token: str = "") -> bool:
+        """保存用户绑定到后端，返回是否成功（成功后才丢弃绑定缓存）"""
+        try:
+            resp = await self.http_clients.backend.post(
+                "/api/newapi-users",
+                json={
+                    "discord_id": discord_id,
+                    "discord_name": discord_name,
+                    "newapi_username": newapi_username,
+                    "newapi_token": token
+                }
+            )
+        except Exception as e:
+            print(f"[绑定] 保存绑定失败 discord_id={discord_id}: {type(e).__name__}: {e}", flush=True)
+            return False
+        if resp.is_error:
+            print(f"[绑定] 保存绑定失败 discord_id={discord_id}: HTTP {resp.status_code}", flush=True)
+            return False
+        self.bindings.pop(discord_id)
+        return True
+
+    async def update_token(self, discord_id: str, token: str) -> bool:
+        """更新用户 Token，返回是否成功（成功后才丢弃绑定缓存）"""
+        try:
+            resp = await self.http_clients.backend.put(
+                f"/api/newapi-users/{discord_id}/token",
+                params={"token": token}
+            )
+        except Exception as e:
+            print(f"[绑定] 更新 Token 失败 discord_id={discord_id}: {type(e).__name__}", flush=True)
+            return False
+        # 不打印响应异常的原文：URL 里带着 Token
+        if resp.is_error:
+            print(f"[绑定] 更新 Token 失败 discord_id={discord_id}: HTTP {resp.status_code}", flush=True)
+            return False
+        self.bindings.pop(discord_id)
+        return True
+
+    # ---------- New API 用户 ----------
+
+    async def search_user(self, username: str) -> dict:
+        """按用户名查询用户信息快照，返回 {"success": bool, "user": {...}, "message": str}"""
+        async def loader():
+            resp = await self.http_clients.newapi.get(
+                "/api/user/search",
+                params={"keyword": username},
+                headers=self.admin_headers()
+            )
+            if resp.status_code != 200:
+                return {"success": False, "message": f"HTTP {resp.status_code}"}, 0
+            data = resp.json()
+            if not data.get("success"):
+                return {"success": False, "message": data.get("message", "查询失败")}, 0
+            # 数据在 data.items 里
+            items = data.get("data", {}).get("items", [])
+            for u in items:
+                if isinstance(u, dict) and u.get("username") == username:
+                    if u.get("id"):
+                        self.user_ids.set(username, u.get("id"))
+                    return {"success": True, "user": u}, None
+            return {"success": False, "message": f"未找到用户 (共{len(items)}个结果)"}, 0
+
+        try:
+            return await self.snapshots.load(username, loader)
+        except Exception as e:
+            return {"success": False, "message": f"请求失败: {type(e).__name__}: {e}"}
+
+    async def get_user_id(self, username: str):
+        """通过用户名获取 New API 用户 ID"""
+        user_id = self.user_ids.get(username)
+        if user_id is not MISS:
+            return user_id
+        result = await self.search_user(username)
+        if result["success"]:
+            return result["user"].get("id")
+        return None
+
+    # ---------- 令牌 ----------
+
+    async def list_user_tokens(self, user_id, user_token: str = "") -> dict:
+        """列出某个用户的令牌，返回 {"success": bool, "tokens": [...], "message": str}
+
+        有用户自己的 Token 时直接调用按用户过滤的接口；否则用管理员接口增量扫描本地索引。
+        """
+        if user_token:
+            result = await self._list_own_tokens(user_id, user_token)
+            if result["success"]:
+                return result
+        index = self.token_index
+        if not index.is_fresh():
+            async with index.lock:
+                # 等锁期间别人可能已经扫完
+                if not index.is_fresh():
+                    result = await self._scan_tokens(full=index.needs_full_scan())
+                    if not result["success"]:
+                        return result
+        return {"success": True, "tokens": index.user_tokens(user_id)}
+
+    async def _list_own_tokens(self, user_id, user_token: str) -> dict:
+        headers = {"Authorization": f"Bearer {user_token}", "New-Api-User": str(user_id)}
+        tokens = []
+        try:
+            page = 0
+            while True:
+                resp = await self.http_clients.newapi.get(
+                    "/api/token/",
+                    params={"p": page, "size": self.token_page_size},
+                    headers=headers
+                )
+                data = resp.json()
+                if resp.status_code != 200 or not data.get("success"):
+                    return {"success": False, "message": data.get("message", "获取失败")}
+                items = parse_token_page(data)
+                tokens.extend(t for t in items if str(t.get("user_id", user_id)) == str(user_id))
+                if len(items) < self.token_page_size:
+                    break
+                page += 1
+        except Exception as e:
+            return {"success": False, "message": f"请求失败: {e}"}
+        self.token_index.replace_user(user_id, tokens)
+        return {"success": True, "tokens": self.token_index.user_tokens(user_id)}
+
+    async def _scan_tokens(self, full: bool) -> dict:
+        """按页流式读取管理员令牌列表并更新索引，增量扫描遇到高水位即停止"""
+        index = self.token_index
+        high_water = 0 if full else index.high_water
+        seen = set()
+        max_id = index.high_water
+        page = 0
+        try:
+            while True:
+                resp = await self.http_clients.newapi.get(
+                    "/api/token/",
+                    params={"p": page, "size": self.token_page_size},
+                    headers=self.admin_headers()
+                )
+                data = resp.json()
+                if resp.status_code != 200 or not data.get("success"):
+                    return {"success": False, "message": data.get("message", "获取失败")}
+                items = parse_token_page(data)
+                ids = [t.get("id") or 0 for t in items]
+                for token in items:
+                    index.put(token)
+                seen.update(ids)
+                max_id = max([max_id] + ids)
+                if len(items) < self.token_page_size:
+                    break
+                # 只有确认是按 ID 倒序时才能在高水位处提前停止
+                if high_water and ids == sorted(ids, reverse=True) and ids[-1] <= high_water:
+                    break
+                page += 1
+        except Exception as e:
+            return {"success": False, "message": f"请求失败: {e}"}
+        now = time.monotonic()
+        if full:
+            # 完整扫描没见到的令牌已被删除
+            for token_id in [t for t in index.tokens if t not in seen]:
+                record = index.tokens.pop(token_id)
+                index.by_user.get(str(record.get("user_id")), set()).discard(token_id)
+            index.full_at = now
+        index.high_water = max_id
+        index.checked_at = now
+        index.dirty = False
+        print(f"[令牌索引] {'完整' if full else '增量'}扫描 {page + 1} 页，共索引 {len(index.tokens)} 个令牌", flush=True)
+        return {"success": True}
+
+    def invalidate(self, discord_id: str = None, username: str = None, tokens: bool = False):
+        """注册、创建令牌等写操作之后调用，丢弃相关缓存"""
+        if discord_id:
+            self.bindings.pop(discord_id)
+        if username:
+            self.snapshots.pop(username)
+        if tokens:
+            # 新令牌的 ID 一定高于高水位，下次查询做一次增量扫描即可
+            self.token_index.dirty = True
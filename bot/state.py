@@ -0,0 +1,203 @@
+"""
+Bot 本地状态：用户消息计数、登录 Token 等
+
+内存中按 LRU 限制条数，定期把变更写入本地 SQLite 快照，重启后恢复，
+不再因为重启把所有人的总结计数清零。
+登录 Token 只放在内存里，不写盘（后端绑定里有一份，重启后从那里取）。
+"""
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+
+class LRUStore:
+    """有上限的 LRU 字典，记录自上次快照以来的变更（persist=False 时只在内存里，不记录变更）"""
+
+    def __init__(self, name: str, maxsize: int, persist: bool = True):
+        self.name = name
+        self.maxsize = maxsize
+        self.persist = persist
+        self.items = OrderedDict()
+        self.dirty = set()
+        self.deleted = set()
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if self.persist:
+            self.dirty.add(key)
+            self.deleted.discard(key)
+        while len(self.items) > self.maxsize:
+            old_key, _ = self.items.popitem(last=False)
+            if self.persist:
+                self.dirty.discard(old_key)
+                self.deleted.add(old_key)
+
+    def pop(self, key, default=None):
+        if key not in self.items:
+            return default
+        if self.persist:
+            self.dirty.discard(key)
+            self.deleted.add(key)
+        return self.items.pop(key)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class BotState:
+    """Bot 状态存储，多个 Bot 共用一份（键里带上 bot_id 区分）
+
+    值只存整数或字符串，直接用 SQLite 的动态类型保存，加载时不需要再解析。
+
+    - counts: "bot_id:user_id" -> 消息计数（每 50 条总结一次记忆）
+    - tokens: discord_id -> New API 登录 Token（只在内存里，明文 Token 不落盘）
+    - kv: 少量杂项（如斜杠命令的哈希），修改后立即写盘
+
+    快照文件权限设为 600。
+    """
+
+    def __init__(self, path: str, max_entries: int, snapshot_interval: float):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.counts = LRUStore("counts", max_entries)
+        self.tokens = LRUStore("tokens", max_entries, persist=False)
+        # 需要写盘的存储
+        self.stores = (self.counts,)
+        self.kv = {}
+        self.loaded = False
+        self.refs = 0
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        os.chmod(self.path, 0o600)
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                store TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value,
+                updated_at REAL,
+                PRIMARY KEY (store, key)
+            ) WITHOUT ROWID"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_updated ON entries(store, updated_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    def load(self):
+        """从快照恢复，按更新时间排序以保留 LRU 顺序"""
+        if self.loaded:
+            return
+        started = time.perf_counter()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connect()
+        # 旧版本写过明文 Token，清掉
+        with conn:
+            conn.execute("DELETE FROM entries WHERE store = ?", (self.tokens.name,))
+        for store in self.stores:
+            rows = conn.execute(
+                """SELECT key, value FROM (
+                       SELECT key, value, updated_at FROM entries WHERE store = ?
+                       ORDER BY updated_at DESC LIMIT ?
+                   ) ORDER BY updated_at""",
+                (store.name, store.maxsize),
+            ).fetchall()
+            store.items = OrderedDict(rows)
+        self.kv = dict(conn.execute("SELECT key, value FROM kv").fetchall())
+        conn.close()
+        self.loaded = True
+        print(
+            f"💾 [状态] 已加载 {len(self.counts)} 个计数，"
+            f"耗时 {(time.perf_counter() - started) * 1000:.0f}ms",
+            flush=True
+        )
+
+    def _write(self, changes: list):
+        conn = self._connect()
+        with conn:
+            for store_name, upserts, deletes in changes:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO entries (store, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                    [(store_name, key, value, updated_at) for key, value, updated_at in upserts],
+                )
+                conn.executemany(
+                    "DELETE FROM entries WHERE store = ? AND key = ?",
+                    [(store_name, key) for key in deletes],
+                )
+        conn.close()
+
+    async def snapshot(self):
+        """把上次快照之后的变更写入 SQLite（在线程里写，不阻塞事件循环）"""
+        async with self._lock:
+            changes = []
+            now = time.time()
+            for store in self.stores:
+                if not store.dirty and not store.deleted:
+                    continue
+                # 按 LRU 顺序给出递增的时间戳，恢复时顺序不变
+                order = {key: i for i, key in enumerate(store.items)} if store.dirty else {}
+                upserts = [
+                    (key, store.items[key], now + order[key] * 1e-6)
+                    for key in store.dirty
+                ]
+                changes.append((store.name, upserts, list(store.deleted)))
+                store.dirty = set()
+                store.deleted = set()
+            if not changes:
+                return
+            try:
+                await asyncio.to_thread(self._write, changes)
+            except Exception:
+                # 写盘失败时把变更放回去，下次快照重试（期间又改过的以内存为准）
+                stores = {store.name: store for store in self.stores}
+                for store_name, upserts, deletes in changes:
+                    store = stores[store_name]
+                    store.dirty.update(key for key, _, _ in upserts if key in store.items)
+                    store.deleted.update(key for key in deletes if key not in store.items)
+                raise
+
+    def get_kv(self, key: str, default: str = "") -> str:
+        return self.kv.get(key, default)
+
+    def _write_kv(self, key: str, value: str):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, value))
+        conn.close()
+
+    async def set_kv(self, key: str, value: str):
+        """修改后立即写盘（在线程里写，不阻塞事件循环）"""
+        self.kv[key] = value
+        await asyncio.to_thread(self._write_kv, key, value)
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception as e:
+                print(f"💾 [状态] 快照失败: {e}", flush=True)
+
+    def open(self):
+        """加载快照并启动定期写盘，多 Bot 托管时按引用计数共用"""
+        self.refs += 1
+        self.load()
+        if self._task is None:
+            self._task = asyncio.create_task(self._snapshot_loop())
+
+    async def close(self):
+        self.refs = max(0, self.refs - 1)
+        await self.snapshot()
+        if not self.refs and self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1 @@
+"""后端和 Bot 共用的代码"""
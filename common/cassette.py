@@ -0,0 +1,161 @@
+"""
+录制/回放：把 httpx 请求和响应录成 JSONL，离线复现上游流量
+
+后端（LLM 上游）和 Bot（New API）共用。录制前会脱敏：请求体、响应体、URL 参数里的
+密码、Key、Token 等字段替换成 ***，鉴权相关的响应头也一样，录制文件可以放心分享。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import httpx
+
+# 需要脱敏的 JSON 字段和 URL 参数（不区分大小写，任意层级）
+SECRET_FIELDS = {
+    "password", "api_key", "apikey", "key", "token", "access_token", "refresh_token",
+    "newapi_token", "authorization", "secret",
+}
+# 需要脱敏的响应头
+SECRET_HEADERS = {"authorization", "proxy-authorization", "cookie", "set-cookie", "x-api-key"}
+MASK = "***"
+
+
+def redact_value(data):
+    """递归替换 JSON 中的敏感字段"""
+    if isinstance(data, dict):
+        return {
+            k: (MASK if k.lower() in SECRET_FIELDS and data[k] not in (None, "") else redact_value(v))
+            for k, v in data.items()
+        }
+    if isinstance(data, list):
+        return [redact_value(v) for v in data]
+    return data
+
+
+class Cassette:
+    """录制文件：JSONL，每行一次请求/响应及其耗时
+
+    回放时先按精确指纹（方法+URL+请求体）匹配，匹配不到再按接口（方法+路径）兜底，
+    这样新版本的提示词变化后依然可以回放同一天的流量。
+    """
+
+    def __init__(self, mode: str, path: str, latency_scale: float = 1.0):
+        self.mode = mode
+        self.path = path
+        self.latency_scale = latency_scale
+        self._exact = {}
+        self._by_endpoint = {}
+        self._cursor = {}
+        if mode == "replay":
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    @staticmethod
+    def redact(body: bytes) -> str:
+        text = body.decode("utf-8", errors="replace")
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return text
+        return json.dumps(redact_value(data), ensure_ascii=False, sort_keys=True)
+
+    @staticmethod
+    def redact_url(url: httpx.URL) -> str:
+        if not url.params:
+            return str(url)
+        params = [(k, MASK if k.lower() in SECRET_FIELDS else v) for k, v in url.params.multi_items()]
+        return str(url.copy_with(params=params))
+
+    @staticmethod
+    def redact_headers(headers: dict) -> dict:
+        return {k: (MASK if k.lower() in SECRET_HEADERS else v) for k, v in headers.items()}
+
+    @staticmethod
+    def endpoint(method: str, url: httpx.URL) -> str:
+        return f"{method} {url.host}{url.path}"
+
+    @staticmethod
+    def fingerprint(method: str, url: str, body: str) -> str:
+        return f"{method} {url} {hashlib.sha1(body.encode('utf-8')).hexdigest()}"
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            print(f"⚠️ [回放] 录制文件不存在: {self.path}", flush=True)
+            return
+        count = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self._exact.setdefault(entry["key"], []).append(entry)
+                self._by_endpoint.setdefault(entry["endpoint"], []).append(entry)
+                count += 1
+        print(f"📼 [回放] 已加载 {count} 条录制: {self.path}", flush=True)
+
+    def _next(self, table: dict, key: str):
+        entries = table.get(key)
+        if not entries:
+            return None
+        # 同一请求多次出现时按录制顺序循环取
+        idx = self._cursor.get((id(table), key), 0)
+        self._cursor[(id(table), key)] = idx + 1
+        return entries[idx % len(entries)]
+
+    def lookup(self, key: str, endpoint: str):
+        return self._next(self._exact, key) or self._next(self._by_endpoint, endpoint)
+
+    def record(self, entry: dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """按 Cassette 录制或回放请求的 httpx 传输层"""
+
+    # 响应体已经解码，这些头不能原样回放
+    DROP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+    def __init__(self, cassette: Cassette, inner: httpx.AsyncBaseTransport = None):
+        self.cassette = cassette
+        self.inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = self.cassette.redact(await request.aread())
+        url = self.cassette.redact_url(request.url)
+        key = self.cassette.fingerprint(request.method, url, body)
+        endpoint = self.cassette.endpoint(request.method, request.url)
+
+        if self.cassette.mode == "replay":
+            entry = self.cassette.lookup(key, endpoint)
+            if entry is None:
+                return httpx.Response(502, text=f"cassette miss: {endpoint}", request=request)
+            if self.cassette.latency_scale > 0:
+                await asyncio.sleep(entry["elapsed"] * self.cassette.latency_scale)
+            return httpx.Response(entry["status"], headers=entry["headers"], text=entry["body"], request=request)
+
+        start = time.perf_counter()
+        response = await self.inner.handle_async_request(request)
+        content = await response.aread()
+        elapsed = time.perf_counter() - start
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in self.DROP_HEADERS}
+        # 请求头（含 Authorization）不录制；响应头和响应体脱敏后再写盘，返回给调用方的仍是原始响应
+        self.cassette.record({
+            "ts": time.time(),
+            "key": key,
+            "endpoint": endpoint,
+            "method": request.method,
+            "url": url,
+            "request": body,
+            "status": response.status_code,
+            "headers": self.cassette.redact_headers(headers),
+            "body": self.cassette.redact(content),
+            "elapsed": round(elapsed, 4),
+        })
+        return httpx.Response(response.status_code, headers=headers, content=content, request=request)
+
+    async def aclose(self):
+        await self.inner.aclose()
@@ -1,40 +1,118 @@
 #!/usr/bin/env python3
 """
 一键启动脚本 - 同时运行后端和 Bot
+
+    python start.py                       # 后端和 Bot 两个进程，通过 TCP 通信
+    python start.py --uds /tmp/meow.sock  # 两个进程，Bot 通过 Unix socket 访问后端
+    python start.py --single-process      # 后端和 Bot 跑在同一个进程、同一个事件循环里
 """
+import argparse
+import asyncio
+import importlib.util
 import subprocess
 import sys
 import os
 
+BACKEND_PORT = 8002
+
 # 切换到脚本所在目录
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
-
-# 安装依赖
-print("📦 安装依赖...")
-subprocess.run([sys.executable, "-m", "pip", "install", "-r", "requirements.txt", "-q"])
-
-# 启动后端
-print("🚀 启动后端服务...")
-backend_process = subprocess.Popen(
-    [sys.executable, "-m", "uvicorn", "main:app", "--host", "0.0.0.0", "--port", "8002"],
-    cwd="backend"
-)
-
-# 启动 Bot
-print("🤖 启动 Discord Bot...")
-bot_process = subprocess.Popen(
-    [sys.executable, "main.py"],
-    cwd="bot"
-)
-
-print("✅ 全部启动完成！")
-print("   后端地址: http://0.0.0.0:8002")
-
-# 等待进程
-try:
-    backend_process.wait()
-    bot_process.wait()
-except KeyboardInterrupt:
-    print("\n🛑 正在停止服务...")
-    backend_process.terminate()
-    bot_process.terminate()
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(ROOT_DIR)
+
+
+def load_module(name: str, path: str):
+    """按文件路径加载模块（后端和 Bot 都叫 main.py，需要换个模块名）"""
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+async def run_single_process():
+    """单进程模式：FastAPI 和 Discord 客户端共用一个事件循环，/api/ask 直接以协程调用"""
+    import uvicorn
+
+    # 后端的数据目录默认相对 backend 目录，与双进程模式保持一致
+    os.chdir(os.path.join(ROOT_DIR, "backend"))
+    backend = load_module("meow_backend", os.path.join(ROOT_DIR, "backend", "main.py"))
+    bot = load_module("meow_bot", os.path.join(ROOT_DIR, "bot", "main.py"))
+    if not bot.TOKEN:
+        raise RuntimeError("DISCORD_BOT_TOKEN 未配置，请在运行环境变量中设置。")
+
+    backend.init_db()
+    bot.LOCAL_BACKEND = backend
+
+    server = uvicorn.Server(uvicorn.Config(backend.app, host="0.0.0.0", port=BACKEND_PORT))
+    bot_task = asyncio.create_task(bot.client.start(bot.TOKEN))
+    print("✅ 全部启动完成（单进程）！")
+    print(f"   后端地址: http://0.0.0.0:{BACKEND_PORT}")
+    try:
+        await server.serve()
+    finally:
+        print("\n🛑 正在停止服务...")
+        await bot.client.close()
+        bot_task.cancel()
+
+
+def run_processes(uds: str):
+    """双进程模式"""
+    # 启动后端
+    print("🚀 启动后端服务...")
+    bot_env = os.environ.copy()
+    if uds:
+        backend_process = subprocess.Popen(
+            [sys.executable, "main.py"],
+            cwd="backend",
+            env=dict(os.environ, BACKEND_PORT=str(BACKEND_PORT), BACKEND_UDS=uds)
+        )
+        bot_env["BACKEND_UDS"] = uds
+    else:
+        backend_process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "0.0.0.0", "--port", str(BACKEND_PORT)],
+            cwd="backend"
+        )
+
+    # 启动 Bot
+    print("🤖 启动 Discord Bot...")
+    bot_process = subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd="bot",
+        env=bot_env
+    )
+
+    print("✅ 全部启动完成！")
+    print(f"   后端地址: http://0.0.0.0:{BACKEND_PORT}")
+
+    # 等待进程
+    try:
+        backend_process.wait()
+        bot_process.wait()
+    except KeyboardInterrupt:
+        print("\n🛑 正在停止服务...")
+        backend_process.terminate()
+        bot_process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同时启动后端和 Discord Bot")
+    parser.add_argument("--uds", default="", help="后端额外监听的 Unix socket 路径，Bot 通过它访问后端")
+    parser.add_argument("--single-process", action="store_true", help="后端和 Bot 在同一个进程中运行")
+    args = parser.parse_args()
+
+    # 安装依赖
+    print("📦 安装依赖...")
+    subprocess.run([sys.executable, "-m", "pip", "install", "-r", "requirements.txt", "-q"])
+
+    if args.single_process:
+        try:
+            asyncio.run(run_single_process())
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_processes(args.uds)
+
+
+if __name__ == "__main__":
+    main()